@@ -152,6 +152,8 @@ class AddressSynchronizer(PrintError):
 
     def on_blockchain_updated(self, event, *args):
         self._get_addr_balance_cache = {}  # invalidate cache
+        if self.verifier:
+            self.verifier.wakeup()
 
     def stop_threads(self, write_to_disk=True):
         if self.network:
@@ -516,6 +518,8 @@ class AddressSynchronizer(PrintError):
             with self.lock:
                 # tx will be verified only if height > 0
                 self.unverified_tx[tx_hash] = tx_height
+            if self.verifier:
+                self.verifier.wakeup()
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
@@ -528,8 +532,9 @@ class AddressSynchronizer(PrintError):
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
-        tx_mined_status = self.get_tx_height(tx_hash)
-        self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
+        if self.network:
+            tx_mined_status = self.get_tx_height(tx_hash)
+            self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
@@ -546,7 +551,7 @@ class AddressSynchronizer(PrintError):
                 if tx_height >= height:
                     header = blockchain.read_header(tx_height)
                     if not header or hash_header(header) != info.header_hash:
-                        self.db.remove_verified_tx(tx_hash)
+                        self.db.undo_verified_tx(tx_hash)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
                         # If on the new fork after the reorg, the txn is at the
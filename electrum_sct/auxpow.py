@@ -43,7 +43,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import binascii
+import struct
+from typing import Tuple, Sequence
 
 # electrum_sct.blockchain is an absolute import because cyclic imports must be
 # absolute prior to Python 3.5.
@@ -51,7 +52,7 @@ import electrum_sct.blockchain
 from .bitcoin import hash_encode, hash_decode
 from .crypto import sha256d
 from . import transaction
-from .transaction import BCDataStream, Transaction, TYPE_SCRIPT
+from .transaction import BCDataStream, Transaction, TYPE_SCRIPT, SerializationError
 from .util import bfh, bh2u
 
 BLOCK_VERSION_AUXPOW_BIT = 0x100
@@ -69,45 +70,139 @@ def auxpow_active(base_header):
 def get_chain_id(base_header):
     return base_header['version'] >> 16
 
-# If expect_trailing_data, returns start position of trailing data
-def deserialize_auxpow_header(base_header, s, expect_trailing_data=False, start_position=0):
-    if len(s) - start_position == 0 and not expect_trailing_data:
-        return None
-
-    auxpow_header = {}
-
-    # Chain ID is the top 16 bits of the 32-bit version.
-    auxpow_header['chain_id'] = get_chain_id(base_header)
-
-    # The parent coinbase transaction is first.
-    # Deserialize it and save the trailing data.
-    parent_coinbase_tx = Transaction(None, expect_trailing_data=True, raw_bytes=s, expect_trailing_bytes=True, copy_input=False, start_position=start_position)
-    parent_coinbase_tx_dict, start_position = fast_tx_deserialize(parent_coinbase_tx)
-    auxpow_header['parent_coinbase_tx'] = parent_coinbase_tx
-
-    # Next is the parent block hash.  According to the Bitcoin.it wiki,
-    # this field is not actually consensus-critical.  So we don't save it.
-    start_position = start_position + 32
-
-    # The coinbase and chain merkle branches/indices are next.
-    # Deserialize them and save the trailing data.
-    auxpow_header['coinbase_merkle_branch'], auxpow_header['coinbase_merkle_index'], start_position = deserialize_merkle_branch(s, start_position=start_position)
-    auxpow_header['chain_merkle_branch'], auxpow_header['chain_merkle_index'], start_position = deserialize_merkle_branch(s, start_position=start_position)
-    
-    # Finally there's the parent header.  Deserialize it, along with any
-    # trailing data if requested.
-    if expect_trailing_data:
-        auxpow_header['parent_header'], start_position = electrum_sct.blockchain.deserialize_header(s, 1, expect_trailing_data=expect_trailing_data, start_position=start_position)
-    else:
-        auxpow_header['parent_header'] = electrum_sct.blockchain.deserialize_header(s, 1, expect_trailing_data=expect_trailing_data, start_position=start_position)
-    # The parent block header doesn't have any block height,
-    # so delete that field.  (We used 1 as a dummy value above.)
-    del auxpow_header['parent_header']['block_height']
-
-    if expect_trailing_data:
-        return auxpow_header, start_position
-
-    return auxpow_header
+class AuxPow:
+    """The parts of an auxpow that verify_auxpow looks at.
+    Hashes are raw bytes, in internal byte order.
+
+    It can still be read like the dicts deserialize_auxpow_header used to
+    return: auxpow['chain_id'], auxpow['coinbase_merkle_branch'] (hex),
+    auxpow['parent_header'] (without a block height), and so on.
+    auxpow['parent_coinbase_tx'] is a Transaction that is not deserialized.
+    """
+
+    __slots__ = ('chain_id', 'coinbase_tx', 'coinbase_txid', 'coinbase_script_sig',
+                 'coinbase_merkle_branch', 'coinbase_merkle_index',
+                 'chain_merkle_branch', 'chain_merkle_index', 'parent_header')
+
+    def __init__(self, chain_id: int, coinbase_tx: bytes, coinbase_script_sig: bytes,
+                 coinbase_merkle_branch: Sequence[bytes], coinbase_merkle_index: int,
+                 chain_merkle_branch: Sequence[bytes], chain_merkle_index: int,
+                 parent_header: bytes):
+        self.chain_id = chain_id
+        self.coinbase_tx = coinbase_tx  # serialized
+        self.coinbase_txid = sha256d(coinbase_tx)
+        self.coinbase_script_sig = coinbase_script_sig
+        self.coinbase_merkle_branch = coinbase_merkle_branch
+        self.coinbase_merkle_index = coinbase_merkle_index
+        self.chain_merkle_branch = chain_merkle_branch
+        self.chain_merkle_index = chain_merkle_index
+        self.parent_header = parent_header  # serialized, 80 bytes
+
+    def parent_hash(self) -> str:
+        return hash_encode(sha256d(self.parent_header))
+
+    def parent_version(self) -> int:
+        return int.from_bytes(self.parent_header[0:4], 'little')
+
+    def parent_merkle_root(self) -> bytes:
+        return self.parent_header[36:68]
+
+    # dict-like access, for code written against auxpow dicts
+
+    _KEYS = ('chain_id', 'parent_coinbase_tx', 'coinbase_merkle_branch', 'coinbase_merkle_index',
+             'chain_merkle_branch', 'chain_merkle_index', 'parent_header')
+
+    def __getitem__(self, key):
+        if key == 'chain_id':
+            return self.chain_id
+        if key == 'parent_coinbase_tx':
+            return Transaction(None, raw_bytes=self.coinbase_tx)
+        if key == 'coinbase_merkle_branch':
+            return [hash_encode(h) for h in self.coinbase_merkle_branch]
+        if key == 'coinbase_merkle_index':
+            return self.coinbase_merkle_index
+        if key == 'chain_merkle_branch':
+            return [hash_encode(h) for h in self.chain_merkle_branch]
+        if key == 'chain_merkle_index':
+            return self.chain_merkle_index
+        if key == 'parent_header':
+            # The parent block header doesn't have any block height.
+            header = electrum_sct.blockchain.BlockHeader.from_bytes(self.parent_header, 1)
+            del header['block_height']
+            return header
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._KEYS
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def keys(self):
+        return list(self._KEYS)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._KEYS else default
+
+def _read_compact_size(b: memoryview, pos: int) -> Tuple[int, int]:
+    size = b[pos]
+    if size < 253:
+        return size, pos + 1
+    if size == 253:
+        return struct.unpack_from('<H', b, pos + 1)[0], pos + 3
+    if size == 254:
+        return struct.unpack_from('<I', b, pos + 1)[0], pos + 5
+    return struct.unpack_from('<Q', b, pos + 1)[0], pos + 9
+
+def _read_merkle_branch(b: memoryview, pos: int) -> Tuple[Tuple[bytes, ...], int, int]:
+    n_hashes, pos = _read_compact_size(b, pos)
+    end = pos + 32 * n_hashes
+    hashes = tuple(bytes(b[i:i+32]) for i in range(pos, end, 32))
+    index = struct.unpack_from('<i', b, end)[0]
+    return hashes, index, end + 4
+
+# Walks the auxpow in place instead of building a Transaction for the
+# parent coinbase; only its txid and first scriptSig are kept.
+# Returns the AuxPow and the position of the data following it in s.
+def parse_auxpow_header(base_header, s, start_position=0) -> Tuple[AuxPow, int]:
+    b = memoryview(s)
+    try:
+        pos = start_position
+        n_inputs, pos = _read_compact_size(b, pos + 4)  # after tx version
+        if n_inputs == 0:
+            raise SerializationError('parent coinbase has no inputs')
+        script_sig = None
+        for i in range(n_inputs):
+            script_size, pos = _read_compact_size(b, pos + 36)  # after prevout
+            if i == 0:
+                script_sig = bytes(b[pos:pos+script_size])
+            pos += script_size + 4  # and sequence
+        n_outputs, pos = _read_compact_size(b, pos)
+        for i in range(n_outputs):
+            script_size, pos = _read_compact_size(b, pos + 8)  # after value
+            pos += script_size
+        pos += 4  # locktime
+        if pos > len(b):
+            raise SerializationError('parent coinbase is truncated')
+        coinbase_tx = bytes(b[start_position:pos])
+        # The parent block hash is not consensus-critical, skip it.
+        pos += 32
+        coinbase_merkle_branch, coinbase_merkle_index, pos = _read_merkle_branch(b, pos)
+        chain_merkle_branch, chain_merkle_index, pos = _read_merkle_branch(b, pos)
+        parent_header = bytes(b[pos:pos+80])
+        if len(parent_header) != 80:
+            raise SerializationError('parent header is truncated')
+    except (IndexError, struct.error) as e:
+        raise SerializationError('auxpow is truncated') from e
+    finally:
+        b.release()
+    auxpow = AuxPow(get_chain_id(base_header), coinbase_tx, script_sig,
+                    coinbase_merkle_branch, coinbase_merkle_index,
+                    chain_merkle_branch, chain_merkle_index, parent_header)
+    return auxpow, pos + 80
 
 # Copied from merkle_branch_from_string in https://github.com/electrumalt/electrum-doge/blob/f74312822a14f59aa8d50186baff74cade449ccd/lib/blockchain.py#L622
 # Returns list of hashes, merkle index, and position of trailing data in s
@@ -143,7 +238,7 @@ def hash_parent_header(header):
 
     verify_auxpow(header)
 
-    return electrum_sct.blockchain.hash_header(header['auxpow']['parent_header'])
+    return header['auxpow'].parent_hash()
 
 # Reimplementation of btcutils.check_merkle_branch from Electrum-DOGE.
 # btcutils seems to have an unclear license and no obvious Git repo, so it
@@ -163,6 +258,18 @@ def calculate_merkle_root(leaf, merkle_branch, index):
 
     return hash_encode(target)
 
+# Same as calculate_merkle_root, on raw hashes.
+def _calculate_merkle_root_bytes(leaf: bytes, merkle_branch: Sequence[bytes], index: int) -> bytes:
+    target = leaf
+    mask = index
+    for merkle_step in merkle_branch:
+        if mask & 1 == 0: # 0 means it goes on the right
+            target = sha256d(target + merkle_step)
+        else:
+            target = sha256d(merkle_step + target)
+        mask = mask >> 1
+    return target
+
 # Copied from Electrum-DOGE
 # TODO: Audit this function carefully.
 # https://github.com/kR105/i0coin/compare/bitcoin:master...master#diff-610df86e65fce009eb271c2a4f7394ccR262
@@ -176,23 +283,19 @@ def calc_merkle_index(chain_id, nonce, merkle_size):
 # Copied from Electrum-DOGE
 # TODO: Audit this function carefully.
 def verify_auxpow(header):
-    auxhash = electrum_sct.blockchain.hash_header(header)
-    auxpow = header['auxpow']
+    auxhash = hash_decode(electrum_sct.blockchain.hash_header(header))
+    auxpow = header['auxpow']  # type: AuxPow
 
-    parent_block = auxpow['parent_header']
-    coinbase = auxpow['parent_coinbase_tx']
-    coinbase_hash = fast_txid(coinbase)
+    chain_merkle_branch = auxpow.chain_merkle_branch
+    chain_index = auxpow.chain_merkle_index
 
-    chain_merkle_branch = auxpow['chain_merkle_branch']
-    chain_index = auxpow['chain_merkle_index']
-
-    coinbase_merkle_branch = auxpow['coinbase_merkle_branch']
-    coinbase_index = auxpow['coinbase_merkle_index']
+    coinbase_merkle_branch = auxpow.coinbase_merkle_branch
+    coinbase_index = auxpow.coinbase_merkle_index
 
     #if (get_chain_id(parent_block) == chain_id)
     #  return error("Aux POW parent has our chain ID");
 
-    if (get_chain_id(parent_block) == CHAIN_ID):
+    if (auxpow.parent_version() >> 16 == CHAIN_ID):
         raise Exception('Aux POW parent has our chain ID')
 
     #// Check that the chain merkle root is in the coinbase
@@ -201,12 +304,12 @@ def verify_auxpow(header):
     #std::reverse(vchRootHash.begin(), vchRootHash.end()); // correct endian
 
     # Check that the chain merkle root is in the coinbase
-    root_hash = calculate_merkle_root(auxhash, chain_merkle_branch, chain_index)
+    root_hash = _calculate_merkle_root_bytes(auxhash, chain_merkle_branch, chain_index)
 
     # Check that we are in the parent block merkle tree
     # if (CBlock::CheckMerkleBranch(GetHash(), vMerkleBranch, nIndex) != parentBlock.hashMerkleRoot)
     #    return error("Aux POW merkle root incorrect");
-    if (calculate_merkle_root(coinbase_hash, coinbase_merkle_branch, coinbase_index) != parent_block['merkle_root']):
+    if (_calculate_merkle_root_bytes(auxpow.coinbase_txid, coinbase_merkle_branch, coinbase_index) != auxpow.parent_merkle_root()):
         raise Exception('Aux POW merkle root incorrect')
 
     #// Check that the same work is not submitted twice to our chain.
@@ -221,8 +324,9 @@ def verify_auxpow(header):
     #if (pc == script.end())
         #return error("Aux POW missing chain merkle root in parent coinbase");
 
-    script = coinbase.inputs()[0]['scriptSig']
-    pos = script.find(root_hash)
+    script = auxpow.coinbase_script_sig
+    # the root is in the script as displayed, i.e. byte-reversed
+    pos = script.find(root_hash[::-1])
 
     # todo: if pos == -1 ??
     if pos == -1:
@@ -263,14 +367,8 @@ def verify_auxpow(header):
     #if (nSize != (1 << vChainMerkleBranch.size()))
         #return error("Aux POW merkle branch size does not match parent coinbase");
 
-    def hex_to_int(s):
-        b = bytes.fromhex(s)
-        b_reversed = b[::-1]
-        h = binascii.hexlify(b_reversed).decode('ascii')
-        return int(h, 16)
-
-    size = hex_to_int(script[pos:pos+8])
-    nonce = hex_to_int(script[pos+8:pos+16])
+    size = int.from_bytes(script[pos:pos+4], 'little')
+    nonce = int.from_bytes(script[pos+4:pos+8], 'little')
 
     #print 'size',size
     #print 'nonce',nonce
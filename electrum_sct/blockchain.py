@@ -20,8 +20,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import struct
 import threading
-from typing import Optional, Dict
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Sequence, List, Tuple
+from collections import OrderedDict, deque
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -34,13 +40,19 @@ from decimal import getcontext
 from . import auxpow
 
 HEADER_SIZE = 80  # bytes
+HEADER_CACHE_SIZE = 10000  # decoded headers kept per chain
+HASH_SIZE = 32  # bytes per entry in the block hash index
+HEADER_FSYNC_DELAY = 1.0  # max seconds an appended header may wait to be fsynced
+SWAP_BLOCK_SIZE = 2016 * HEADER_SIZE  # bytes copied at a time when swapping forks
 
 try:
     import scrypt
     getPoWHash = lambda x: scrypt.hash(x, x, N=1024, r=1, p=1, buflen=32)
+    getPoWHashes = lambda xs: [getPoWHash(x) for x in xs]
 except ImportError:
     util.print_msg("Warning: package scrypt not available; synchronization could be very slow")
     from .scrypt import scrypt_1024_1_1_80 as getPoWHash
+    from .scrypt import scrypt_1024_1_1_80_many as getPoWHashes
 
 MAX_TARGET = 0x00000FFFFF000000000000000000000000000000000000000000000000000000
 
@@ -51,7 +63,183 @@ class MissingHeader(Exception):
 class InvalidHeader(Exception):
     pass
 
+
+_SERIALIZED_FIELDS = ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce')
+_HEADER_KEYS = _SERIALIZED_FIELDS + ('block_height', 'auxpow')
+_NOT_DECODED = object()  # hash fields of a BlockHeader are hex-encoded on first use
+
+
+class BlockHeader:
+    """A block header, as returned by deserialize_header.
+
+    Lighter than the dicts used before: it keeps the 80 bytes it was read
+    from, encodes the hashes in it to hex only when asked for them, and
+    remembers its hash and PoW hash once computed. It can still be used
+    like one of those dicts: header['bits'], header.get('auxpow'),
+    dict(header). Keys that were never set are missing, as in a dict.
+    """
+
+    __slots__ = ('version', '_prev_block_hash', '_merkle_root', 'timestamp', 'bits', 'nonce',
+                 'block_height', 'auxpow', '_raw', '_hash', '_powhash')
+
+    def __init__(self, fields=None, **kwargs):
+        self._clear_cache()
+        for d in (fields or {}), kwargs:
+            for key, value in d.items():
+                self[key] = value
+
+    @classmethod
+    def from_bytes(cls, s: bytes, height: int, start_position: int=0) -> 'BlockHeader':
+        raw = bytes(s[start_position:start_position+HEADER_SIZE])
+        h = cls.__new__(cls)
+        set_attr = object.__setattr__
+        set_attr(h, 'version', int.from_bytes(raw[0:4], 'little'))
+        set_attr(h, '_prev_block_hash', _NOT_DECODED)
+        set_attr(h, '_merkle_root', _NOT_DECODED)
+        set_attr(h, 'timestamp', int.from_bytes(raw[68:72], 'little'))
+        set_attr(h, 'bits', int.from_bytes(raw[72:76], 'little'))
+        set_attr(h, 'nonce', int.from_bytes(raw[76:80], 'little'))
+        set_attr(h, 'block_height', height)
+        set_attr(h, '_raw', raw)
+        set_attr(h, '_hash', None)
+        set_attr(h, '_powhash', None)
+        return h
+
+    def _get_hash_field(self, name: str, position: int) -> str:
+        value = getattr(self, name, None)
+        if value is _NOT_DECODED:
+            value = hash_encode(self._raw[position:position+32])
+            object.__setattr__(self, name, value)
+        elif value is None and not hasattr(self, name):
+            raise AttributeError(name[1:])
+        return value
+
+    prev_block_hash = property(lambda self: self._get_hash_field('_prev_block_hash', 4),
+                               lambda self, value: object.__setattr__(self, '_prev_block_hash', value),
+                               lambda self: object.__delattr__(self, '_prev_block_hash'))
+    merkle_root = property(lambda self: self._get_hash_field('_merkle_root', 36),
+                           lambda self, value: object.__setattr__(self, '_merkle_root', value),
+                           lambda self: object.__delattr__(self, '_merkle_root'))
+
+    def _clear_cache(self) -> None:
+        if getattr(self, '_raw', None) is not None:
+            # the hash fields can't be decoded once _raw is gone
+            self._get_hash_field('_prev_block_hash', 4)
+            self._get_hash_field('_merkle_root', 36)
+        object.__setattr__(self, '_raw', None)
+        object.__setattr__(self, '_hash', None)
+        object.__setattr__(self, '_powhash', None)
+
+    def __setattr__(self, name, value):
+        if name in _SERIALIZED_FIELDS:
+            self._clear_cache()
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        if name in _SERIALIZED_FIELDS:
+            self._clear_cache()
+        object.__delattr__(self, name)
+
+    def raw(self) -> bytes:
+        if self._raw is None:
+            object.__setattr__(self, '_raw', bfh(serialize_header(self)))
+        return self._raw
+
+    def hash(self) -> str:
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash_encode(sha256d(self.raw())))
+        return self._hash
+
+    def pow_hash(self) -> str:
+        if self._powhash is None:
+            object.__setattr__(self, '_powhash', hash_encode(getPoWHash(self.raw())))
+        return self._powhash
+
+    # dict-like access, for code written against header dicts
+
+    def __getitem__(self, key):
+        if key not in _HEADER_KEYS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in _HEADER_KEYS:
+            raise KeyError(f'not a header field: {key}')
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return key in _HEADER_KEYS and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [key for key in _HEADER_KEYS if hasattr(self, key)]
+
+    def values(self):
+        return [getattr(self, key) for key in self.keys()]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in _HEADER_KEYS else default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def copy(self) -> 'BlockHeader':
+        h = BlockHeader.__new__(BlockHeader)
+        for name in self.__slots__:
+            if hasattr(self, name):
+                object.__setattr__(h, name, getattr(self, name))
+        return h
+
+    def __getstate__(self):
+        state = self.to_dict()
+        state.update(_raw=self._raw, _hash=self._hash, _powhash=self._powhash)
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+    def __eq__(self, other):
+        if isinstance(other, BlockHeader):
+            return self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'BlockHeader({self.to_dict()!r})'
+
+
 def serialize_header(header_dict: dict) -> str:
+    if isinstance(header_dict, BlockHeader) and header_dict._raw is not None:
+        return bh2u(header_dict._raw)
     s = int_to_hex(header_dict['version'], 4) \
         + rev_hex(header_dict['prev_block_hash']) \
         + rev_hex(header_dict['merkle_root']) \
@@ -66,21 +254,17 @@ def deserialize_header(s: bytes, height: int, expect_trailing_data=False, start_
         raise InvalidHeader('Invalid header: {}'.format(s))
     if len(s) - start_position < HEADER_SIZE:
         raise InvalidHeader('Invalid header length: {}'.format(len(s) - start_position))
-    hex_to_int = lambda s: int.from_bytes(s, byteorder='little')
-    h = {}
-    h['version'] = hex_to_int(s[start_position+0:start_position+4])
-    h['prev_block_hash'] = hash_encode(s[start_position+4:start_position+36])
-    h['merkle_root'] = hash_encode(s[start_position+36:start_position+68])
-    h['timestamp'] = hex_to_int(s[start_position+68:start_position+72])
-    h['bits'] = hex_to_int(s[start_position+72:start_position+76])
-    h['nonce'] = hex_to_int(s[start_position+76:start_position+80])
-    h['block_height'] = height
+    h = BlockHeader.from_bytes(s, height, start_position)
 
     if auxpow.auxpow_active(h) and height > constants.net.max_checkpoint():
         if expect_trailing_data:
-            h['auxpow'], start_position = auxpow.deserialize_auxpow_header(h, s, expect_trailing_data=True, start_position=start_position+HEADER_SIZE)
+            h['auxpow'], start_position = auxpow.parse_auxpow_header(h, s, start_position=start_position+HEADER_SIZE)
+        elif len(s) - start_position == HEADER_SIZE:
+            h['auxpow'] = None
         else:
-            h['auxpow'] = auxpow.deserialize_auxpow_header(h, s, start_position=start_position+HEADER_SIZE)
+            h['auxpow'], end_position = auxpow.parse_auxpow_header(h, s, start_position=start_position+HEADER_SIZE)
+            if end_position != len(s):
+                raise Exception('Invalid header length: {}'.format(len(s) - start_position))
     else:
         if expect_trailing_data:
             start_position = start_position+HEADER_SIZE
@@ -97,15 +281,138 @@ def hash_header(header: dict) -> str:
         return '0' * 64
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
+    if isinstance(header, BlockHeader):
+        return header.hash()
     return hash_raw_header(serialize_header(header))
 
 
 def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
+def _hash_raw_header_bytes(header: bytes) -> bytes:
+    # all-zero headers are placeholders for ones we do not have
+    if header == bytes(HEADER_SIZE):
+        return bytes(HASH_SIZE)
+    return sha256d(header)
+
+def _hash_raw_headers_bytes(data: bytes) -> bytes:
+    return b''.join(_hash_raw_header_bytes(data[i:i+HEADER_SIZE])
+                    for i in range(0, len(data) - HEADER_SIZE + 1, HEADER_SIZE))
+
 def pow_hash_header(header):
+    # a single header is faster with the scalar hash than the batch kernel
+    if isinstance(header, BlockHeader):
+        return header.pow_hash()
     return hash_encode(getPoWHash(bfh(serialize_header(header))))
 
+def pow_hash_headers(headers: Sequence[dict]) -> List[str]:
+    powhashes = [header._powhash if isinstance(header, BlockHeader) else None for header in headers]
+    missing = [i for i, powhash in enumerate(powhashes) if powhash is None]
+    raw_headers = [headers[i].raw() if isinstance(headers[i], BlockHeader) else bfh(serialize_header(headers[i]))
+                   for i in missing]
+    for i, h in zip(missing, getPoWHashes(raw_headers)):
+        powhashes[i] = hash_encode(h)
+        if isinstance(headers[i], BlockHeader):
+            object.__setattr__(headers[i], '_powhash', powhashes[i])
+    return powhashes
+
+
+def check_headers(net, start_height: int, data: bytes) -> Tuple[bytes, List[dict], List[str], List[str]]:
+    """Stateless part of chunk verification: parses the headers in 'data',
+    computes their hashes and PoW hashes.
+    Returns the headers stripped of auxpow, as stored on disk, along with
+    the parsed headers, their hashes and their PoW hashes.
+    Nothing here depends on other headers, so this can run in a worker
+    process; 'net' is passed along as workers do not share our constants.
+    """
+    if constants.net is not net:
+        constants.net = net
+    stripped = bytearray()
+    headers = []
+    start_position = 0
+    while start_position < len(data):
+        stripped.extend(data[start_position:start_position+HEADER_SIZE])
+        header, start_position = deserialize_header(data, start_height + len(headers), expect_trailing_data=True, start_position=start_position)
+        # not needed further on, and expensive to send back from a worker
+        header.pop('auxpow', None)
+        headers.append(header)
+    hashes = [hash_header(header) for header in headers]
+    # hash all the headers at once; much faster with the vectorized fallback
+    powhashes = pow_hash_headers(headers)
+    return bytes(stripped), headers, hashes, powhashes
+
+
+def split_chunk(start_height: int, data: bytes, parts: int) -> List[Tuple[int, bytes]]:
+    """Splits 'data' into at most 'parts' runs of whole headers,
+    returned as (height of first header, data) pairs.
+    """
+    num_headers = len(data) // HEADER_SIZE
+    if start_height + num_headers <= max(auxpow.MIN_AUXPOW_HEIGHT, constants.net.max_checkpoint() + 1):
+        # no auxpow this low; every header is HEADER_SIZE bytes
+        positions = [i * HEADER_SIZE for i in range(num_headers)]
+    else:
+        positions = []
+        start_position = 0
+        while start_position < len(data):
+            positions.append(start_position)
+            _, start_position = deserialize_header(data, start_height + len(positions) - 1, expect_trailing_data=True, start_position=start_position)
+    step = max(1, -(-len(positions) // max(1, parts)))
+    runs = []
+    for i in range(0, len(positions), step):
+        end = positions[i + step] if i + step < len(positions) else len(data)
+        runs.append((start_height + i, data[positions[i]:end]))
+    return runs
+
+
+_verification_pool = None  # type: Optional[ProcessPoolExecutor]
+_verification_pool_size = 0
+_verification_pool_lock = threading.Lock()
+
+
+def get_verification_pool(config: 'SimpleConfig') -> Optional[ProcessPoolExecutor]:
+    """Returns the process pool used to verify chunks, or None if
+    chunks are to be verified in this process.
+    """
+    global _verification_pool, _verification_pool_size
+    size = config.get_header_verification_processes() if config else 0
+    with _verification_pool_lock:
+        if size != _verification_pool_size:
+            if _verification_pool is not None:
+                _verification_pool.shutdown(wait=False)
+            _verification_pool = ProcessPoolExecutor(max_workers=size) if size > 1 else None
+            _verification_pool_size = size
+        return _verification_pool
+
+
+def _discard_verification_pool(pool: ProcessPoolExecutor) -> None:
+    global _verification_pool, _verification_pool_size
+    with _verification_pool_lock:
+        if _verification_pool is pool:
+            _verification_pool = None
+            _verification_pool_size = 0
+    pool.shutdown(wait=False)
+
+
+def check_chunk(start_height: int, data: bytes, pool: Optional[ProcessPoolExecutor]=None):
+    """Runs check_headers over 'data', fanned out over 'pool' if given."""
+    if pool is None:
+        return check_headers(constants.net, start_height, data)
+    runs = split_chunk(start_height, data, pool._max_workers)
+    try:
+        results = list(pool.map(check_headers, [constants.net] * len(runs), *zip(*runs)))
+    except BrokenProcessPool:
+        util.print_error("[blockchain] verification pool broke; verifying in process")
+        _discard_verification_pool(pool)
+        return check_headers(constants.net, start_height, data)
+    stripped = bytearray()
+    headers, hashes, powhashes = [], [], []
+    for r in results:
+        stripped.extend(r[0])
+        headers.extend(r[1])
+        hashes.extend(r[2])
+        powhashes.extend(r[3])
+    return bytes(stripped), headers, hashes, powhashes
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -125,6 +432,7 @@ def read_blockchains(config: 'SimpleConfig'):
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             util.print_error("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
             os.unlink(best_chain.path())
+            best_chain.delete_hash_index()
             best_chain.update_size()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
@@ -136,6 +444,9 @@ def read_blockchains(config: 'SimpleConfig'):
     def delete_chain(filename, reason):
         util.print_error(f"[blockchain] deleting chain {filename}: {reason}")
         os.unlink(os.path.join(fdir, filename))
+        hashes_filename = os.path.join(util.get_headers_dir(config), 'fork_hashes', filename)
+        if os.path.exists(hashes_filename):
+            os.unlink(hashes_filename)
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -173,15 +484,274 @@ def read_blockchains(config: 'SimpleConfig'):
     for filename in l:
         instantiate_chain(filename)
 
+    load_chainwork_cache(config)
+
 
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
+# Indexes for routing incoming headers to chains without scanning every
+# chain. Entries are only hints; they are checked against the chain and
+# the blockchains dict before being used.
+# block hash -> (chain, height), for headers on the branch of a fork
+# (the main chain is looked up through its block hash index)
+_FORK_BLOCK_HASHES = {}  # type: Dict[str, Tuple[Blockchain, int]]
+# block hash at tip -> chains with that tip
+_CHAINS_BY_TIP_HASH = {}  # type: Dict[str, List[Blockchain]]
+_index_lock = threading.Lock()
+
+
+def _is_registered(chain: 'Blockchain') -> bool:
+    with blockchains_lock:
+        return blockchains.get(chain.get_id()) is chain
+
 # block hash -> chain work; up to and including that block
 _CHAINWORK_CACHE = {
     "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
 }  # type: Dict[str, int]
 
+# _CHAINWORK_CACHE entries of retarget boundaries are also appended to a
+# file, so that they need not be recomputed after a restart.
+# record: height (uint32 LE), block hash (raw), chain work (uint256 BE)
+_CHAINWORK_RECORD = struct.Struct('<I32s32s')
+_chainwork_lock = threading.Lock()
+
+
+def _chainwork_path(config: 'SimpleConfig') -> str:
+    return os.path.join(util.get_headers_dir(config), 'blockchain_chainwork')
+
+
+def _save_chainwork(config: 'SimpleConfig', entries: Sequence[Tuple[int, str, int]]) -> None:
+    data = b''.join(_CHAINWORK_RECORD.pack(height, bfh(block_hash), work.to_bytes(32, 'big'))
+                    for height, block_hash, work in entries)
+    with _chainwork_lock, open(_chainwork_path(config), 'ab') as f:
+        f.write(data)
+
+
+def load_chainwork_cache(config: 'SimpleConfig') -> None:
+    """Fills _CHAINWORK_CACHE from disk. Entries are keyed by block hash,
+    so a range rewritten by a reorg or a swap never matches stale ones;
+    entries for blocks no chain has anymore are dropped here."""
+    path = _chainwork_path(config)
+    if not os.path.exists(path):
+        return
+    with blockchains_lock: chains = list(blockchains.values())
+    with _chainwork_lock:
+        with open(path, 'rb') as f:
+            data = f.read()
+        kept = bytearray()
+        num_records = len(data) // _CHAINWORK_RECORD.size
+        for i in range(num_records):
+            record = data[i*_CHAINWORK_RECORD.size:(i+1)*_CHAINWORK_RECORD.size]
+            height, raw_hash, work = _CHAINWORK_RECORD.unpack(record)
+            block_hash = bh2u(raw_hash)
+            if not any(chain.check_hash(height, block_hash) for chain in chains):
+                continue
+            _CHAINWORK_CACHE[block_hash] = int.from_bytes(work, 'big')
+            kept += record
+        if len(kept) == len(data):
+            return
+        util.print_error(f"[blockchain] dropping {num_records - len(kept) // _CHAINWORK_RECORD.size} stale chainwork entries")
+        with open(path + '.tmp', 'wb') as f:
+            f.write(kept)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+
+def _copy_file_blocks(src, dst) -> None:
+    while True:
+        data = src.read(SWAP_BLOCK_SIZE)
+        if not data:
+            break
+        dst.write(data)
+
+
+def _swap_file_tail(path: str, offset: int, tail_path: str, replacement_path: str) -> None:
+    """Moves what 'path' holds from 'offset' on to a new file at
+    'tail_path', and puts the contents of 'replacement_path' there
+    instead, deleting it. Data is streamed in SWAP_BLOCK_SIZE blocks.
+    The tail is in place under its new name before 'path' is cut, so
+    a crash leaves at worst a duplicate of it."""
+    tmp_path = tail_path + '.tmp'
+    with open(path, 'rb+') as f:
+        f.seek(offset)
+        with open(tmp_path, 'wb') as tail:
+            _copy_file_blocks(f, tail)
+            tail.flush()
+            os.fsync(tail.fileno())
+        os.replace(tmp_path, tail_path)
+        f.seek(offset)
+        f.truncate()
+        with open(replacement_path, 'rb') as replacement:
+            _copy_file_blocks(replacement, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.unlink(replacement_path)
+
+
+_swap_lock_stats = {'swaps': 0, 'total': 0.0, 'max': 0.0}
+
+
+def _record_swap_lock_time(seconds: float) -> None:
+    with blockchains_lock:
+        _swap_lock_stats['swaps'] += 1
+        _swap_lock_stats['total'] += seconds
+        _swap_lock_stats['max'] = max(_swap_lock_stats['max'], seconds)
+
+
+def get_swap_lock_stats() -> dict:
+    """How long swap_with_parent held blockchains_lock, in seconds."""
+    with blockchains_lock:
+        return dict(_swap_lock_stats)
+
+
+class KimotoGravityWellCalculator:
+    """
+    Computes Kimoto Gravity Well targets for a chain, keeping the
+    timestamps and targets of the last PastBlocksMax headers in a window
+    that slides forward one block at a time.
+
+    The results are identical to Blockchain.KimotoGravityWell: the float
+    running average depends on the order in which the window is walked,
+    so it is recomputed for every height, but the headers are only read
+    and decoded once, and the event horizon is precomputed.
+    """
+
+    BlocksTargetSpacing = 0.5 * 60  # 30 seconds
+    TimeDaySeconds = 60 * 60 * 24
+    PastSecondsMin = TimeDaySeconds * 0.01
+    PastSecondsMax = TimeDaySeconds * 0.14
+    PastBlocksMin = PastSecondsMin / BlocksTargetSpacing
+    PastBlocksMax = PastSecondsMax / BlocksTargetSpacing
+    bnProofOfWorkLimit = 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+
+    # EventHorizonDeviation for each PastBlocksMass
+    EventHorizonDeviations = [None] + [
+        1 + ((0.7084) * pow((float(i)/float(144)), float(-1.228)))
+        for i in range(1, int(PastBlocksMax)+1)]
+
+    def __init__(self, chain: 'Blockchain'):
+        self.chain = chain
+        # (block hash, prev hash, timestamp, bits, target) of consecutive heights,
+        # the newest one last; None for headers we do not have
+        self._window = deque(maxlen=int(self.PastBlocksMax))
+        self._window_end = None  # type: Optional[int]  # height of newest header in window
+        self._result = None  # type: Optional[Tuple[int, int]]  # target for _window_end + 1
+
+    def _read_entry(self, height: int) -> Optional[tuple]:
+        entry = self.chain._read_header_and_hash(height)
+        if entry is None:
+            return None
+        header, header_hash = entry
+        bits = header.get('bits')
+        try:
+            target = self.chain.convbignum(bits)
+        except BaseException:
+            # only raise if the loop actually gets to this header
+            target = None
+        return header_hash, header.get('prev_block_hash'), header.get('timestamp'), bits, target
+
+    def _slide_to(self, last_height: int) -> None:
+        """Makes the window end at last_height."""
+        window = self._window
+        tail = window[-1] if window else None
+        if self._window_end is not None and tail is not None and None not in window \
+                and self._window_end <= last_height < self._window_end + window.maxlen:
+            new_entries = [self._read_entry(height)
+                           for height in range(self._window_end + 1, last_height + 1)]
+            if not new_entries:
+                last = self._read_entry(last_height)
+                if last is not None and last[0] == tail[0]:
+                    return
+            elif None not in new_entries and new_entries[0][1] == tail[0]:
+                # the new headers build on top of the window
+                window.extend(new_entries)
+                self._window_end = last_height
+                self._result = None
+                return
+        # not a continuation of the window; read it from scratch
+        self._result = None
+        window.clear()
+        first_height = max(0, last_height - window.maxlen + 1)
+        for height in range(first_height, last_height + 1):
+            window.append(self._read_entry(height))
+        self._window_end = last_height
+
+    def reset(self, from_height: int) -> None:
+        """Drops the window if headers from from_height on were rewritten."""
+        if self._window_end is not None and from_height <= self._window_end:
+            self._window.clear()
+            self._window_end = None
+            self._result = None
+
+    def get_target(self, height: int) -> Tuple[int, int]:
+        BlockLastSolvedIndex = height - 1
+        if (BlockLastSolvedIndex <= 0 or BlockLastSolvedIndex < self.PastSecondsMin):
+            new_target = self.bnProofOfWorkLimit
+            new_bits = self.chain.convbits(new_target)
+            return new_bits, new_target
+
+        self._slide_to(BlockLastSolvedIndex)
+        if self._result is None:
+            self._result = self._compute(height)
+        return self._result
+
+    def _compute(self, height: int) -> Tuple[int, int]:
+        window = self._window
+        PastBlocksMin = self.PastBlocksMin
+        PastBlocksMax = int(self.PastBlocksMax)
+        TargetBlocksSpacingSeconds = self.BlocksTargetSpacing
+        EventHorizonDeviations = self.EventHorizonDeviations
+        BlockReadingIndex = height - 1
+        last = window[-1]
+
+        for i in range(1, PastBlocksMax+1):
+            PastBlocksMass = i
+            reading = window[-i] if i <= len(window) else None
+
+            if (reading is None or last is None):
+                raise BaseException("Could not find previous blocks when calculating difficulty reading: " + str(BlockReadingIndex) + ", last: " + str(height - 1) + ", height: " + str(height))
+
+            reading_target = reading[4]
+            if reading_target is None:
+                reading_target = self.chain.convbignum(reading[3])
+            if (i == 1):
+                PastDifficultyAverage = reading_target
+            else:
+                PastDifficultyAverage = float(((reading_target)- PastDifficultyAveragePrev) / float(i)) + PastDifficultyAveragePrev
+
+            PastDifficultyAveragePrev = PastDifficultyAverage
+            PastRateActualSeconds = last[2] - reading[2]
+            PastRateTargetSeconds = TargetBlocksSpacingSeconds * PastBlocksMass
+            PastRateAdjustmentRatio = float(1.0)
+            if (PastRateActualSeconds < 0):
+                PastRateActualSeconds = 0.0
+
+            if (PastRateActualSeconds != 0 and PastRateTargetSeconds != 0):
+                PastRateAdjustmentRatio = float(PastRateTargetSeconds) / float(PastRateActualSeconds)
+
+            if (PastBlocksMass >= PastBlocksMin):
+                EventHorizonDeviationFast = EventHorizonDeviations[PastBlocksMass]
+                EventHorizonDeviationSlow = float(1) / float(EventHorizonDeviationFast)
+                if ((PastRateAdjustmentRatio <= EventHorizonDeviationSlow) or (PastRateAdjustmentRatio >= EventHorizonDeviationFast)):
+                    break
+                if (BlockReadingIndex < 1):
+                    break
+
+            BlockReadingIndex = BlockReadingIndex - 1
+
+        bnNew = PastDifficultyAverage
+        if (PastRateActualSeconds != 0 and PastRateTargetSeconds != 0):
+            bnNew *= float(PastRateActualSeconds)
+            bnNew /= float(PastRateTargetSeconds)
+        if (bnNew > self.bnProofOfWorkLimit):
+            bnNew = self.bnProofOfWorkLimit
+
+        new_target = bnNew
+        new_bits = self.chain.convbits(new_target)
+        return new_bits, new_target
+
 
 class Blockchain(util.PrintError):
     """
@@ -201,7 +771,21 @@ class Blockchain(util.PrintError):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._hashes_mmap = None  # type: Optional[mmap.mmap]
+        self._hash_index_checked = False
+        # (chain id, height) -> (header, header hash); least recently used first
+        self._header_cache = OrderedDict()  # type: OrderedDict[Tuple[str, int], Tuple[dict, str]]
+        self.header_cache_hits = 0
+        self.header_cache_misses = 0
+        self._kgw_calculator = KimotoGravityWellCalculator(self)
+        self._branch_hashes = {}  # type: Dict[int, str]  # height -> hash, for _FORK_BLOCK_HASHES
+        self._indexed_tip_hash = None  # type: Optional[str]
+        self._unsynced = False  # written headers that are not fsynced yet
+        self._sync_timer = None  # type: Optional[threading.Timer]
+        self._drop_torn_headers()
         self.update_size()
+        self._reindex_branch()
 
     def with_lock(func):
         def func_wrapper(self, *args, **kwargs):
@@ -277,11 +861,199 @@ class Blockchain(util.PrintError):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        # the file might have changed; it gets remapped on next read
+        self._close_mmap()
+        self._update_tip_index()
+
+    @with_lock
+    def _update_tip_index(self) -> None:
+        try:
+            tip_hash = self.get_hash(self.height())
+        except Exception:
+            tip_hash = None
+        with _index_lock:
+            if tip_hash == self._indexed_tip_hash:
+                return
+            chains = _CHAINS_BY_TIP_HASH.get(self._indexed_tip_hash, [])
+            if self in chains:
+                chains.remove(self)
+                if not chains:
+                    del _CHAINS_BY_TIP_HASH[self._indexed_tip_hash]
+            if tip_hash is not None:
+                _CHAINS_BY_TIP_HASH.setdefault(tip_hash, []).append(self)
+            self._indexed_tip_hash = tip_hash
+
+    @with_lock
+    def _update_branch_index(self, hashes: bytes, first_height: int, old_height: int, truncate: bool) -> None:
+        """Updates _FORK_BLOCK_HASHES after write() stored headers
+        with the given hashes from first_height on."""
+        if self.parent is None:
+            return
+        count = len(hashes) // HASH_SIZE
+        end_height = old_height + 1 if truncate else min(old_height + 1, first_height + count)
+        with _index_lock:
+            for height in range(first_height, end_height):
+                self._unindex_block(height)
+            for i in range(count):
+                h = hashes[i * HASH_SIZE:(i + 1) * HASH_SIZE]
+                if h != bytes(HASH_SIZE):
+                    self._index_block(first_height + i, hash_encode(h))
+
+    @with_lock
+    def _reindex_branch(self) -> None:
+        """Re-registers the headers of this chain's own branch in
+        _FORK_BLOCK_HASHES, e.g. after they changed in a swap."""
+        hashes = b''
+        if self.parent is not None and self._size > 0:
+            hashes = self._get_hashes_mmap()[:self._size * HASH_SIZE]
+        with _index_lock:
+            for height in list(self._branch_hashes):
+                self._unindex_block(height)
+            for i in range(len(hashes) // HASH_SIZE):
+                h = hashes[i * HASH_SIZE:(i + 1) * HASH_SIZE]
+                if h != bytes(HASH_SIZE):
+                    self._index_block(self.forkpoint + i, hash_encode(h))
+
+    def _index_block(self, height: int, block_hash: str) -> None:
+        self._branch_hashes[height] = block_hash
+        _FORK_BLOCK_HASHES[block_hash] = (self, height)
+
+    def _unindex_block(self, height: int) -> None:
+        block_hash = self._branch_hashes.pop(height, None)
+        if block_hash is not None and _FORK_BLOCK_HASHES.get(block_hash, (None,))[0] is self:
+            del _FORK_BLOCK_HASHES[block_hash]
+
+    @with_lock
+    def _get_mmap(self) -> Optional[mmap.mmap]:
+        if self._mmap is None and self._size > 0:
+            filename = self.path()
+            self.assert_headers_file_available(filename)
+            with open(filename, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @with_lock
+    def _close_mmap(self) -> None:
+        for m in (self._mmap, self._hashes_mmap):
+            if m is None:
+                continue
+            try:
+                m.close()
+            except BufferError:
+                # a slice is still referenced somewhere; the mapping
+                # will be released when that is garbage collected
+                pass
+        self._mmap = None
+        self._hashes_mmap = None
+
+    @with_lock
+    def hashes_path(self):
+        """Path of the block hash index: HASH_SIZE bytes per header
+        in the headers file, all zeroes where the hash is not known."""
+        d = util.get_headers_dir(self.config)
+        if self.parent is None:
+            return os.path.join(d, 'blockchain_hashes')
+        return os.path.join(d, 'fork_hashes', os.path.basename(self.path()))
+
+    @with_lock
+    def delete_hash_index(self) -> None:
+        self._close_mmap()
+        self._hash_index_checked = False
+        if os.path.exists(self.hashes_path()):
+            os.unlink(self.hashes_path())
+
+    @with_lock
+    def _check_hash_index(self) -> None:
+        """Rebuilds the block hash index if it is missing or does not
+        match the headers file."""
+        if self._hash_index_checked:
+            return
+        filename = self.hashes_path()
+        consistent = os.path.exists(filename) and os.path.getsize(filename) == self._size * HASH_SIZE
+        if consistent and self._size > 0:
+            with open(self.path(), 'rb') as f:
+                f.seek((self._size - 1) * HEADER_SIZE)
+                tip = f.read(HEADER_SIZE)
+            with open(filename, 'rb') as f:
+                f.seek((self._size - 1) * HASH_SIZE)
+                tip_hash = f.read(HASH_SIZE)
+            consistent = tip_hash in (bytes(HASH_SIZE), _hash_raw_header_bytes(tip))
+        if not consistent:
+            self._rebuild_hash_index()
+        self._hash_index_checked = True
+
+    @with_lock
+    def _rebuild_hash_index(self) -> None:
+        self.print_error("rebuilding block hash index", self.hashes_path())
+        filename = self.hashes_path()
+        util.make_dir(os.path.dirname(filename))
+        self._close_mmap()
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as out:
+            if os.path.exists(self.path()):
+                with open(self.path(), 'rb') as f:
+                    for i in range(0, self._size, 2016):
+                        data = f.read(min(2016, self._size - i) * HEADER_SIZE)
+                        out.write(_hash_raw_headers_bytes(data))
+        os.replace(tmp_filename, filename)
+
+    @with_lock
+    def _get_hashes_mmap(self) -> Optional[mmap.mmap]:
+        self._check_hash_index()
+        if self._hashes_mmap is None and self._size > 0:
+            with open(self.hashes_path(), 'rb') as f:
+                self._hashes_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._hashes_mmap
+
+    @with_lock
+    def _read_indexed_hash(self, height: int) -> Optional[str]:
+        """Returns the hash at height from the block hash index,
+        or None if it is not there."""
+        if height < self.forkpoint:
+            return self.parent._read_indexed_hash(height)
+        if height > self.height():
+            return
+        delta = height - self.forkpoint
+        h = self._get_hashes_mmap()[delta * HASH_SIZE:(delta + 1) * HASH_SIZE]
+        if len(h) < HASH_SIZE or h == bytes(HASH_SIZE):
+            return
+        return hash_encode(h)
+
+    @with_lock
+    def _write_hash_index(self, hashes: bytes, offset: int, truncate: bool, after_headers: bool,
+                          sync: bool=False) -> None:
+        """Keeps the block hash index in sync with write(). Called
+        before writing the headers, to forget hashes that are about to
+        change, and after, to store the new ones."""
+        index_offset = offset // HEADER_SIZE * HASH_SIZE
+        with open(self.hashes_path(), 'rb+') as f:
+            if after_headers:
+                f.seek(index_offset)
+                f.write(hashes)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+                return
+            f.seek(0, os.SEEK_END)
+            index_size = f.tell()
+            if index_offset >= index_size:
+                # appending; nothing to forget
+                return
+            if truncate:
+                f.truncate(index_offset)
+            else:
+                f.seek(index_offset)
+                f.write(bytes(min(len(hashes), index_size - index_offset)))
+            # the headers file is fsynced next; make sure the index
+            # never claims the old hashes for the new headers
+            f.flush()
+            os.fsync(f.fileno())
 
     @classmethod
-    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
+    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None,
+                      powhash: str=None) -> None:
         _hash = hash_header(header)
-        _powhash = pow_hash_header(header)
+        _powhash = powhash if powhash is not None else pow_hash_header(header)
         # Don't verify AuxPoW when covered by a checkpoint
 #       if header.get('block_height') > constants.net.max_checkpoint():
 #            _pow_hash = auxpow.hash_parent_header(header)
@@ -304,30 +1076,25 @@ class Blockchain(util.PrintError):
         #   print(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
         #   raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
-    def verify_chunk(self, index: int, data: bytes) -> bytes:
-        stripped = bytearray()
-        start_position = 0
+    def verify_chunk(self, index: int, data: bytes, checked=None) -> bytes:
         start_height = index * 2016
         prev_hash = self.get_hash(start_height - 1)
         target = self.get_target(index-1)
-        i = 0
-        while start_position < len(data):
+        # parsing, auxpow and PoW hashing do not depend on our headers and may
+        # run in other processes; the linkage is then checked here, in order
+        if checked is None:
+            checked = check_chunk(start_height, data, get_verification_pool(self.config))
+        stripped, headers, hashes, powhashes = checked
+        for i, header in enumerate(headers):
             height = start_height + i
             try:
                 expected_header_hash = self.get_hash(height)
             except MissingHeader:
                 expected_header_hash = None
+            self.verify_header(header, prev_hash, target, expected_header_hash, powhashes[i])
+            prev_hash = hashes[i]
 
-            # Strip auxpow header for disk
-            stripped.extend(data[start_position:start_position+HEADER_SIZE])
-
-            header, start_position = deserialize_header(data, index*2016 + i, expect_trailing_data=True, start_position=start_position)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
-
-            i = i + 1
-
-        return bytes(stripped)
+        return stripped
 
     @with_lock
     def path(self):
@@ -360,18 +1127,22 @@ class Blockchain(util.PrintError):
             chunk = chunk[-delta_bytes:]
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
-        self.write(chunk, delta_bytes, truncate)
+        self.write(chunk, delta_bytes, truncate, sync=True)
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
         parent_lock = self.parent.lock if self.parent is not None else threading.Lock()
         with parent_lock, self.lock, blockchains_lock:  # this order should not deadlock
+            t0 = time.monotonic()
             # do the swap; possibly multiple ones
             cnt = 0
             while self._swap_with_parent():
                 cnt += 1
                 if cnt > len(blockchains):  # make sure we are making progress
                     raise Exception(f'swapping fork with parent too many times: {cnt}')
+            if cnt:
+                _record_swap_lock_time(time.monotonic() - t0)
+                self.print_error(f"swapped {cnt} times; locks held for {1000 * (time.monotonic() - t0):.1f} ms")
 
     def _swap_with_parent(self) -> bool:
         """Check if this chain became stronger than its parent, and swap
@@ -383,33 +1154,44 @@ class Blockchain(util.PrintError):
         if self.parent.get_chainwork() >= self.get_chainwork():
             return False
         self.print_error("swap", self.forkpoint, self.parent.forkpoint)
-        parent_branch_size = self.parent.height() - self.forkpoint + 1
+        self.sync()
+        self.parent.sync()
         forkpoint = self.forkpoint  # type: Optional[int]
         parent = self.parent  # type: Optional[Blockchain]
         child_old_id = self.get_id()
         parent_old_id = parent.get_id()
-        # swap files
-        # child takes parent's name
-        # parent's new name will be something new (not child's old name)
         self.assert_headers_file_available(self.path())
-        child_old_name = self.path()
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
         self.assert_headers_file_available(parent.path())
-        with open(parent.path(), 'rb') as f:
-            f.seek((forkpoint - parent.forkpoint)*HEADER_SIZE)
-            parent_data = f.read(parent_branch_size*HEADER_SIZE)
-        self.write(parent_data, 0)
-        parent.write(my_data, (forkpoint - parent.forkpoint)*HEADER_SIZE)
+        # the index files are moved along with the headers
+        self._check_hash_index()
+        parent._check_hash_index()
+        child_old_name, child_old_hashes_name = self.path(), self.hashes_path()
+        parent_old_name, parent_old_hashes_name = parent.path(), parent.hashes_path()
+        delta = forkpoint - parent.forkpoint
+        with open(parent_old_name, 'rb') as f:
+            f.seek(delta * HEADER_SIZE)
+            parent_branch_first_hash = hash_raw_header(bh2u(f.read(HEADER_SIZE)))
+        self._close_mmap()
+        parent._close_mmap()
         # swap parameters
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
-        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
+        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, parent_branch_first_hash
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
-        # parent's new name
-        os.replace(child_old_name, parent.path())
+        # we take over the parent's file: its branch moves to a file of its
+        # own under the parent's new name, and our headers take its place
+        _swap_file_tail(parent_old_name, delta * HEADER_SIZE, parent.path(), child_old_name)
+        _swap_file_tail(parent_old_hashes_name, delta * HASH_SIZE, parent.hashes_path(), child_old_hashes_name)
+        self._unsynced = parent._unsynced = False
+        # both chains now contain different headers under different ids
+        self._header_cache.clear()
+        parent._header_cache.clear()
         self.update_size()
         parent.update_size()
+        self._hash_index_checked = True
+        parent._hash_index_checked = True
+        self._reindex_branch()
+        parent._reindex_branch()
         # update pointers
         blockchains.pop(child_old_id, None)
         blockchains.pop(parent_old_id, None)
@@ -428,10 +1210,96 @@ class Blockchain(util.PrintError):
         else:
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
+    def get_fsync_delay(self) -> float:
+        return self.config.get('header_fsync_delay', HEADER_FSYNC_DELAY)
+
+    @with_lock
+    def sync(self) -> None:
+        """fsyncs headers written since the last sync."""
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        if not self._unsynced:
+            return
+        for filename in (self.path(), self.hashes_path()):
+            try:
+                # opened for writing, as Windows cannot flush read-only handles
+                with open(filename, 'rb+') as f:
+                    os.fsync(f.fileno())
+            except FileNotFoundError:
+                # deleted, e.g. by read_blockchains; nothing left to sync
+                pass
+        self._unsynced = False
+
+    @with_lock
+    def _schedule_sync(self) -> None:
+        delay = self.get_fsync_delay()
+        if delay <= 0:
+            self.sync()
+        elif self._sync_timer is None:
+            self._sync_timer = threading.Timer(delay, self.sync)
+            self._sync_timer.daemon = True
+            self._sync_timer.start()
+
     @with_lock
-    def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
+    def _drop_torn_headers(self) -> None:
+        """A crash before appended headers were fsynced can leave the file
+        with a partial header at its end, or with headers that were not
+        fully written. Cut the file back to the last header that links,
+        and the block hash index back to the headers that are left."""
+        filename = self.path()
+        if not os.path.exists(filename):
+            return
+        file_size = os.path.getsize(filename)
+        size = file_size // HEADER_SIZE
+        # no fork below the checkpoints, and their region may have gaps
+        first_height = max(self.forkpoint + 1, constants.net.max_checkpoint() + 1)
+        num_checked = min(size, self.forkpoint + size - first_height + 1, 2016)
+        good_size = size
+        if num_checked > 1:
+            with open(filename, 'rb') as f:
+                f.seek((size - num_checked) * HEADER_SIZE)
+                data = f.read(num_checked * HEADER_SIZE)
+            hashes = _hash_raw_headers_bytes(data)
+            i = num_checked - 1
+            while i > 0 and (data[i*HEADER_SIZE:(i+1)*HEADER_SIZE] == bytes(HEADER_SIZE)
+                             or data[i*HEADER_SIZE+4:i*HEADER_SIZE+36] != hashes[(i-1)*HASH_SIZE:i*HASH_SIZE]):
+                good_size -= 1
+                i -= 1
+        # the index may have outlived headers lost in the crash; cutting
+        # it is cheaper than the rebuild _check_hash_index would do
+        hashes_filename = self.hashes_path()
+        if os.path.exists(hashes_filename) and os.path.getsize(hashes_filename) > good_size * HASH_SIZE:
+            with open(hashes_filename, 'rb+') as f:
+                f.truncate(good_size * HASH_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+        if good_size * HEADER_SIZE == file_size:
+            return
+        self.print_error(f'dropping {file_size - good_size * HEADER_SIZE} bytes of torn headers from {filename}')
+        with open(filename, 'rb+') as f:
+            f.truncate(good_size * HEADER_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @with_lock
+    def write(self, data: bytes, offset: int, truncate: bool=True, sync: bool=False) -> None:
+        """Writes headers at 'offset'. Appended headers are fsynced in
+        groups, at most get_fsync_delay() seconds later, unless 'sync'.
+        Anything else is fsynced right away."""
         filename = self.path()
         self.assert_headers_file_available(filename)
+        # don't keep the file mapped while it is being truncated
+        self._close_mmap()
+        first_height = self.forkpoint + offset // HEADER_SIZE
+        if first_height <= self.height():
+            self._invalidate_header_cache(first_height)
+        self._check_hash_index()
+        self._hash_index_checked = False
+        old_height = self.height()
+        hashes = _hash_raw_headers_bytes(data)
+        self._write_hash_index(hashes, offset, truncate, after_headers=False)
+        sync = sync or offset != self._size * HEADER_SIZE
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -439,7 +1307,19 @@ class Blockchain(util.PrintError):
             f.seek(offset)
             f.write(data)
             f.flush()
-            os.fsync(f.fileno())
+            if sync:
+                os.fsync(f.fileno())
+        if sync:
+            self._unsynced = False
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+        else:
+            self._unsynced = True
+            self._schedule_sync()
+        self._write_hash_index(hashes, offset, truncate, after_headers=True, sync=sync)
+        self._hash_index_checked = True
+        self._update_branch_index(hashes, first_height, old_height, truncate)
         self.update_size()
 
     @with_lock
@@ -449,30 +1329,83 @@ class Blockchain(util.PrintError):
         # headers are only _appended_ to the end:
         assert delta == self.size(), (delta, self.size())
         assert len(data) == HEADER_SIZE
-        self.write(data, delta*HEADER_SIZE)
+        # fsync on chunk boundaries; in between, group commit
+        self.write(data, delta*HEADER_SIZE, sync=(header.get('block_height') + 1) % 2016 == 0)
         self.swap_with_parent()
 
     @with_lock
-    def read_header(self, height: int) -> Optional[dict]:
+    def _invalidate_header_cache(self, from_height: int) -> None:
+        for key in [key for key in self._header_cache if key[1] >= from_height]:
+            del self._header_cache[key]
+        self._kgw_calculator.reset(from_height)
+
+    def get_header_cache_stats(self) -> dict:
+        return {
+            'size': len(self._header_cache),
+            'hits': self.header_cache_hits,
+            'misses': self.header_cache_misses,
+        }
+
+    @with_lock
+    def _read_header_and_hash(self, height: int) -> Optional[Tuple[dict, str]]:
         if height < 0:
             return
         if height < self.forkpoint:
-            return self.parent.read_header(height)
+            return self.parent._read_header_and_hash(height)
         if height > self.height():
             return
+        key = (self.get_id(), height)
+        entry = self._header_cache.get(key)
+        if entry is not None:
+            self._header_cache.move_to_end(key)
+            self.header_cache_hits += 1
+            return entry
+        self.header_cache_misses += 1
+        header = self._read_header_from_file(height)
+        if header is None:
+            return
+        entry = header, hash_header(header)
+        self._header_cache[key] = entry
+        if len(self._header_cache) > HEADER_CACHE_SIZE:
+            self._header_cache.popitem(last=False)
+        return entry
+
+    def read_header(self, height: int) -> Optional[BlockHeader]:
+        entry = self._read_header_and_hash(height)
+        if entry is None:
+            return
+        # callers might modify the header; don't hand out the cached one
+        return entry[0].copy()
+
+    @with_lock
+    def has_chunk(self, index: int) -> bool:
+        """Whether every header of chunk 'index' is on disk. Chunks in the
+        checkpoint region are saved when needed, so any of them may be
+        missing while the headers after them are there."""
+        start_height = index * 2016
+        if start_height < self.forkpoint:
+            return self.parent.has_chunk(index)
+        if start_height + 2015 > self.height():
+            return False
+        delta = start_height - self.forkpoint
+        data = self._get_mmap()[delta * HEADER_SIZE:(delta + 2016) * HEADER_SIZE]
+        empty = bytes(HEADER_SIZE)
+        return all(data[i:i + HEADER_SIZE] != empty for i in range(0, len(data), HEADER_SIZE))
+
+    def _read_header_from_file(self, height: int) -> Optional[BlockHeader]:
         delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
+        # zero-copy view into the mapped headers file
+        h = memoryview(self._get_mmap())[delta * HEADER_SIZE:(delta + 1) * HEADER_SIZE]
+        try:
             if len(h) < HEADER_SIZE:
                 raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
-            return None
-        return deserialize_header(h, height)
+            if h == bytes([0])*HEADER_SIZE:
+                return None
+            return deserialize_header(h, height)
+        finally:
+            h.release()
 
-    def header_at_tip(self) -> Optional[dict]:
+    def header_at_tip(self) -> Optional[BlockHeader]:
         """Return latest header."""
         height = self.height()
         return self.read_header(height)
@@ -492,10 +1425,13 @@ class Blockchain(util.PrintError):
             h, t = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
+            header_hash = self._read_indexed_hash(height)
+            if header_hash is not None:
+                return header_hash
+            entry = self._read_header_and_hash(height)
+            if entry is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return entry[1]
 
     def get_timestamp(self, height):
         if height < len(self.checkpoints) * 2016 and (height+1) % 2016 == 0:
@@ -510,16 +1446,15 @@ class Blockchain(util.PrintError):
         if height <= 28:
             return 0x1e0ffff0, 0x00000FFFF0000000000000000000000000000000000000000000000000000000
         index = height // 2016
-        print("index %d" % index + " height %d" % height)
         if index < len(self.checkpoints) and (height % 2016 == 0):
-            print("Bailing early index < len(self.checkpoints)")
             _, t, b, _ = self.checkpoints[index]
             return b, t
         if height < 4800000:
-            print("returning kgw")
-            return self.KimotoGravityWell(height, chain)
+            if chain:
+                return self.KimotoGravityWell(height, chain)
+            with self.lock:
+                return self._kgw_calculator.get_target(height)
         else:
-            print("returning digishield")
             return self.get_digishield_target(height, chain)
 
     def convbits(self, new_target):
@@ -611,7 +1546,7 @@ class Blockchain(util.PrintError):
     def chainwork_of_header_at_height(self, height: int) -> int:
         """work done by single header at given height"""
         chunk_idx = height // 2016 - 1
-        target = self.get_target(chunk_idx)
+        _, target = self.get_target(chunk_idx)
         work = ((2 ** 256 - target - 1) // (target + 1)) + 1
         return work
 
@@ -631,12 +1566,16 @@ class Blockchain(util.PrintError):
             cached_height -= 2016
         assert cached_height >= -1, cached_height
         running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
+        new_entries = []
         while cached_height < last_retarget:
             cached_height += 2016
             work_in_single_header = self.chainwork_of_header_at_height(cached_height)
             work_in_chunk = 2016 * work_in_single_header
             running_total += work_in_chunk
             _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
+            new_entries.append((cached_height, self.get_hash(cached_height), running_total))
+        if new_entries:
+            _save_chainwork(self.config, new_entries)
         cached_height += 2016
         work_in_single_header = self.chainwork_of_header_at_height(cached_height)
         work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
@@ -671,12 +1610,23 @@ class Blockchain(util.PrintError):
             return False
         return True
 
-    def connect_chunk(self, idx: int, hexdata: str) -> bool:
+    def precheck_chunk(self, idx: int, hexdata: str):
+        """The stateless part of connect_chunk, which may run in another
+        thread. Returns what connect_chunk takes as 'checked', or None if
+        the chunk is invalid.
+        """
+        try:
+            return check_chunk(idx * 2016, bfh(hexdata), get_verification_pool(self.config))
+        except BaseException as e:
+            self.print_error(f'precheck_chunk idx {idx} failed: {repr(e)}')
+            return None
+
+    def connect_chunk(self, idx: int, hexdata: str, checked=None) -> bool:
         assert idx >= 0, idx
         try:
             data = bfh(hexdata)
             # verify_chunk also strips the AuxPoW headers
-            data = self.verify_chunk(idx, data)
+            data = self.verify_chunk(idx, data, checked)
             #self.print_error("validated chunk %d" % idx)
             self.save_chunk(idx, data)
             return True
@@ -684,23 +1634,41 @@ class Blockchain(util.PrintError):
             self.print_error(f'verify_chunk idx {idx} failed: {repr(e)}')
             return False
 
-    def get_checkpoints(self):
-        # for each chunk, store the hash of the last block and the target after the chunk
+    def get_checkpoints(self, include_unexpired_names: bool = False):
+        """For each chunk, the hash of its last block and the target at
+        that block. The hashes come from a single pass over the headers
+        file, front to back; each target reads only the KGW window, the
+        last PastBlocksMax headers of the chunk.
+        """
+        # SmartCryptoTech: by default, don't generate checkpoints for unexpired
+        # names, because otherwise we'll need to fetch chunks on demand during
+        # name lookups, which will add some latency.
+        if include_unexpired_names:
+            n = self.height() // 2016
+        else:
+            n = (self.height() - 36000) // 2016
         cp = []
-
-        # SmartCryptoTech: don't generate checkpoints for unexpired names, because
-        # otherwise we'll need to fetch chunks on demand during name lookups,
-        # which will add some latency.  TODO: Allow user-configurable pre-
-        # fetching of checkpointed unexpired chunks.
-        #n = self.height() // 2016
-        n = (self.height() - 36000) // 2016
-
-        for index in range(n):
-            h = self.get_hash((index+1) * 2016 -1)
-            target = self.get_target(index)
-            cp.append((h, target))
+        for index, h in enumerate(self._iter_chunk_hashes(n)):
+            cp.append((h, self.get_target((index + 1) * 2016 - 1)))
         return cp
 
+    def _iter_chunk_hashes(self, num_chunks: int):
+        """Yields the hash of the last header of each of the first
+        num_chunks chunks. Headers stored in this chain's file are read
+        and hashed in file order; the rest come from get_hash."""
+        with open(self.path(), 'rb') as f:
+            for index in range(num_chunks):
+                height = (index + 1) * 2016 - 1
+                if height < self.forkpoint or height <= constants.net.max_checkpoint():
+                    yield self.get_hash(height)
+                    continue
+                f.seek((height - self.forkpoint) * HEADER_SIZE)
+                raw = f.read(HEADER_SIZE)
+                if len(raw) < HEADER_SIZE or raw == bytes(HEADER_SIZE):
+                    yield self.get_hash(height)
+                    continue
+                yield hash_encode(sha256d(raw))
+
     def get_digishield_target(self, height, chain={}):
         if chain is None:
             chain = {}
@@ -848,18 +1816,26 @@ class Blockchain(util.PrintError):
         return new_bits, new_target
 
 def check_header(header: dict) -> Optional[Blockchain]:
-    if type(header) is not dict:
+    if type(header) not in (dict, BlockHeader):
         return None
-    with blockchains_lock: chains = list(blockchains.values())
+    header_hash = hash_header(header)
+    height = header.get('block_height')
+    with _index_lock:
+        entry = _FORK_BLOCK_HASHES.get(header_hash)
+    with blockchains_lock:
+        chains = [blockchains.get(constants.net.GENESIS)]
+    if entry is not None and entry[1] == height:
+        chains.insert(0, entry[0])
     for b in chains:
-        if b.check_header(header):
+        if b is not None and _is_registered(b) and b.check_hash(height, header_hash):
             return b
     return None
 
 
 def can_connect(header: dict) -> Optional[Blockchain]:
-    with blockchains_lock: chains = list(blockchains.values())
+    with _index_lock:
+        chains = list(_CHAINS_BY_TIP_HASH.get(header.get('prev_block_hash'), []))
     for b in chains:
-        if b.can_connect(header):
+        if _is_registered(b) and b.can_connect(header):
             return b
     return None
@@ -23,6 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import sys
 import datetime
 import copy
@@ -445,6 +446,34 @@ class Commands:
         """Return the list of available servers"""
         return self.network.get_servers()
 
+    @command('n')
+    def getserverstats(self):
+        """Return the round-trip time, error rate and throughput measured
+        for each server, as used to choose which servers to connect to.
+        Times are in seconds."""
+        return self.network.get_server_stats()
+
+    @command('n')
+    def getnetworkmetrics(self):
+        """Return per-method counts, latency histograms, timeouts, payload
+        sizes and in-flight counts of the requests sent to servers since
+        the network started, how many calls were saved by sharing
+        identical requests in flight, and the size and hit rate of the
+        shared transaction store. Times are in seconds, sizes in bytes."""
+        return self.network.get_network_metrics()
+
+    @command('n')
+    def exportcheckpoints(self, path, unexpired_names=False):
+        """Write checkpoints for the local blockchain to a JSON file, in the
+        format of checkpoints.json. Chunks where names may still be
+        unexpired are left out unless --unexpired_names is given, since
+        name lookups would then need to fetch those chunks on demand,
+        unless they are prefetched: see the name_prefetch_depth config
+        key, which only has an effect with such checkpoints."""
+        path = os.path.abspath(path)
+        self.network.export_checkpoints(path, include_unexpired_names=unexpired_names)
+        return path
+
     @command('')
     def version(self):
         """Return the version of Electrum."""
@@ -975,9 +1004,15 @@ class Commands:
         return True
 
     @command('wn')
-    def is_synchronized(self):
+    def is_synchronized(self, show_progress=False):
         """ return wallet synchronization status """
-        return self.wallet.is_up_to_date()
+        if not show_progress:
+            return self.wallet.is_up_to_date()
+        synchronizer = self.wallet.synchronizer
+        return {
+            'synchronized': self.wallet.is_up_to_date(),
+            'transactions': synchronizer.get_tx_fetch_progress() if synchronizer else None,
+        }
 
     @command('n')
     def getfeerate(self, fee_method=None, fee_level=None):
@@ -1029,7 +1064,7 @@ class Commands:
             if height < constants.net.max_checkpoint():
                 self.network.run_from_another_thread(self.network.request_chunk(height, None))
 
-        # (from verifier._request_and_verify_single_proof)
+        # (from verifier._request_and_verify_proofs)
         merkle = self.network.run_from_another_thread(self.network.get_merkle_for_transaction(txid, height))
         if height != merkle.get('block_height'):
             raise Exception('requested height {} differs from received height {} for txid {}'
@@ -1045,9 +1080,17 @@ class Commands:
 
         # The txid is now verified to come from a safe height in the blockchain.
 
+        tx = None
         if self.wallet and txid in self.wallet.db.transactions:
             tx = self.wallet.db.transactions[txid]
         else:
+            raw = self.network.tx_store.get(txid)
+            if raw:
+                tx = Transaction(raw)
+                if tx.txid() != txid:
+                    self.network.tx_store.discard(txid)
+                    tx = None
+        if tx is None:
             raw = self.network.run_from_another_thread(self.network.get_transaction(txid))
             if raw:
                 tx = Transaction(raw)
@@ -1056,6 +1099,7 @@ class Commands:
 
         if tx.txid() != txid:
             raise Exception("txid mismatch")
+        self.network.tx_store.put(txid, tx.raw)
 
         # the tx is now verified to come from a safe height in the blockchain
 
@@ -1192,6 +1236,7 @@ command_options = {
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
     'show_fees':   (None, "Show miner fees paid by transactions"),
+    'show_progress': (None, "Show how many of the missing transactions were downloaded"),
     'year':        (None, "Show history for a given year"),
     'fee_method':  (None, "Fee estimation method to use"),
     'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
@@ -1205,6 +1250,7 @@ command_options = {
     'value':       (None, "The value to assign to the name"),
     'trigger_txid':(None, "Broadcast the transaction when this txid reaches the specified number of confirmations"),
     'trigger_name':(None, "Broadcast the transaction when this name reaches the specified number of confirmations"),
+    'unexpired_names': (None, "Also checkpoint the chunks in which names may still be unexpired"),
 }
 
 
@@ -221,7 +221,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             self.network_signal.connect(self.on_network_qt)
             interests = ['wallet_updated', 'network_updated', 'blockchain_updated',
                          'new_transaction', 'status',
-                         'banner', 'verified', 'fee', 'fee_histogram']
+                         'banner', 'verified', 'fee', 'fee_histogram',
+                         'tx_fetch_progress']
             # To avoid leaking references to "self" that prevent the
             # window from being GC-ed when closed, callbacks should be
             # methods of this class only, and specifically not be
@@ -372,6 +373,10 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             wallet, tx = args
             if wallet == self.wallet:
                 self.tx_notification_queue.put(tx)
+        elif event == 'tx_fetch_progress':
+            wallet = args[0]
+            if wallet == self.wallet:
+                self.network_signal.emit('status', None)
         elif event in ['status', 'banner', 'verified', 'fee', 'fee_histogram']:
             # Handle in GUI thread
             self.network_signal.emit(event, args)
@@ -804,6 +809,10 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             # Display the synchronizing message in that case.
             if not self.wallet.up_to_date or server_height == 0:
                 text = _("Synchronizing...")
+                synchronizer = self.wallet.synchronizer
+                progress = synchronizer.get_tx_fetch_progress() if synchronizer else None
+                if progress and progress['fetched'] < progress['total']:
+                    text += " ({}/{} {})".format(progress['fetched'], progress['total'], _("transactions"))
                 icon = read_QIcon("status_waiting.png")
             elif server_lag > 1:
                 text = _("Server is lagging ({} blocks)").format(server_lag)
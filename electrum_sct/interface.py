@@ -26,13 +26,14 @@ import os
 import re
 import ssl
 import sys
+import time
 import traceback
 import asyncio
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional
+from typing import Tuple, Union, List, Dict, TYPE_CHECKING, Optional
 from collections import defaultdict
 
 import aiorpcx
-from aiorpcx import RPCSession, Notification
+from aiorpcx import RPCSession, Notification, run_in_thread
 import certifi
 
 from .util import PrintError, ignore_exceptions, log_exceptions, bfh, SilentTaskGroup
@@ -52,6 +53,26 @@ if TYPE_CHECKING:
 ca_path = certifi.where()
 
 
+# seconds during which a server is not asked for chunks of another
+# interface after failing to send one, or sending one that does not connect
+CHUNK_SOURCE_FAILURE_PENALTY = 60
+CHUNK_SOURCE_BAD_CHUNK_PENALTY = 600
+
+# implementations, as in their server.version response, known to answer
+# JSON-RPC batch requests
+BATCH_REQUEST_SERVERS = ('electrumx', 'electrs', 'fulcrum')
+
+# read-only requests that concurrent callers with the same params share:
+# only one of them goes to the server, the others wait for its response
+COALESCED_METHODS = frozenset([
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+    'blockchain.scripthash.get_history',
+    'blockchain.scripthash.get_balance',
+    'blockchain.scripthash.listunspent',
+])
+
+
 class NetworkTimeout:
     # seconds
     class Generic:
@@ -79,6 +100,15 @@ class NotificationSession(RPCSession):
         self.default_timeout = NetworkTimeout.Generic.NORMAL
         self._msg_counter = 0
         self.interface = None  # type: Optional[Interface]
+        # for throughput: when requests last started being in flight,
+        # and how much had been received by then
+        self._requests_in_flight = 0
+        self._busy_since = 0.0
+        self._busy_recv_size = 0
+        # hashable key -> [request future, number of callers waiting for it]
+        self._coalesced_requests = {}  # type: Dict[str, list]
+        # response to server.version, once the interface has it
+        self.server_version = None
 
     def _get_and_inc_msg_counter(self):
         # runs in event loop thread, no need for lock
@@ -100,6 +130,32 @@ class NotificationSession(RPCSession):
                 raise Exception('unexpected request: {}'.format(repr(request)))
 
     async def send_request(self, *args, timeout=None, **kwargs):
+        if args[0] not in COALESCED_METHODS or len(args) < 2:
+            return await self._send_request(*args, timeout=timeout, **kwargs)
+        # note: callers that join a request in flight get the timeout of
+        # the caller that made it
+        key = self.get_hashable_key_for_rpc_call(args[0], args[1])
+        entry = self._coalesced_requests.get(key)
+        if entry is None or entry[0].done():
+            fut = asyncio.ensure_future(self._send_request(*args, timeout=timeout, **kwargs))
+            entry = self._coalesced_requests[key] = [fut, 0]
+            fut.add_done_callback(lambda f: self._forget_coalesced_request(key, entry))
+        elif self.interface:
+            self.interface.network.rpc_metrics.request_coalesced(args[0])
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            # nobody is waiting anymore (all callers were cancelled)
+            if entry[1] == 0:
+                entry[0].cancel()
+
+    def _forget_coalesced_request(self, key, entry):
+        if self._coalesced_requests.get(key) is entry:
+            del self._coalesced_requests[key]
+
+    async def _send_request(self, *args, timeout=None, **kwargs):
         # note: the timeout starts after the request touches the wire!
         if timeout is None:
             timeout = self.default_timeout
@@ -107,15 +163,111 @@ class NotificationSession(RPCSession):
         async with self.in_flight_requests_semaphore:
             msg_id = self._get_and_inc_msg_counter()
             self.maybe_log(f"<-- {args} {kwargs} (id: {msg_id})")
+            method, params = args[0], args[1] if len(args) > 1 else None
+            self._request_started(method, params)
+            start = time.time()
+            outcome, response = 'cancelled', None
             try:
                 response = await asyncio.wait_for(
                     super().send_request(*args, **kwargs),
                     timeout)
             except asyncio.TimeoutError as e:
+                outcome = 'timeout'
                 raise RequestTimedOut(f'request timed out: {args} (id: {msg_id})') from e
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                outcome = 'error'
+                raise
             else:
+                outcome = 'ok'
                 self.maybe_log(f"--> {response} (id: {msg_id})")
                 return response
+            finally:
+                self._request_finished(method, time.time() - start, outcome, response)
+
+    def supports_batch_requests(self) -> bool:
+        # batches are part of JSON-RPC 2.0, but not every server
+        # implementation answers them, and some just drop them
+        ver = self.server_version
+        software = ver[0] if isinstance(ver, (list, tuple)) and ver else ver
+        return str(software).lower().startswith(BATCH_REQUEST_SERVERS)
+
+    async def send_requests(self, method, params_list, timeout=None) -> list:
+        """Sends a request to 'method' for each item of 'params_list', as one
+        JSON-RPC batch if the server supports batches. Returns the results in
+        order, with the CodeMessageError of failed requests in their place.
+        """
+        if len(params_list) > 1 and self.supports_batch_requests():
+            return await self._send_batch_request(method, params_list, timeout=timeout)
+
+        async def send(params):
+            try:
+                return await self.send_request(method, params, timeout=timeout)
+            except aiorpcx.jsonrpc.CodeMessageError as e:
+                return e
+        return await asyncio.gather(*[send(params) for params in params_list])
+
+    async def _send_batch_request(self, method, params_list, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        async def send():
+            async with self.send_batch() as batch:
+                for params in params_list:
+                    batch.add_request(method, params)
+            return list(batch.results)
+
+        async with self.in_flight_requests_semaphore:
+            msg_id = self._get_and_inc_msg_counter()
+            self.maybe_log(f"<-- batch of {len(params_list)} {method} (id: {msg_id})")
+            for params in params_list:
+                self._request_started(method, params)
+            start = time.time()
+            outcome, results = 'cancelled', [None] * len(params_list)
+            try:
+                results = await asyncio.wait_for(send(), timeout)
+            except asyncio.TimeoutError as e:
+                outcome = 'timeout'
+                raise RequestTimedOut(f'request timed out: batch of {len(params_list)} {method} (id: {msg_id})') from e
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                outcome = 'error'
+                raise
+            else:
+                outcome = 'ok'
+                self.maybe_log(f"--> {results} (id: {msg_id})")
+                return results
+            finally:
+                seconds = time.time() - start
+                for result in results:
+                    if isinstance(result, Exception):
+                        self._request_finished(method, seconds, 'error', None)
+                    else:
+                        self._request_finished(method, seconds, outcome, result)
+
+    def _request_started(self, method, params):
+        if self._requests_in_flight == 0:
+            self._busy_since = time.time()
+            self._busy_recv_size = self.recv_size
+        self._requests_in_flight += 1
+        if self.interface:
+            self.interface.network.rpc_metrics.request_started(method, params)
+
+    def _request_finished(self, method, seconds, outcome, response):
+        self._requests_in_flight -= 1
+        if not self.interface:
+            return
+        network = self.interface.network
+        network.rpc_metrics.request_finished(method, seconds, outcome, response)
+        # error responses say nothing about the server's speed or reliability
+        if outcome in ('ok', 'timeout'):
+            network.server_stats.record_request(self.interface.server, method,
+                                                seconds if outcome == 'ok' else None)
+        if self._requests_in_flight == 0:
+            network.server_stats.record_transfer(
+                self.interface.server, self.recv_size - self._busy_recv_size, time.time() - self._busy_since)
 
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
         # note: until the cache is written for the first time,
@@ -129,6 +281,22 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_many(self, method: str, params_list: List[List], queue: asyncio.Queue):
+        """Like subscribe, for each item of 'params_list'. The ones that are
+        not cached are requested together, see send_requests."""
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+        missing = [(key, params) for key, params in zip(keys, params_list) if key not in self.cache]
+        if missing:
+            results = await self.send_requests(method, [params for key, params in missing])
+            for (key, params), result in zip(missing, results):
+                if isinstance(result, Exception):
+                    raise result
+                self.cache[key] = result
+        for key, params in zip(keys, params_list):
+            await queue.put(params + [self.cache[key]])
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -391,6 +559,13 @@ class Interface(PrintError):
         if can_return_early and index in self._requested_chunks:
             return
         self.print_error("requesting chunk from height {}".format(height))
+        res = await self._fetch_chunk(index, tip)
+        conn = self.blockchain.connect_chunk(index, res['hex'])
+        if not conn:
+            return conn, 0
+        return conn, res['count']
+
+    async def _fetch_chunk(self, index, tip=None):
         size = 2016
         if tip is not None:
             size = min(size, tip - index * 2016 + 1)
@@ -400,15 +575,83 @@ class Interface(PrintError):
             if index * 2016 + size - 1 > cp_height:
                 cp_height = 0
             self._requested_chunks.add(index)
-            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size, cp_height])
+            return await self.session.send_request('blockchain.block.headers', [index * 2016, size, cp_height])
         finally:
             try: self._requested_chunks.remove(index)
             except KeyError: pass
-        conn = self.blockchain.connect_chunk(index, res['hex'])
+
+    def get_header_pipeline_depth(self) -> int:
+        """Number of chunks kept in flight during catch-up."""
+        return max(1, int(self.network.config.get('header_pipeline_depth', 4)))
+
+    async def _request_chunk_pipelined(self, height, tip, prefetched):
+        """Like request_chunk, but keeps requests for the following chunks
+        in flight while this one is verified. 'prefetched' maps chunk index
+        to the future of its request, and is owned by the caller.
+        Requests are striped over the interfaces that agree on our tip,
+        header_pipeline_depth for each of them. Chunks are still
+        connected one at a time, in order.
+        """
+        depth = self.get_header_pipeline_depth()
+        if depth <= 1:
+            return await self.request_chunk(height, tip)
+        index = height // 2016
+        for i in [i for i in prefetched if i < index]:
+            self._cancel_prefetched_chunk(prefetched.pop(i))
+        sources = [self] + self.network.get_chunk_sources(self)
+        for i in range(index, min(index + depth * len(sources), tip // 2016 + 1)):
+            if i not in prefetched:
+                source = sources[i % len(sources)]
+                prefetched[i] = asyncio.ensure_future(self._fetch_chunk_from(source, i, tip))
+        self.print_error("requesting chunk from height {} ({} in flight, {} servers)".format(height, len(prefetched), len(sources)))
+        res, source = await prefetched.pop(index)
+        conn = await self._connect_chunk(index, res['hex'])
+        if not conn and source is not self:
+            # it claimed our tip, but sent a chunk that is not on our chain
+            self.print_error("chunk {} from {} does not connect".format(index, source.server))
+            self.network.penalize_chunk_source(source, CHUNK_SOURCE_BAD_CHUNK_PENALTY)
+            res = await self._fetch_chunk(index, tip)
+            conn = await self._connect_chunk(index, res['hex'])
         if not conn:
             return conn, 0
         return conn, res['count']
 
+    async def _connect_chunk(self, index, hexdata) -> bool:
+        # parsing, auxpow and PoW hashing run in a thread, so that responses
+        # to the other requests keep being read in the meantime; linking the
+        # headers to the chain and saving them stay on the network thread,
+        # where the other interfaces change the chains and forks
+        checked = await run_in_thread(self.blockchain.precheck_chunk, index, hexdata)
+        if checked is None:
+            return False
+        return self.blockchain.connect_chunk(index, hexdata, checked)
+
+    async def _fetch_chunk_from(self, source, index, tip):
+        """Fetches chunk 'index' from interface 'source', or from us if
+        that fails or takes too long. Returns the response and the
+        interface it came from.
+        """
+        if source is not self:
+            timeout = self.network.get_network_timeout_seconds(NetworkTimeout.Urgent)
+            size = max(0, min(2016, tip - index * 2016 + 1))
+            try:
+                res = await asyncio.wait_for(source._fetch_chunk(index, tip), timeout)
+                if res.get('count') != size:
+                    raise Exception('expected {} headers, got {}'.format(size, res.get('count')))
+                return res, source
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.print_error("chunk {} from {} failed: {}; fetching it ourselves".format(index, source.server, repr(e)))
+                self.network.penalize_chunk_source(source, CHUNK_SOURCE_FAILURE_PENALTY)
+        return await self._fetch_chunk(index, tip), self
+
+    @classmethod
+    def _cancel_prefetched_chunk(cls, fut):
+        if fut.done() and not fut.cancelled():
+            fut.exception()  # mark as retrieved, we don't care anymore
+        fut.cancel()
+
     async def open_session(self, sslc, exit_early=False):
         async with aiorpcx.Connector(NotificationSession,
                                      host=self.host, port=self.port,
@@ -423,6 +666,7 @@ class Interface(PrintError):
             if exit_early:
                 return
             self.print_error("connection established. version: {}".format(ver))
+            self.session.server_version = ver
 
             async with self.group as group:
                 await group.spawn(self.ping)
@@ -481,22 +725,27 @@ class Interface(PrintError):
         if next_height is None:
             next_height = self.tip
         last = None
-        while last is None or height <= next_height:
-            prev_last, prev_height = last, height
-            if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
-                if not could_connect:
-                    if height <= constants.net.max_checkpoint():
-                        raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
+        prefetched = {}  # chunk index -> future of request
+        try:
+            while last is None or height <= next_height:
+                prev_last, prev_height = last, height
+                if next_height > height + 10:
+                    could_connect, num_headers = await self._request_chunk_pipelined(height, next_height, prefetched)
+                    if not could_connect:
+                        if height <= constants.net.max_checkpoint():
+                            raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
+                        last, height = await self.step(height)
+                        continue
+                    self.network.trigger_callback('network_updated')
+                    height = (height // 2016 * 2016) + num_headers
+                    assert height <= next_height+1, (height, self.tip)
+                    last = 'catchup'
+                else:
                     last, height = await self.step(height)
-                    continue
-                self.network.trigger_callback('network_updated')
-                height = (height // 2016 * 2016) + num_headers
-                assert height <= next_height+1, (height, self.tip)
-                last = 'catchup'
-            else:
-                last, height = await self.step(height)
-            assert (prev_last, prev_height) != (last, height), 'had to prevent infinite loop in interface.sync_until'
+                assert (prev_last, prev_height) != (last, height), 'had to prevent infinite loop in interface.sync_until'
+        finally:
+            for fut in prefetched.values():
+                self._cancel_prefetched_chunk(fut)
         return last, height
 
     async def step(self, height, header=None):
@@ -641,10 +641,38 @@ class JsonDB(PrintError):
     @modifier
     def add_verified_tx(self, txid, info):
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        self.undone_verified_tx.pop(txid, None)
 
     @modifier
     def remove_verified_tx(self, txid):
         self.verified_tx.pop(txid, None)
+        self.undone_verified_tx.pop(txid, None)
+
+    @modifier
+    def undo_verified_tx(self, txid):
+        """Used when a reorg removed the block of txid from our chain.
+        Its verification info is kept, see get_undone_verified_tx."""
+        info = self.verified_tx.pop(txid, None)
+        if info is not None:
+            self.undone_verified_tx[txid] = info
+
+    @locked
+    def get_undone_verified_tx(self, txid):
+        """Returns the verification info txid had before a reorg undid it.
+        If the tx is still at that height, and the block there has the same
+        hash, its proof need not be requested again."""
+        if txid not in self.undone_verified_tx:
+            return None
+        height, timestamp, txpos, header_hash = self.undone_verified_tx[txid]
+        return TxMinedInfo(height=height,
+                           conf=None,
+                           timestamp=timestamp,
+                           txpos=txpos,
+                           header_hash=header_hash)
+
+    @modifier
+    def remove_undone_verified_tx(self, txid):
+        self.undone_verified_tx.pop(txid, None)
 
     def is_in_verified_tx(self, txid):
         return txid in self.verified_tx
@@ -743,6 +771,7 @@ class JsonDB(PrintError):
         self.spent_outpoints = self.get_data_ref('spent_outpoints')
         self.history = self.get_data_ref('addr_history')  # address -> list of (txid, height)
         self.verified_tx = self.get_data_ref('verified_tx3')  # txid -> (height, timestamp, txpos, header_hash)
+        self.undone_verified_tx = self.get_data_ref('undone_verified_tx')  # same, for verifications undone by a reorg
         self.tx_fees = self.get_data_ref('tx_fees')
         self.queued_transactions = self.get_data_ref('queued_transactions')
         # convert raw hex transactions to Transaction objects
@@ -774,4 +803,5 @@ class JsonDB(PrintError):
         self.transactions.clear()
         self.history.clear()
         self.verified_tx.clear()
+        self.undone_verified_tx.clear()
         self.tx_fees.clear()
@@ -22,6 +22,7 @@
 # SOFTWARE.
 import time
 import queue
+import bisect
 import os
 import random
 import re
@@ -38,7 +39,7 @@ import traceback
 import dns
 import dns.resolver
 import aiorpcx
-from aiorpcx import TaskGroup
+from aiorpcx import TaskGroup, run_in_thread
 from aiohttp import ClientResponse
 
 from . import util
@@ -55,10 +56,13 @@ from .interface import (Interface, serialize_server, deserialize_server,
                         RequestTimedOut, NetworkTimeout)
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
+from .tx_store import TxStore
 from .i18n import _
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+NAME_PREFETCH_INTERVAL = 10
+TX_STORE_SAVE_INTERVAL = 60
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -111,11 +115,253 @@ def filter_protocol(hostmap, protocol='s'):
     return eligible
 
 
-def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
+def pick_random_server(hostmap = None, protocol = 's', exclude_set = set(), server_stats = None):
     if hostmap is None:
         hostmap = constants.net.DEFAULT_SERVERS
     eligible = list(set(filter_protocol(hostmap, protocol)) - exclude_set)
-    return random.choice(eligible) if eligible else None
+    if not eligible:
+        return None
+    if server_stats:
+        return server_stats.choose(eligible)
+    return random.choice(eligible)
+
+
+class ServerStats:
+    """Round-trip times, error counts and throughput of the servers we
+    have talked to, used to prefer fast and reliable servers.
+
+    The RTT is a moving average over requests other than chunk downloads,
+    whose time is mostly transfer. Throughput is measured over the time
+    a session has requests in flight. Only timeouts, failed connections
+    and bad chunks count as errors, not error responses.
+    """
+
+    RTT_SMOOTHING = 0.2
+    MAX_SERVERS = 100
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = {}  # type: Dict[str, dict]
+        if path:
+            try:
+                with open(path, "r", encoding='utf-8') as f:
+                    self.stats = json.loads(f.read())
+            except:
+                pass
+
+    def _get(self, server: str) -> dict:
+        stats = self.stats.get(server)
+        if stats is None:
+            stats = self.stats[server] = {'rtt': None, 'requests': 0, 'errors': 0,
+                                          'bytes': 0, 'busy_time': 0.0, 'last_used': 0}
+        stats['last_used'] = int(time.time())
+        return stats
+
+    def record_request(self, server: str, method: str, seconds: Optional[float]) -> None:
+        """Records a request that took 'seconds', or timed out if None."""
+        with self.lock:
+            stats = self._get(server)
+            stats['requests'] += 1
+            if seconds is None:
+                stats['errors'] += 1
+            elif method != 'blockchain.block.headers':
+                rtt = stats['rtt']
+                stats['rtt'] = seconds if rtt is None else rtt + self.RTT_SMOOTHING * (seconds - rtt)
+
+    def record_transfer(self, server: str, num_bytes: int, seconds: float) -> None:
+        with self.lock:
+            stats = self._get(server)
+            stats['bytes'] += num_bytes
+            stats['busy_time'] += seconds
+
+    def record_error(self, server: str) -> None:
+        with self.lock:
+            stats = self._get(server)
+            stats['requests'] += 1
+            stats['errors'] += 1
+
+    def _weight(self, server: str, default_rtt: float) -> float:
+        stats = self.stats.get(server)
+        if stats is None:
+            # give servers we do not know yet a fair chance
+            return 1 / default_rtt
+        rtt = stats['rtt'] if stats['rtt'] is not None else default_rtt
+        success_rate = (stats['requests'] - stats['errors'] + 1) / (stats['requests'] + 2)
+        return success_rate / max(rtt, 0.01)
+
+    def choose(self, servers: Sequence[str]) -> str:
+        """Picks one of 'servers' at random, weighted by success rate
+        over RTT."""
+        with self.lock:
+            rtts = sorted(stats['rtt'] for stats in self.stats.values() if stats['rtt'] is not None)
+            default_rtt = rtts[len(rtts) // 2] if rtts else 1.0
+            weights = [self._weight(server, default_rtt) for server in servers]
+        return random.choices(servers, weights=weights)[0]
+
+    def to_dict(self) -> Dict[str, dict]:
+        with self.lock:
+            out = {}
+            for server, stats in self.stats.items():
+                out[server] = {
+                    'rtt': stats['rtt'],
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'error_rate': stats['errors'] / stats['requests'] if stats['requests'] else None,
+                    'bytes_per_second': stats['bytes'] / stats['busy_time'] if stats['busy_time'] else None,
+                    'last_used': stats['last_used'],
+                }
+            return out
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            servers = sorted(self.stats, key=lambda server: self.stats[server]['last_used'], reverse=True)
+            self.stats = {server: self.stats[server] for server in servers[:self.MAX_SERVERS]}
+            s = json.dumps(self.stats, indent=4, sort_keys=True)
+        try:
+            with open(self.path, "w", encoding='utf-8') as f:
+                f.write(s)
+        except:
+            pass
+
+
+def payload_size(obj) -> int:
+    """Approximate size of 'obj' encoded as JSON, without encoding it."""
+    if isinstance(obj, str):
+        return len(obj) + 2
+    if isinstance(obj, dict):
+        return 1 + sum(len(str(k)) + 4 + payload_size(v) for k, v in obj.items()) + (not obj)
+    if isinstance(obj, (list, tuple)):
+        return 1 + sum(payload_size(v) + 1 for v in obj) + (not obj)
+    if obj is None:
+        return 4
+    return len(str(obj))
+
+
+class RPCMetrics:
+    """Per-method call counts, latencies, timeouts, payload sizes and
+    in-flight counts of the requests sent to servers, and of the
+    best_effort_reliable calls that retry them over interface changes.
+    'calls' counts requests that went to a server; 'coalesced' counts
+    calls that were saved by sharing a request already in flight.
+
+    Payload sizes are estimated from the decoded params and results.
+    Latencies of requests that timed out or were cancelled are not put
+    in the histogram.
+    """
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.methods = {}  # type: Dict[str, dict]
+        self.reliable_calls = {}  # type: Dict[str, dict]
+
+    def _get(self, method: str) -> dict:
+        m = self.methods.get(method)
+        if m is None:
+            m = self.methods[method] = {
+                'calls': 0, 'coalesced': 0, 'in_flight': 0, 'max_in_flight': 0,
+                'errors': 0, 'timeouts': 0, 'cancelled': 0,
+                'total_time': 0.0, 'max_time': 0.0,
+                'latency': [0] * (len(self.LATENCY_BUCKETS) + 1),
+                'request_bytes': 0, 'response_bytes': 0,
+            }
+        return m
+
+    def request_started(self, method: str, params) -> None:
+        size = payload_size(params)
+        with self.lock:
+            m = self._get(method)
+            m['calls'] += 1
+            m['in_flight'] += 1
+            m['max_in_flight'] = max(m['max_in_flight'], m['in_flight'])
+            m['request_bytes'] += size
+
+    def request_coalesced(self, method: str) -> None:
+        with self.lock:
+            self._get(method)['coalesced'] += 1
+
+    def request_finished(self, method: str, seconds: float, outcome: str, response=None) -> None:
+        """'outcome' is one of 'ok', 'error', 'timeout' and 'cancelled'."""
+        size = payload_size(response) if outcome == 'ok' else 0
+        with self.lock:
+            m = self._get(method)
+            m['in_flight'] -= 1
+            if outcome == 'timeout':
+                m['timeouts'] += 1
+                return
+            if outcome == 'cancelled':
+                m['cancelled'] += 1
+                return
+            if outcome == 'error':
+                m['errors'] += 1
+            m['total_time'] += seconds
+            m['max_time'] = max(m['max_time'], seconds)
+            m['latency'][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+            m['response_bytes'] += size
+
+    def record_reliable_call(self, name: str, attempts: int, seconds: float, ok: bool) -> None:
+        with self.lock:
+            r = self.reliable_calls.get(name)
+            if r is None:
+                r = self.reliable_calls[name] = {'calls': 0, 'retries': 0, 'failures': 0,
+                                                 'total_time': 0.0, 'max_time': 0.0}
+            r['calls'] += 1
+            r['retries'] += max(attempts - 1, 0)
+            if not ok:
+                r['failures'] += 1
+            r['total_time'] += seconds
+            r['max_time'] = max(r['max_time'], seconds)
+
+    def _histogram(self, counts: List[int]) -> Dict[str, int]:
+        labels = ['<=%g' % b for b in self.LATENCY_BUCKETS] + ['>%g' % self.LATENCY_BUCKETS[-1]]
+        return dict(zip(labels, counts))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            methods = {}
+            for method, m in self.methods.items():
+                answered = m['calls'] - m['in_flight'] - m['timeouts'] - m['cancelled']
+                methods[method] = {
+                    'calls': m['calls'],
+                    'coalesced': m['coalesced'],
+                    'in_flight': m['in_flight'],
+                    'max_in_flight': m['max_in_flight'],
+                    'errors': m['errors'],
+                    'timeouts': m['timeouts'],
+                    'cancelled': m['cancelled'],
+                    'mean_time': m['total_time'] / answered if answered else None,
+                    'max_time': m['max_time'],
+                    'latency_histogram': self._histogram(m['latency']),
+                    'request_bytes': m['request_bytes'],
+                    'response_bytes': m['response_bytes'],
+                }
+            reliable_calls = {}
+            for name, r in self.reliable_calls.items():
+                reliable_calls[name] = dict(r, mean_time=r['total_time'] / r['calls'])
+            return {
+                'uptime': time.time() - self.start_time,
+                'methods': methods,
+                'best_effort_reliable': reliable_calls,
+            }
+
+    def summary(self, top: int = 5) -> str:
+        """One line with the totals and the methods that took longest."""
+        with self.lock:
+            calls = sum(m['calls'] for m in self.methods.values())
+            coalesced = sum(m['coalesced'] for m in self.methods.values())
+            in_flight = sum(m['in_flight'] for m in self.methods.values())
+            timeouts = sum(m['timeouts'] for m in self.methods.values())
+            errors = sum(m['errors'] for m in self.methods.values())
+            received = sum(m['response_bytes'] for m in self.methods.values())
+            slowest = sorted(self.methods.items(), key=lambda item: item[1]['total_time'], reverse=True)[:top]
+            parts = ['%s %d/%.1fs' % (method, m['calls'], m['total_time']) for method, m in slowest]
+        return ('%d requests, %d coalesced, %d in flight, %d timeouts, %d errors, %d bytes received; %s'
+                % (calls, coalesced, in_flight, timeouts, errors, received, ', '.join(parts)))
 
 
 class NetworkParameters(NamedTuple):
@@ -207,6 +453,14 @@ class UntrustedServerReturnedError(Exception):
         return f"<UntrustedServerReturnedError original_exception: {repr(self.original_exception)}>"
 
 
+def wrap_server_errors(results: list) -> list:
+    """Replaces the error responses in the results of send_requests
+    with UntrustedServerReturnedError, as catch_server_exceptions does."""
+    return [UntrustedServerReturnedError(original_exception=result)
+            if isinstance(result, aiorpcx.jsonrpc.CodeMessageError) else result
+            for result in results]
+
+
 INSTANCE = None
 
 
@@ -254,6 +508,10 @@ class Network(PrintError):
 
         self.server_peers = {}  # returned by interface (servers that the main interface knows about)
         self.recent_servers = self._read_recent_servers()  # note: needs self.recent_servers_lock
+        self.server_stats = ServerStats(os.path.join(self.config.path, "server_stats") if self.config.path else None)
+        self.rpc_metrics = RPCMetrics()
+        self.tx_store = TxStore(os.path.join(self.config.path, "txstore") if self.config.path else None,
+                                self.config.get('tx_store_max_size', 50 * 1000 * 1000))
 
         self.banner = ''
         self.donation_address = ''
@@ -275,6 +533,10 @@ class Network(PrintError):
         self.connecting = set()
         self.server_queue = None
         self.proxy = None
+        # server -> time until which other interfaces do not fetch chunks from it
+        self.chunk_source_penalties = {}  # type: Dict[str, float]
+        # chunks of the name expiration window available, and in total
+        self.name_prefetch_progress = (0, 0)
 
         # Dump network messages (all interfaces).  Set at runtime from the console.
         self.debug = False
@@ -490,7 +752,7 @@ class Network(PrintError):
     def _start_random_interface(self):
         with self.interfaces_lock:
             exclude_set = self.disconnected_servers | set(self.interfaces) | self.connecting
-        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        server = pick_random_server(self.get_servers(), self.protocol, exclude_set, self.server_stats)
         if server:
             self._start_interface(server)
         return server
@@ -588,7 +850,7 @@ class Network(PrintError):
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            await self.switch_to_interface(random.choice(servers))
+            await self.switch_to_interface(self.server_stats.choose(servers))
 
     async def switch_lagging_interface(self):
         '''If auto_connect and lagging, switch interface'''
@@ -598,8 +860,8 @@ class Network(PrintError):
             with self.interfaces_lock: interfaces = list(self.interfaces.values())
             filtered = list(filter(lambda iface: iface.tip_header == best_header, interfaces))
             if filtered:
-                chosen_iface = random.choice(filtered)
-                await self.switch_to_interface(chosen_iface.server)
+                chosen_server = self.server_stats.choose([iface.server for iface in filtered])
+                await self.switch_to_interface(chosen_server)
 
     async def switch_unwanted_fork_interface(self):
         """If auto_connect and main interface is not on preferred fork,
@@ -687,6 +949,7 @@ class Network(PrintError):
         self.recent_servers.insert(0, server)
         self.recent_servers = self.recent_servers[0:20]
         self._save_recent_servers()
+        self.server_stats.save()
 
     async def connection_down(self, interface: Interface):
         '''A connection to server either went down, or was never made.
@@ -697,8 +960,30 @@ class Network(PrintError):
         if server == self.default_server:
             self._set_status('disconnected')
         await self._close_interface(interface)
+        self.server_stats.save()
         self.trigger_callback('network_updated')
 
+    def get_chunk_sources(self, interface: Interface) -> List[Interface]:
+        """The other interfaces that 'interface' may fetch chunks from:
+        those with the same tip, and not penalized for bad chunks lately.
+        """
+        tip_header = interface.tip_header
+        if not tip_header:
+            return []
+        tip_hash = blockchain.hash_header(tip_header)
+        now = time.time()
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        return [i for i in interfaces
+                if i is not interface and i.tip == interface.tip and i.tip_header
+                and i.session and not i.session.is_closing()
+                and self.chunk_source_penalties.get(i.server, 0) <= now
+                and blockchain.hash_header(i.tip_header) == tip_hash]
+
+    def penalize_chunk_source(self, interface: Interface, seconds: float) -> None:
+        self.print_error(f"not fetching chunks from {interface.server} for {seconds} seconds")
+        self.server_stats.record_error(interface.server)
+        self.chunk_source_penalties[interface.server] = time.time() + seconds
+
     def get_network_timeout_seconds(self, request_type=NetworkTimeout.Generic) -> int:
         if self.oneserver and not self.auto_connect:
             return request_type.MOST_RELAXED
@@ -716,6 +1001,7 @@ class Network(PrintError):
         except BaseException as e:
             #traceback.print_exc()
             self.print_error(f"couldn't launch iface {server} -- {repr(e)}")
+            self.server_stats.record_error(server)
             await interface.close()
             return
         else:
@@ -747,33 +1033,39 @@ class Network(PrintError):
 
     def best_effort_reliable(func):
         async def make_reliable_wrapper(self, *args, **kwargs):
-            for i in range(10):
-                iface = self.interface
-                # retry until there is a main interface
-                if not iface:
-                    await asyncio.sleep(0.1)
-                    continue  # try again
-                # wait for it to be usable
-                iface_ready = iface.ready
-                iface_disconnected = iface.got_disconnected
-                await asyncio.wait([iface_ready, iface_disconnected], return_when=asyncio.FIRST_COMPLETED)
-                if not iface_ready.done() or iface_ready.cancelled():
-                    await asyncio.sleep(0.1)
-                    continue  # try again
-                # try actual request
-                success_fut = asyncio.ensure_future(func(self, *args, **kwargs))
-                await asyncio.wait([success_fut, iface_disconnected], return_when=asyncio.FIRST_COMPLETED)
-                if success_fut.done() and not success_fut.cancelled():
-                    if success_fut.exception():
-                        try:
-                            raise success_fut.exception()
-                        except RequestTimedOut:
-                            await iface.close()
-                            await iface_disconnected
-                            continue  # try again
-                    return success_fut.result()
-                # otherwise; try again
-            raise BestEffortRequestFailed('no interface to do request on... gave up.')
+            start, attempts, ok = time.time(), 0, False
+            try:
+                for i in range(10):
+                    attempts = i + 1
+                    iface = self.interface
+                    # retry until there is a main interface
+                    if not iface:
+                        await asyncio.sleep(0.1)
+                        continue  # try again
+                    # wait for it to be usable
+                    iface_ready = iface.ready
+                    iface_disconnected = iface.got_disconnected
+                    await asyncio.wait([iface_ready, iface_disconnected], return_when=asyncio.FIRST_COMPLETED)
+                    if not iface_ready.done() or iface_ready.cancelled():
+                        await asyncio.sleep(0.1)
+                        continue  # try again
+                    # try actual request
+                    success_fut = asyncio.ensure_future(func(self, *args, **kwargs))
+                    await asyncio.wait([success_fut, iface_disconnected], return_when=asyncio.FIRST_COMPLETED)
+                    if success_fut.done() and not success_fut.cancelled():
+                        if success_fut.exception():
+                            try:
+                                raise success_fut.exception()
+                            except RequestTimedOut:
+                                await iface.close()
+                                await iface_disconnected
+                                continue  # try again
+                        ok = True
+                        return success_fut.result()
+                    # otherwise; try again
+                raise BestEffortRequestFailed('no interface to do request on... gave up.')
+            finally:
+                self.rpc_metrics.record_reliable_call(func.__name__, attempts, time.time() - start, ok)
         return make_reliable_wrapper
 
     def catch_server_exceptions(func):
@@ -793,6 +1085,21 @@ class Network(PrintError):
             raise Exception(f"{repr(tx_height)} is not a block height")
         return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
 
+    @best_effort_reliable
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> list:
+        """Like get_merkle_for_transaction, for several (tx_hash, tx_height)
+        pairs, in one JSON-RPC batch if the server supports it. Returns the
+        proofs in order, with an UntrustedServerReturnedError in place of
+        those the server returned an error for."""
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.interface.session.send_requests('blockchain.transaction.get_merkle',
+                                                             [[tx_hash, tx_height] for tx_hash, tx_height in txs])
+        return wrap_server_errors(results)
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx, *, timeout=None) -> None:
         if timeout is None:
@@ -962,6 +1269,20 @@ class Network(PrintError):
         return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash],
                                                          timeout=timeout)
 
+    @best_effort_reliable
+    async def get_transactions(self, tx_hashes: Sequence[str], *, timeout=None) -> list:
+        """Like get_transaction, for several transactions, in one JSON-RPC
+        batch if the server supports it. Returns the raw transactions in
+        order, with an UntrustedServerReturnedError in place of those the
+        server returned an error for."""
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        results = await self.interface.session.send_requests('blockchain.transaction.get',
+                                                             [[tx_hash] for tx_hash in tx_hashes],
+                                                             timeout=timeout)
+        return wrap_server_errors(results)
+
     @best_effort_reliable
     @catch_server_exceptions
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
@@ -1039,11 +1360,81 @@ class Network(PrintError):
     def get_local_height(self):
         return self.blockchain().height()
 
-    def export_checkpoints(self, path):
+    def get_name_window_chunks(self) -> List[int]:
+        """Indexes of the checkpointed chunks holding the last
+        name_prefetch_depth blocks. Headers above the checkpoints are
+        synced anyway. Empty with the default checkpoints, which stop
+        before unexpired names; see exportcheckpoints --unexpired_names."""
+        depth = self.config.get_name_prefetch_depth()
+        height = self.get_local_height()
+        first_height = max(0, height - depth + 1)
+        last_height = min(height, constants.net.max_checkpoint())
+        if depth <= 0 or first_height > last_height:
+            return []
+        return list(range(first_height // 2016, last_height // 2016 + 1))
+
+    async def _prefetch_name_window_chunks(self) -> None:
+        indexes = self.get_name_window_chunks()
+        chain = self.blockchain()
+        missing = [index for index in indexes if not chain.has_chunk(index)]
+        progress = (len(indexes) - len(missing), len(indexes))
+        if progress != self.name_prefetch_progress:
+            self.name_prefetch_progress = progress
+            self.trigger_callback('name_prefetch', *progress)
+        # recent names are looked up more often
+        for index in reversed(missing):
+            try:
+                r = await self.request_chunk(index * 2016, None, can_return_early=True)
+            except (BestEffortRequestFailed, UntrustedServerReturnedError) as e:
+                self.print_error(f"name prefetch: could not get chunk {index}: {repr(e)}")
+                return
+            if r is None:
+                continue  # already being requested; counted on the next pass
+            if not r[0]:
+                self.print_error(f"name prefetch: chunk {index} does not connect")
+                return
+            progress = (progress[0] + 1, progress[1])
+            self.name_prefetch_progress = progress
+            self.trigger_callback('name_prefetch', *progress)
+
+    @ignore_exceptions  # do not kill main_taskgroup
+    @log_exceptions
+    async def _prefetch_name_window(self):
+        """Keeps the checkpointed chunks in the name expiration window
+        downloaded and verified, so that name lookups and SPV do not have
+        to request them on demand. Progress is reported with the
+        'name_prefetch' callback, as (chunks available, chunks in window).
+        """
+        while True:
+            if self.is_connected():
+                await self._prefetch_name_window_chunks()
+            await asyncio.sleep(NAME_PREFETCH_INTERVAL)
+
+    def get_server_stats(self) -> Dict[str, dict]:
+        return self.server_stats.to_dict()
+
+    def get_network_metrics(self) -> dict:
+        return dict(self.rpc_metrics.snapshot(), tx_store=self.tx_store.get_stats())
+
+    async def _save_tx_store(self):
+        # so that a crash loses little of the index
+        while True:
+            await asyncio.sleep(TX_STORE_SAVE_INTERVAL)
+            await run_in_thread(self.tx_store.save)
+
+    async def _log_network_metrics(self):
+        interval = self.config.get('network_metrics_log_interval', 0)
+        if not interval:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            self.print_error('network metrics:', self.rpc_metrics.summary())
+
+    def export_checkpoints(self, path, include_unexpired_names=False):
         """Run manually to generate blockchain checkpoints.
-        Kept for console use only.
+        Also available as the exportcheckpoints command.
         """
-        cp = self.blockchain().get_checkpoints()
+        cp = self.blockchain().get_checkpoints(include_unexpired_names)
         with open(path, 'w', encoding='utf-8') as f:
             f.write(json.dumps(cp, indent=4))
 
@@ -1067,6 +1458,9 @@ class Network(PrintError):
                 # will NOT raise, and the group will keep the other tasks running
                 async with main_taskgroup as group:
                     await group.spawn(self._maintain_sessions())
+                    await group.spawn(self._prefetch_name_window())
+                    await group.spawn(self._log_network_metrics())
+                    await group.spawn(self._save_tx_store())
                     [await group.spawn(job) for job in self._jobs]
             except Exception as e:
                 traceback.print_exc(file=sys.stderr)
@@ -1091,6 +1485,8 @@ class Network(PrintError):
         self.interfaces = {}  # type: Dict[str, Interface]
         self.connecting.clear()
         self.server_queue = None
+        self.server_stats.save()
+        await run_in_thread(self.tx_store.save)
         if not full_shutdown:
             self.trigger_callback('network_updated')
 
@@ -1100,6 +1496,10 @@ class Network(PrintError):
         try:
             fut.result(timeout=2)
         except (asyncio.TimeoutError, asyncio.CancelledError): pass
+        # headers are fsynced in groups; don't leave any behind
+        with blockchain.blockchains_lock: chains = list(blockchain.blockchains.values())
+        for chain in chains:
+            chain.sync()
 
     async def _ensure_there_is_a_main_interface(self):
         if self.is_connected():
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Compares parsing an auxpow with auxpow.parse_auxpow_header against
+# deserialize_auxpow_header below, the parser it replaced, which builds
+# a Transaction for the parent coinbase.
+#
+# usage: bench_auxpow.py [number of headers]
+
+import sys
+from timeit import default_timer
+
+from electrum_sct import auxpow, blockchain
+from electrum_sct.tests.test_auxpow import smartcryptotech_header_37174
+from electrum_sct.transaction import Transaction
+from electrum_sct.util import bfh, print_msg
+
+
+def deserialize_auxpow_header(base_header, s, start_position=0):
+    auxpow_header = {}
+    auxpow_header['chain_id'] = auxpow.get_chain_id(base_header)
+    parent_coinbase_tx = Transaction(None, expect_trailing_data=True, raw_bytes=s, expect_trailing_bytes=True, copy_input=False, start_position=start_position)
+    parent_coinbase_tx_dict, start_position = auxpow.fast_tx_deserialize(parent_coinbase_tx)
+    auxpow_header['parent_coinbase_tx'] = parent_coinbase_tx
+    start_position = start_position + 32
+    auxpow_header['coinbase_merkle_branch'], auxpow_header['coinbase_merkle_index'], start_position = auxpow.deserialize_merkle_branch(s, start_position=start_position)
+    auxpow_header['chain_merkle_branch'], auxpow_header['chain_merkle_index'], start_position = auxpow.deserialize_merkle_branch(s, start_position=start_position)
+    auxpow_header['parent_header'] = blockchain.deserialize_header(s, 1, start_position=start_position)
+    del auxpow_header['parent_header']['block_height']
+    return auxpow_header
+
+
+def report(name, dt, count):
+    print_msg("%-28s %8.2f us/header %10.0f headers/s" % (name, dt / count * 1e6, count / dt))
+    return dt
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    header_bytes = bfh(smartcryptotech_header_37174)
+    base_header = blockchain.deserialize_header(header_bytes[:80], 0)
+
+    t0 = default_timer()
+    for i in range(count):
+        deserialize_auxpow_header(base_header, header_bytes, start_position=80)
+    legacy = report("deserialize_auxpow_header", default_timer() - t0, count)
+
+    t0 = default_timer()
+    for i in range(count):
+        auxpow.parse_auxpow_header(base_header, header_bytes, start_position=80)
+    parse = report("parse_auxpow_header", default_timer() - t0, count)
+
+    print_msg("speedup: %.1fx" % (legacy / parse))
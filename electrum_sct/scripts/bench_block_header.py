@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Compares BlockHeader with the plain dicts headers used to be, for a
+# full chunk: time to deserialize and hash each header twice (as
+# verification and the header cache do), and memory held per header.
+#
+# usage: bench_block_header.py [number of headers]
+
+import sys
+import tracemalloc
+from timeit import default_timer
+
+from electrum_sct.bitcoin import hash_encode
+from electrum_sct.blockchain import HEADER_SIZE, deserialize_header, hash_header, hash_raw_header, serialize_header
+from electrum_sct.scripts.bench_header_sync import make_headers
+from electrum_sct.util import print_msg
+
+
+def deserialize_header_dict(s: bytes, height: int) -> dict:
+    # what deserialize_header did before BlockHeader
+    hex_to_int = lambda s: int.from_bytes(s, byteorder='little')
+    h = {}
+    h['version'] = hex_to_int(s[0:4])
+    h['prev_block_hash'] = hash_encode(s[4:36])
+    h['merkle_root'] = hash_encode(s[36:68])
+    h['timestamp'] = hex_to_int(s[68:72])
+    h['bits'] = hex_to_int(s[72:76])
+    h['nonce'] = hex_to_int(s[76:80])
+    h['block_height'] = height
+    return h
+
+
+def hash_header_dict(header: dict) -> str:
+    return hash_raw_header(serialize_header(header))
+
+
+def run(name, deserialize, hash_function, data, count):
+    t0 = default_timer()
+    headers = [deserialize(data[i*HEADER_SIZE:(i+1)*HEADER_SIZE], i) for i in range(count)]
+    for i in range(2):
+        for header in headers:
+            hash_function(header)
+    dt = default_timer() - t0
+    tracemalloc.start()
+    headers = [deserialize(data[i*HEADER_SIZE:(i+1)*HEADER_SIZE], i) for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print_msg("%-12s %8.2f us/header %10.0f headers/s %6d bytes/header"
+              % (name, dt / count * 1e6, count / dt, size / count))
+    return dt, size
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2016
+    data = make_headers(count)
+    dict_time, dict_size = run("dict", deserialize_header_dict, hash_header_dict, data, count)
+    header_time, header_size = run("BlockHeader", deserialize_header, hash_header, data, count)
+    print_msg("speedup: %.2fx, memory: %.2fx" % (dict_time / header_time, header_size / dict_size))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Measures header sync against a local stand-in for an ElectrumX server,
+# running in this process on its own event loop, that serves a synthetic
+# (optionally auxpow) chain or a recorded headers file after a simulated
+# round-trip time.
+#
+# A Network is pointed at the stand-in, or at several of them serving the
+# same chain with --servers, and goes through three phases:
+#   initial  sync from genesis to the tip of the stand-in
+#   catchup  the stand-in announces more headers on top of its tip
+#   reorg    the stand-in switches to a longer branch forking below its tip
+# For each phase, the time until the local chain has the stand-in's tip,
+# the headers/s, the CPU time of this process minus the stand-in's, and
+# the number of fsync calls are reported. Verification done in worker
+# processes (header_verification_processes) is not in the CPU time.
+#
+# usage: bench_header_sync.py [number of chunks [rtt in ms ...]] [options]
+#
+# A recorded headers file holds the headers of a chain from genesis on,
+# back to back, as returned by blockchain.block.headers.
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import List
+
+import aiorpcx
+
+from electrum_sct import auxpow, blockchain, constants
+from electrum_sct.blockchain import HEADER_SIZE, MissingHeader, deserialize_header, hash_header, serialize_header
+from electrum_sct.crypto import sha256d
+from electrum_sct.network import Network
+from electrum_sct.simple_config import SimpleConfig
+from electrum_sct.util import bfh, bh2u, create_and_start_event_loop, print_msg
+
+REGTEST_GENESIS_HEADER = "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff7f2002000000"
+
+RTTS = [0, 100, 500, 1000]  # milliseconds
+DEPTHS = [1, 4]
+SYNC_TIMEOUT = 600  # seconds
+
+AUXPOW_VERSION = auxpow.CHAIN_ID << 16 | auxpow.BLOCK_VERSION_AUXPOW_BIT | 1
+
+
+def make_auxpow(raw_header: bytes) -> bytes:
+    """A minimal auxpow for 'raw_header': a parent coinbase committing
+    to it, alone in a parent block of another chain."""
+    script_sig = b'\xfa\xbemm' + sha256d(raw_header)[::-1] + (1).to_bytes(4, 'little') + bytes(4)
+    coinbase = ((1).to_bytes(4, 'little')
+                + b'\x01' + bytes(32) + b'\xff' * 4 + bytes([len(script_sig)]) + script_sig + b'\xff' * 4
+                + b'\x01' + bytes(8) + b'\x00'
+                + bytes(4))
+    parent_header = (1).to_bytes(4, 'little') + bytes(32) + sha256d(coinbase) + raw_header[68:80]
+    # parent block hash, then empty coinbase and chain merkle branches
+    return coinbase + bytes(32) + b'\x00' + bytes(4) + b'\x00' + bytes(4) + parent_header
+
+
+def extend_chain(headers: List[bytes], count: int, *, with_auxpow=False, salt=0) -> List[bytes]:
+    """Returns 'headers' followed by 'count' synthetic ones. Branches
+    built with different salts from the same headers differ."""
+    headers = list(headers) or [bfh(REGTEST_GENESIS_HEADER)]
+    prev = deserialize_header(headers[-1][:HEADER_SIZE], len(headers) - 1)
+    for height in range(len(headers), len(headers) + count):
+        header = {
+            'version': AUXPOW_VERSION if with_auxpow else 1,
+            'prev_block_hash': hash_header(prev),
+            'merkle_root': '%032x%032x' % (salt, height),
+            'timestamp': prev['timestamp'] + 30,
+            'bits': prev['bits'],
+            'nonce': 0,
+            'block_height': height,
+        }
+        raw = bfh(serialize_header(header))
+        headers.append(raw + make_auxpow(raw) if with_auxpow else raw)
+        prev = header
+    return headers
+
+
+def make_headers(count: int) -> bytes:
+    """A synthetic regtest chain of 'count' headers, without auxpow."""
+    return b''.join(extend_chain([], count - 1))
+
+
+def read_headers_file(path: str) -> List[bytes]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    headers = []
+    position = 0
+    while position < len(data):
+        _, end = deserialize_header(data, len(headers), expect_trailing_data=True, start_position=position)
+        headers.append(data[position:end])
+        position = end
+    return headers
+
+
+class StandInSession(aiorpcx.RPCSession):
+    """Serves 'headers' after sleeping for 'rtt' seconds."""
+
+    headers = []  # type: List[bytes]
+    rtt = 0
+    subscribed = set()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.subscribed.discard(self)
+
+    @classmethod
+    def tip(cls):
+        return len(cls.headers) - 1
+
+    @classmethod
+    def tip_notification(cls):
+        return {'hex': bh2u(cls.headers[-1]), 'height': cls.tip()}
+
+    async def handle_request(self, request):
+        await asyncio.sleep(self.rtt)
+        if request.method == 'server.version':
+            return ['ElectrumX stand-in', '1.4']
+        elif request.method in ('server.ping', 'blockchain.relayfee'):
+            return None
+        elif request.method in ('server.banner', 'server.donation_address'):
+            return ''
+        elif request.method in ('server.peers.subscribe', 'mempool.get_fee_histogram'):
+            return []
+        elif request.method == 'blockchain.estimatefee':
+            return -1
+        elif request.method == 'blockchain.headers.subscribe':
+            self.subscribed.add(self)
+            return self.tip_notification()
+        elif request.method == 'blockchain.block.header':
+            height = request.args[0]
+            return bh2u(self.headers[height])
+        elif request.method == 'blockchain.block.headers':
+            start_height, count = request.args[:2]
+            count = max(0, min(count, 2016, self.tip() - start_height + 1))
+            data = b''.join(self.headers[start_height:start_height + count])
+            return {'hex': bh2u(data), 'count': count, 'max': 2016}
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, f'unknown method {request.method}')
+
+    @classmethod
+    async def set_headers(cls, headers):
+        """Switches to 'headers' and announces the new tip."""
+        cls.headers = headers
+        for session in list(cls.subscribed):
+            await session.send_notification('blockchain.headers.subscribe', [cls.tip_notification()])
+
+
+class FsyncCounter:
+
+    def __init__(self):
+        self.count = 0
+        self._fsync = os.fsync
+
+    def __call__(self, fd):
+        self.count += 1
+        return self._fsync(fd)
+
+
+class Bench:
+
+    def __init__(self, headers, *, with_auxpow, catchup, reorg_depth, num_servers):
+        self.headers = headers
+        self.with_auxpow = with_auxpow
+        self.catchup = catchup
+        self.reorg_depth = reorg_depth
+        self.fsyncs = os.fsync = FsyncCounter()
+        self.server_loop = asyncio.new_event_loop()
+        threading.Thread(target=self.server_loop.run_forever, name='StandIn', daemon=True).start()
+        # one loopback address per server, as servers are told apart by host
+        self.servers = [aiorpcx.Server(StandInSession, f'127.0.0.{i + 1}', 0, loop=self.server_loop)
+                        for i in range(num_servers)]
+        for server in self.servers:
+            self.run_on_server(server.listen())
+        constants.net.DEFAULT_SERVERS = {
+            f'127.0.0.{i + 1}': {'t': str(server.server.sockets[0].getsockname()[1])}
+            for i, server in enumerate(self.servers)}
+
+    def run_on_server(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.server_loop).result()
+
+    def server_cpu_time(self):
+        async def thread_time():
+            return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+        return self.run_on_server(thread_time())
+
+    def measure(self, rtt, depth, phase, num_headers, start):
+        """Runs start(), then waits until the chain we follow has the
+        tip of the stand-in."""
+        cpu, server_cpu, fsyncs = time.process_time(), self.server_cpu_time(), self.fsyncs.count
+        t0 = time.time()
+        network = start()
+        tip = StandInSession.tip()
+        tip_hash = hash_header(deserialize_header(StandInSession.headers[tip][:HEADER_SIZE], tip))
+        deadline = t0 + SYNC_TIMEOUT
+        while True:
+            chain = network.blockchain()
+            try:
+                if chain.height() == tip and chain.get_hash(tip) == tip_hash:
+                    break
+            except MissingHeader:
+                pass
+            if time.time() > deadline:
+                raise Exception(f'{phase}: not synced after {SYNC_TIMEOUT} seconds, at {chain.height()} of {tip}')
+            time.sleep(0.005)
+        dt = time.time() - t0
+        cpu = time.process_time() - cpu - (self.server_cpu_time() - server_cpu)
+        print_msg("%8d %6d %8s %8d %10.2f %12.0f %8.2f %7d"
+                  % (rtt, depth, phase, num_headers, dt, num_headers / dt, cpu, self.fsyncs.count - fsyncs))
+        return network
+
+    def run(self, rtt, depth):
+        StandInSession.rtt = rtt / 1000
+        self.run_on_server(StandInSession.set_headers(self.headers))
+        data_dir = tempfile.mkdtemp()
+        network = None
+        try:
+            config = SimpleConfig({'electrum_path': data_dir, 'header_pipeline_depth': depth,
+                                   'server': '127.0.0.1:{}:t'.format(constants.net.DEFAULT_SERVERS['127.0.0.1']['t']),
+                                   'oneserver': len(self.servers) == 1, 'auto_connect': False})
+            blockchain.blockchains = {}
+
+            def start():
+                nonlocal network
+                network = Network(config)
+                network.start()
+                return network
+            self.measure(rtt, depth, 'initial', len(self.headers) - 1, start)
+
+            if self.catchup:
+                headers = extend_chain(StandInSession.headers, self.catchup, with_auxpow=self.with_auxpow)
+                self.measure(rtt, depth, 'catchup', self.catchup,
+                             lambda: self.run_on_server(StandInSession.set_headers(headers)) or network)
+
+            if self.reorg_depth:
+                fork_headers = StandInSession.headers[:-self.reorg_depth]
+                count = self.reorg_depth + 10
+                headers = extend_chain(fork_headers, count, with_auxpow=self.with_auxpow, salt=1)
+                self.measure(rtt, depth, 'reorg', count,
+                             lambda: self.run_on_server(StandInSession.set_headers(headers)) or network)
+        finally:
+            if network:
+                network.stop()
+            shutil.rmtree(data_dir)
+
+    def close(self):
+        async def close():
+            for server in self.servers:
+                await server.close()
+            for session in list(StandInSession.subscribed):
+                await session.close()
+        self.run_on_server(close())
+        self.server_loop.call_soon_threadsafe(self.server_loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark header sync against a local stand-in server.')
+    parser.add_argument('chunks', type=int, nargs='?', default=5, help='length of the synthetic chain, in chunks')
+    parser.add_argument('rtts', type=int, nargs='*', metavar='rtt', help=f'simulated round-trip times in ms (default: {RTTS})')
+    parser.add_argument('--depth', type=int, action='append', dest='depths', help=f'header_pipeline_depth to try, repeatable (default: {DEPTHS})')
+    parser.add_argument('--auxpow', action='store_true', help='give synthetic headers an auxpow, and allow auxpow from height 1 on')
+    parser.add_argument('--headers-file', help='serve a recorded chain instead of a synthetic one')
+    parser.add_argument('--mainnet', action='store_true', help='the recorded chain is a mainnet one, not regtest')
+    parser.add_argument('--catchup', type=int, default=2016 + 100, help='headers announced after the initial sync (0 to skip)')
+    parser.add_argument('--servers', type=int, default=1, help='number of stand-in servers to connect to')
+    parser.add_argument('--reorg-depth', type=int, default=100, help='depth of the fork switched to after catch-up (0 to skip)')
+    args = parser.parse_args()
+
+    if args.mainnet:
+        constants.set_mainnet()
+    else:
+        constants.set_regtest()
+    if args.auxpow:
+        # auxpow is only allowed from a height no synthetic chain gets to
+        auxpow.MIN_AUXPOW_HEIGHT = 1
+    if args.headers_file:
+        headers = read_headers_file(args.headers_file)
+    else:
+        headers = extend_chain([], args.chunks * 2016 - 1, with_auxpow=args.auxpow)
+
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    bench = Bench(headers, with_auxpow=args.auxpow, catchup=args.catchup, reorg_depth=args.reorg_depth,
+                  num_servers=args.servers)
+    try:
+        print_msg(f"{len(headers)} headers{' with auxpow' if args.auxpow else ''}, {args.servers} servers")
+        print_msg("%8s %6s %8s %8s %10s %12s %8s %7s"
+                  % ("rtt (ms)", "depth", "phase", "headers", "time (s)", "headers/s", "cpu (s)", "fsyncs"))
+        for rtt in args.rtts or RTTS:
+            for depth in args.depths or DEPTHS:
+                bench.run(rtt, depth)
+    finally:
+        bench.close()
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Compares the pure-Python scrypt PoW hash with the vectorized batch
+# kernel for a range of batch sizes, including n=1 (a new tip header),
+# and times scrypt_1024_1_1_80_many, which picks between them.
+#
+# usage: bench_scrypt.py [batch sizes...]
+
+import os
+import sys
+from timeit import default_timer
+
+from electrum_sct import scrypt
+from electrum_sct.util import print_msg
+
+
+def run(function, headers, repeat):
+    t0 = default_timer()
+    for i in range(repeat):
+        function(headers)
+    return (default_timer() - t0) / repeat / len(headers)
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [1, 2, 4, 8, 16, 64, 256]
+    print_msg("min batch size: %d" % scrypt.MIN_BATCH_SIZE)
+    print_msg("%6s %14s %14s %14s" % ("n", "pure ms/hash", "numpy ms/hash", "many ms/hash"))
+    for n in sizes:
+        headers = [os.urandom(80) for i in range(n)]
+        repeat = max(1, 4 // n)
+        pure = run(lambda hs: [scrypt.scrypt_1024_1_1_80(h) for h in hs], headers, repeat)
+        if scrypt.numpy is None:
+            vectorized = float('nan')
+        else:
+            vectorized = run(scrypt._scrypt_1024_1_1_80_numpy, headers, repeat)
+        many = run(scrypt.scrypt_1024_1_1_80_many, headers, repeat)
+        print_msg("%6d %14.2f %14.2f %14.2f" % (n, pure * 1000, vectorized * 1000, many * 1000))
@@ -18,6 +18,20 @@
 
 import hashlib
 import hmac
+from typing import Sequence, List
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of headers hashed in lockstep by the vectorized implementation.
+# The scratchpad needs 128 KiB per header, so this bounds memory use to
+# 32 MiB per batch.
+BATCH_SIZE = 256
+
+# Below this many headers, the vectorized setup costs more than it saves.
+MIN_BATCH_SIZE = 16
 
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, bytes) or len(header) != 80:
@@ -244,7 +258,104 @@ def _xor_salsa8_2(X):
     ]
 
 
+def scrypt_1024_1_1_80_many(headers: Sequence[bytes]) -> List[bytes]:
+    """Returns the scrypt PoW hashes of a sequence of 80-byte headers.
+    Uses a NumPy-vectorized Salsa20/8 that processes up to BATCH_SIZE
+    headers in lockstep; falls back to the pure-Python implementation
+    if NumPy is not available, or for fewer than MIN_BATCH_SIZE headers.
+    """
+    if numpy is None or len(headers) < MIN_BATCH_SIZE:
+        return [scrypt_1024_1_1_80(header) for header in headers]
+    result = []
+    for i in range(0, len(headers), BATCH_SIZE):
+        result.extend(_scrypt_1024_1_1_80_numpy(headers[i:i+BATCH_SIZE]))
+    return result
+
+def _scrypt_1024_1_1_80_numpy(headers):
+    for header in headers:
+        if not isinstance(header, bytes) or len(header) != 80:
+            raise ValueError('header must be 80 bytes')
+    n = len(headers)
+    if n == 0:
+        return []
+
+    # X[i] holds word i of the scrypt state for every header (one per column)
+    B = b''.join(hashlib.pbkdf2_hmac('sha256', header, header, 1, 128) for header in headers)
+    X = numpy.frombuffer(B, dtype='<u4').reshape(n, 32).T.astype(numpy.uint32)
+    V = numpy.empty((1024, 32, n), dtype=numpy.uint32)
+    lanes = numpy.arange(n)
+
+    for i in range(1024):
+        V[i] = X
+        _xor_salsa8_2_numpy(X)
+
+    for i in range(1024):
+        k = X[16] & 1023
+        X ^= V[k, :, lanes].T
+        _xor_salsa8_2_numpy(X)
+
+    B = X.T.astype('<u4').tobytes()
+    return [hashlib.pbkdf2_hmac('sha256', header, B[j*128:(j+1)*128], 1, 32)
+            for j, header in enumerate(headers)]
+
+def _xor_salsa8_2_numpy(X):
+    X[0:16] ^= X[16:32]
+    _salsa20_8_numpy(X[0:16])
+    X[16:32] ^= X[0:16]
+    _salsa20_8_numpy(X[16:32])
+
+def _salsa20_8_numpy(B):
+    [
+        t00, t01, t02, t03, t04, t05, t06, t07,
+        t08, t09, t10, t11, t12, t13, t14, t15
+    ] = [row.copy() for row in B]
+
+    def R(a, b):
+        return (a << numpy.uint32(b)) | (a >> numpy.uint32(32 - b))
+
+    for j in range(4):
+        t04 ^= R(t00+t12, 7)
+        t08 ^= R(t04+t00, 9)
+        t12 ^= R(t08+t04, 13)
+        t00 ^= R(t12+t08, 18)
+        t09 ^= R(t05+t01, 7)
+        t13 ^= R(t09+t05, 9)
+        t01 ^= R(t13+t09, 13)
+        t05 ^= R(t01+t13, 18)
+        t14 ^= R(t10+t06, 7)
+        t02 ^= R(t14+t10, 9)
+        t06 ^= R(t02+t14, 13)
+        t10 ^= R(t06+t02, 18)
+        t03 ^= R(t15+t11, 7)
+        t07 ^= R(t03+t15, 9)
+        t11 ^= R(t07+t03, 13)
+        t15 ^= R(t11+t07, 18)
+        t01 ^= R(t00+t03, 7)
+        t02 ^= R(t01+t00, 9)
+        t03 ^= R(t02+t01, 13)
+        t00 ^= R(t03+t02, 18)
+        t06 ^= R(t05+t04, 7)
+        t07 ^= R(t06+t05, 9)
+        t04 ^= R(t07+t06, 13)
+        t05 ^= R(t04+t07, 18)
+        t11 ^= R(t10+t09, 7)
+        t08 ^= R(t11+t10, 9)
+        t09 ^= R(t08+t11, 13)
+        t10 ^= R(t09+t08, 18)
+        t12 ^= R(t15+t14, 7)
+        t13 ^= R(t12+t15, 9)
+        t14 ^= R(t13+t12, 13)
+        t15 ^= R(t14+t13, 18)
+
+    B += [
+        t00, t01, t02, t03, t04, t05, t06, t07,
+        t08, t09, t10, t11, t12, t13, t14, t15
+    ]
 
+
+# Benchmark: python3 -m electrum_sct.scrypt [number of headers]
+# (run as a module, so that "import scrypt" below finds the C package
+# rather than this file)
 if __name__ == '__main__':
     from binascii import unhexlify
 
@@ -257,11 +368,39 @@ if __name__ == '__main__':
     ]
 
     from timeit import default_timer
-    t0 = default_timer()
+    import os
+    import sys
+
+    def report(name, dt, count):
+        dt = dt / count
+        print("%-10s %8.2f ms/hash %10.2f hash/s" % (name, dt*1000, 1.0 / dt))
 
+    t0 = default_timer()
     for header, hash in vectors:
         assert scrypt_1024_1_1_80(unhexlify(header)) == unhexlify(hash)
+    report("pure", default_timer() - t0, len(vectors))
+
+    # a chunk's worth of headers (or fewer, if given on the command line)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2016
+    headers = [unhexlify(header) for header, hash in vectors]
+    headers += [os.urandom(80) for i in range(count - len(headers))]
+
+    if numpy is None:
+        print("vectorized: numpy not available")
+    else:
+        t0 = default_timer()
+        hashes = scrypt_1024_1_1_80_many(headers)
+        report("vectorized", default_timer() - t0, count)
+        for (header, hash), h in zip(vectors, hashes):
+            assert h == unhexlify(hash)
 
-    dt = (default_timer() - t0) / len(vectors)
-    print("%.1f ms/hash" % (dt*1000))
-    print("%.2f hash/s" % (1.0 / dt))
+    try:
+        import scrypt
+    except ImportError:
+        print("C:         package scrypt not available")
+    else:
+        t0 = default_timer()
+        c_hashes = [scrypt.hash(x, x, N=1024, r=1, p=1, buflen=32) for x in headers]
+        report("C", default_timer() - t0, count)
+        if numpy is not None:
+            assert c_hashes == hashes
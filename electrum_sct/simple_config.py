@@ -282,6 +282,22 @@ class SimpleConfig(PrintError):
     def get_session_timeout(self):
         return self.get('session_timeout', 300)
 
+    def get_header_verification_processes(self) -> int:
+        """Number of worker processes used to verify header chunks.
+        0 or 1 verifies them in this process; -1 uses one per CPU.
+        """
+        n = int(self.get('header_verification_processes', 0))
+        if n < 0:
+            n = os.cpu_count() or 1
+        return n
+
+    def get_name_prefetch_depth(self) -> int:
+        """Number of most recent blocks whose checkpointed chunks are
+        downloaded ahead of name lookups. Defaults to the name
+        expiration depth; 0 disables prefetching.
+        """
+        return max(0, int(self.get('name_prefetch_depth', 36000)))
+
     def open_last_wallet(self):
         if self.get('wallet_path') is None:
             last_wallet = self.get('gui_last_wallet')
@@ -24,10 +24,11 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING
+import time
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 from collections import defaultdict
 
-from aiorpcx import TaskGroup, run_in_thread
+from aiorpcx import run_in_thread
 
 from .transaction import Transaction
 from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer
@@ -42,12 +43,18 @@ if TYPE_CHECKING:
 class SynchronizerFailure(Exception): pass
 
 
+def tx_fetch_priority(tx_height: int) -> Tuple[int, int]:
+    # unconfirmed transactions first, then the newest: recent transactions
+    # are the most likely to have unspent outputs, that the balance needs
+    if tx_height <= 0:
+        return 0, 0
+    return 1, -tx_height
+
+
 def history_status(h):
     if not h:
         return None
-    status = ''
-    for tx_hash, height in h:
-        status += tx_hash + ':%d:' % height
+    status = ''.join(tx_hash + ':%d:' % height for tx_hash, height in h)
     return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
 
@@ -57,6 +64,10 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     """
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
+        # set when there might be work for main(); made once, so that
+        # wakeup() can be called before the first _reset()
+        asyncio.set_event_loop(network.asyncio_loop)
+        self._wakeup = asyncio.Event()
         NetworkJobOnDefaultServer.__init__(self, network)
 
     def _reset(self):
@@ -67,6 +78,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         # Queues
         self.add_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
+        self._wakeup.clear()
 
     async def _start_tasks(self):
         try:
@@ -81,26 +93,52 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     def add(self, addr):
         asyncio.run_coroutine_threadsafe(self._add_address(addr), self.asyncio_loop)
 
+    def wakeup(self):
+        """Makes main() check the state of the wallet again. Thread-safe."""
+        self.asyncio_loop.call_soon_threadsafe(lambda: self._wakeup.set())
+
     async def _add_address(self, addr: str):
         if not is_address(addr): raise ValueError(f"invalid smartcryptotech address {addr}")
         if addr in self.requested_addrs: return
         self.requested_addrs.add(addr)
         await self.add_queue.put(addr)
+        self._wakeup.set()
 
     async def _on_address_status(self, addr, status):
         """Handle the change of the status of an address."""
         raise NotImplementedError()  # implemented by subclasses
 
-    async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            self.requested_addrs.remove(addr)
+    def get_subscription_batch_size(self) -> int:
+        """Number of addresses subscribed to in one JSON-RPC batch."""
+        return max(1, int(self.network.config.get('subscription_batch_size', 100)))
+
+    def get_subscription_rate_limit(self) -> float:
+        """Addresses subscribed to per second at most, 0 for no limit."""
+        return max(0, float(self.network.config.get('subscription_rate_limit', 1000)))
 
+    async def send_subscriptions(self):
+        async def subscribe_to_addresses(addrs):
+            hashes = []
+            for addr in addrs:
+                h = address_to_scripthash(addr)
+                self.scripthash_to_address[h] = addr
+                hashes.append(h)
+            await self.session.subscribe_many('blockchain.scripthash.subscribe',
+                                              [[h] for h in hashes], self.status_queue)
+            self.requested_addrs.difference_update(addrs)
+            self._wakeup.set()
+
+        # addresses added while a batch is in flight make up the next one
+        batch_size = self.get_subscription_batch_size()
+        rate_limit = self.get_subscription_rate_limit()
         while True:
-            addr = await self.add_queue.get()
-            await self.group.spawn(subscribe_to_address, addr)
+            addrs = [await self.add_queue.get()]
+            while len(addrs) < batch_size and not self.add_queue.empty():
+                addrs.append(self.add_queue.get_nowait())
+            start = time.monotonic()
+            await subscribe_to_addresses(addrs)
+            if rate_limit:
+                await asyncio.sleep(len(addrs) / rate_limit - (time.monotonic() - start))
 
     async def handle_status(self):
         while True:
@@ -108,6 +146,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             addr = self.scripthash_to_address[h]
             await self.group.spawn(self._on_address_status, addr, status)
             self._processed_some_notifications = True
+            self._wakeup.set()
 
     async def main(self):
         raise NotImplementedError()  # implemented by subclasses
@@ -123,12 +162,18 @@ class Synchronizer(SynchronizerBase):
     '''
     def __init__(self, wallet: 'AddressSynchronizer'):
         self.wallet = wallet
+        # addr -> (history list, its length, status), see get_local_status
+        self._status_cache = {}  # type: Dict[str, tuple]
         SynchronizerBase.__init__(self, wallet.network)
 
     def _reset(self):
         super()._reset()
         self.requested_tx = {}
         self.requested_histories = {}
+        # (priority, tx_hash, allow_server_not_finding_tx) of the requested
+        # transactions that have not been sent to the server yet
+        self.tx_queue = asyncio.PriorityQueue()
+        self._tx_fetched = self._tx_fetch_total = self._tx_fetch_bytes = 0
 
     def diagnostic_name(self):
         return '{}:{}'.format(self.__class__.__name__, self.wallet.diagnostic_name())
@@ -138,9 +183,20 @@ class Synchronizer(SynchronizerBase):
                 and not self.requested_histories
                 and not self.requested_tx)
 
-    async def _on_address_status(self, addr, status):
+    def get_local_status(self, addr):
+        """history_status of the history the wallet has for addr. Cached as
+        long as the wallet keeps the same history list, which it replaces
+        when the history changes."""
         history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
+        cached = self._status_cache.get(addr)
+        if cached and cached[0] is history and cached[1] == len(history):
+            return cached[2]
+        status = history_status(history)
+        self._status_cache[addr] = (history, len(history), status)
+        return status
+
+    async def _on_address_status(self, addr, status):
+        if self.get_local_status(addr) == status:
             return
         if addr in self.requested_histories:
             return
@@ -163,38 +219,101 @@ class Synchronizer(SynchronizerBase):
         else:
             # Store received history
             self.wallet.receive_history_callback(addr, hist, tx_fees)
+            # its status is the one we just checked
+            history = self.wallet.db.get_addr_history(addr)
+            self._status_cache[addr] = (history, len(history), status)
             # Request transactions we don't have
             await self._request_missing_txs(hist)
 
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
+        self._wakeup.set()
+
+    def get_tx_fetch_concurrency(self) -> int:
+        """Number of transaction requests (or batches) kept in flight."""
+        return max(1, int(self.network.config.get('tx_fetch_concurrency', 4)))
+
+    def get_tx_fetch_batch_size(self) -> int:
+        """Number of transactions asked for in one JSON-RPC batch."""
+        return max(1, int(self.network.config.get('tx_fetch_batch_size', 10)))
+
+    def get_tx_fetch_progress(self) -> dict:
+        """Progress of the transactions requested since the last time
+        none were pending. 'bytes' is the size of the raw transactions."""
+        return {'fetched': self._tx_fetched, 'total': self._tx_fetch_total, 'bytes': self._tx_fetch_bytes}
+
+    def _trigger_tx_fetch_progress(self):
+        self.network.trigger_callback('tx_fetch_progress', self.wallet,
+                                      self._tx_fetched, self._tx_fetch_total, self._tx_fetch_bytes)
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
-        transaction_hashes = []
+        missing = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if self.wallet.db.get_transaction(tx_hash):
                 continue
-            transaction_hashes.append(tx_hash)
-            self.requested_tx[tx_hash] = tx_height
+            missing.append((tx_hash, tx_height))
 
-        if not transaction_hashes: return
-        async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
-
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        try:
-            result = await self.network.get_transaction(tx_hash)
-        except UntrustedServerReturnedError as e:
+        if not missing: return
+        if not self.requested_tx:
+            self._tx_fetched = self._tx_fetch_total = self._tx_fetch_bytes = 0
+        for tx_hash, tx_height in missing:
+            self.requested_tx[tx_hash] = tx_height
+            self.tx_queue.put_nowait((tx_fetch_priority(tx_height), tx_hash, allow_server_not_finding_tx))
+        self._tx_fetch_total += len(missing)
+        self._trigger_tx_fetch_progress()
+
+    async def _fetch_transactions(self):
+        """Takes transactions from tx_queue, most urgent first, and
+        requests up to tx_fetch_batch_size of them at once."""
+        batch_size = self.get_tx_fetch_batch_size()
+        while True:
+            items = [await self.tx_queue.get()]
+            while len(items) < batch_size and not self.tx_queue.empty():
+                items.append(self.tx_queue.get_nowait())
+            # another wallet of the daemon might have them already
+            stored = await run_in_thread(self._read_stored_transactions, [tx_hash for _, tx_hash, _ in items])
+            missing = [tx_hash for (_, tx_hash, _), raw in zip(items, stored) if raw is None]
+            fetched = iter(await self.network.get_transactions(missing) if missing else [])
+            to_store = []
+            for (_, tx_hash, allow_server_not_finding_tx), raw in zip(items, stored):
+                result = raw if raw is not None else next(fetched)
+                if self._receive_transaction(tx_hash, result, allow_server_not_finding_tx=allow_server_not_finding_tx) \
+                        and raw is None:
+                    to_store.append((tx_hash, result))
+            self._trigger_tx_fetch_progress()
+            if to_store:
+                await run_in_thread(self._store_transactions, to_store)
+
+    def _read_stored_transactions(self, tx_hashes: List[str]) -> List[Optional[str]]:
+        # the store is a directory shared by all wallets; don't trust its contents
+        stored = []
+        for tx_hash in tx_hashes:
+            raw = self.network.tx_store.get(tx_hash)
+            if raw is not None and Transaction(raw).txid() != tx_hash:
+                self.print_error(f"dropping stored tx with wrong txid for {tx_hash}")
+                self.network.tx_store.discard(tx_hash)
+                raw = None
+            stored.append(raw)
+        return stored
+
+    def _store_transactions(self, txs: List[Tuple[str, str]]) -> None:
+        for tx_hash, raw in txs:
+            self.network.tx_store.put(tx_hash, raw)
+
+    def _receive_transaction(self, tx_hash, result, *, allow_server_not_finding_tx=False) -> bool:
+        self._tx_fetched += 1
+        if isinstance(result, UntrustedServerReturnedError):
             # most likely, "No such mempool or blockchain transaction"
             if allow_server_not_finding_tx:
                 self.requested_tx.pop(tx_hash)
-                return
+                self._wakeup.set()
+                return False
             else:
-                raise
+                raise result
+        self._tx_fetch_bytes += len(result) // 2
         tx = Transaction(result)
         try:
             tx.deserialize()  # see if raises
@@ -209,12 +328,16 @@ class Synchronizer(SynchronizerBase):
             raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
         tx_height = self.requested_tx.pop(tx_hash)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        self._wakeup.set()
         self.print_error(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.raw)}")
         # callbacks
         self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
+        return True
 
     async def main(self):
         self.wallet.set_up_to_date(False)
+        for i in range(self.get_tx_fetch_concurrency()):
+            await self.group.spawn(self._fetch_transactions())
         # request missing txns, if any
         for addr in self.wallet.db.get_history():
             history = self.wallet.db.get_addr_history(addr)
@@ -225,9 +348,12 @@ class Synchronizer(SynchronizerBase):
         # add addresses to bootstrap
         for addr in self.wallet.get_addresses():
             await self._add_address(addr)
-        # main loop
+        # main loop: woken up when addresses are added, subscriptions
+        # are made, and histories or transactions are received
+        self._wakeup.set()
         while True:
-            await asyncio.sleep(0.1)
+            await self._wakeup.wait()
+            self._wakeup.clear()
             await run_in_thread(self.wallet.synchronize)
             up_to_date = self.is_up_to_date()
             if (up_to_date != self.wallet.is_up_to_date()
@@ -1,4 +1,5 @@
 from electrum_sct import auxpow, blockchain, constants
+from electrum_sct.transaction import Transaction
 from electrum_sct.util import bfh
 
 from . import SequentialTestCase
@@ -9,6 +10,9 @@ smartcryptotech_header_37174 = '01010100d681bfa4acb5e0dc772a0099ce069ae4841ee229
 
 class Test_auxpow(SequentialTestCase):
 
+    # the height passed to deserialize_header for auxpow to be parsed
+    AUXPOW_HEIGHT = max(auxpow.MIN_AUXPOW_HEIGHT, constants.net.max_checkpoint() + 1)
+
     # Deserialize the AuxPoW header from SmartCryptoTech block #37,174.
     # This height was chosen because it has large, non-equal lengths of the
     # coinbase and chain Merkle branches.
@@ -57,3 +61,96 @@ class Test_auxpow(SequentialTestCase):
         observed_parent_merkle_root = header_auxpow['parent_header']['merkle_root']
         self.assertEqual(expected_parent_merkle_root, observed_parent_merkle_root)
 
+    def test_parse_auxpow_header(self):
+        header_bytes = bfh(smartcryptotech_header_37174)
+        header = blockchain.deserialize_header(header_bytes, self.AUXPOW_HEIGHT)
+        header_auxpow = header['auxpow']
+
+        # this block is merge-mined with chain ID 1
+        self.assertEqual(1, header_auxpow.chain_id)
+
+        expected_coinbase_txid = '8a3164be45a621f85318647d425fe9f45837b8e42ec4fdd902d7f64daf61ff4a'
+        observed_coinbase_txid = auxpow.hash_encode(header_auxpow.coinbase_txid)
+
+        self.assertEqual(expected_coinbase_txid, observed_coinbase_txid)
+
+        coinbase_merkle_branch = [auxpow.hash_encode(h) for h in header_auxpow.coinbase_merkle_branch]
+        self.assertEqual(5, len(coinbase_merkle_branch))
+        self.assertEqual('f8f27314022a5165ae122642babb28dd44191dd36f99dad80b4f16b75197dde0', coinbase_merkle_branch[0])
+        self.assertEqual('c8a9dc420e17dee7b04bc0174c7a37ed9e5bc3f0ea0fdfe0b5d24bfc19ecedb0', coinbase_merkle_branch[1])
+        self.assertEqual('0ce9c5b98e212527e4aa7b9298435dc4e8f4dfc4dc63b7c89c06300637c33620', coinbase_merkle_branch[2])
+        self.assertEqual('3b6d0c4122a5b047cb879a440461839f0446f6bd451f01c6f0b14b6624e84136', coinbase_merkle_branch[3])
+        self.assertEqual('458500be38a68b215112df5e52d9c08fdd52034fb2005ce15d2a42be28e436cb', coinbase_merkle_branch[4])
+
+        coinbase_merkle_index = header_auxpow.coinbase_merkle_index
+        self.assertEqual(0, coinbase_merkle_index)
+
+        chain_merkle_branch = [auxpow.hash_encode(h) for h in header_auxpow.chain_merkle_branch]
+        self.assertEqual(4, len(chain_merkle_branch))
+        self.assertEqual('000000000000000000000000000000000000000000000000000000000000000a', chain_merkle_branch[0])
+        self.assertEqual('65bd8eb2c7e3a3646507977e8659e5396b197f197fbb51e7158927a263798302', chain_merkle_branch[1])
+        self.assertEqual('5f961bb13289d705abb28376a01f7097535c95f87b9e719b9ec39d8eb20d72e9', chain_merkle_branch[2])
+        self.assertEqual('7cb5fdcc41120d6135a40a6753bddc0c9b675ba2936d2e0cd78cdcb02e6beb50', chain_merkle_branch[3])
+
+        chain_merkle_index = header_auxpow.chain_merkle_index
+        self.assertEqual(11, chain_merkle_index)
+
+        expected_parent_hash = '00000000000024111173f561b36ad4906df95f52503a79332d7f540c2a57db84'
+        observed_parent_hash = header_auxpow.parent_hash()
+        self.assertEqual(expected_parent_hash, observed_parent_hash)
+
+        expected_parent_header = blockchain.deserialize_header(bfh('0100000055a7bc918827dbe7d8027781d803f4b418589b7b9fc03e718a03000000000000625a3d6dc4dfb0ab25f450cd202ff3bdb074f2edde1ddb4af5217e10c9dbafb9639a0a4fd7690d1a25aeaa97'), 1)
+        expected_parent_merkle_root = expected_parent_header['merkle_root']
+        observed_parent_merkle_root = auxpow.hash_encode(header_auxpow.parent_merkle_root())
+        self.assertEqual(expected_parent_merkle_root, observed_parent_merkle_root)
+
+    def test_parse_auxpow_header_matches_transaction_parser(self):
+        header_bytes = bfh(smartcryptotech_header_37174)
+        base_header = blockchain.deserialize_header(header_bytes[:80], 0)
+        header_auxpow, end_position = auxpow.parse_auxpow_header(base_header, header_bytes, start_position=80)
+        coinbase_tx = Transaction(None, expect_trailing_data=True, raw_bytes=header_bytes, expect_trailing_bytes=True, copy_input=False, start_position=80)
+        coinbase_tx_dict, coinbase_end_position = auxpow.fast_tx_deserialize(coinbase_tx)
+
+        self.assertEqual(len(header_bytes), end_position)
+        self.assertEqual(header_bytes[80:coinbase_end_position], header_auxpow.coinbase_tx)
+        self.assertEqual(auxpow.fast_txid(coinbase_tx), auxpow.hash_encode(header_auxpow.coinbase_txid))
+        self.assertEqual(coinbase_tx.inputs()[0]['scriptSig'], header_auxpow.coinbase_script_sig.hex())
+
+        with self.assertRaises(auxpow.SerializationError):
+            auxpow.parse_auxpow_header(base_header, header_bytes[:-1], start_position=80)
+        with self.assertRaises(auxpow.SerializationError):
+            auxpow.parse_auxpow_header(base_header, header_bytes[:200], start_position=80)
+
+    def test_auxpow_dict_access(self):
+        header_bytes = bfh(smartcryptotech_header_37174)
+        header_auxpow = blockchain.deserialize_header(header_bytes, self.AUXPOW_HEIGHT)['auxpow']
+
+        self.assertEqual(['chain_id', 'parent_coinbase_tx', 'coinbase_merkle_branch', 'coinbase_merkle_index',
+                          'chain_merkle_branch', 'chain_merkle_index', 'parent_header'], list(header_auxpow))
+        self.assertEqual(1, header_auxpow['chain_id'])
+        self.assertEqual('8a3164be45a621f85318647d425fe9f45837b8e42ec4fdd902d7f64daf61ff4a',
+                         auxpow.fast_txid(header_auxpow['parent_coinbase_tx']))
+        self.assertEqual('f8f27314022a5165ae122642babb28dd44191dd36f99dad80b4f16b75197dde0',
+                         header_auxpow['coinbase_merkle_branch'][0])
+        self.assertEqual(0, header_auxpow['coinbase_merkle_index'])
+        self.assertEqual('7cb5fdcc41120d6135a40a6753bddc0c9b675ba2936d2e0cd78cdcb02e6beb50',
+                         header_auxpow['chain_merkle_branch'][3])
+        self.assertEqual(11, header_auxpow['chain_merkle_index'])
+        parent_header = header_auxpow['parent_header']
+        self.assertEqual('00000000000024111173f561b36ad4906df95f52503a79332d7f540c2a57db84',
+                         blockchain.hash_header(parent_header))
+        self.assertNotIn('block_height', parent_header)
+        self.assertIsNone(header_auxpow.get('parent_block_hash'))
+        with self.assertRaises(KeyError):
+            header_auxpow['parent_block_hash']
+
+    def test_verify_auxpow(self):
+        header_bytes = bfh(smartcryptotech_header_37174)
+        header = blockchain.deserialize_header(header_bytes, self.AUXPOW_HEIGHT)
+        # merge-mined with chain ID 1, which is not our CHAIN_ID: the chain
+        # merkle root is found, but not at the index our chain ID gives
+        with self.assertRaisesRegex(Exception, 'Aux POW wrong index'):
+            auxpow.verify_auxpow(header)
+        header['nonce'] += 1
+        with self.assertRaisesRegex(Exception, 'Aux POW missing chain merkle root'):
+            auxpow.verify_auxpow(header)
@@ -1,10 +1,14 @@
+import json
+import pickle
+import random
 import shutil
 import tempfile
 import os
+from unittest import mock
 
-from electrum_sct import constants, blockchain
+from electrum_sct import constants, blockchain, util
 from electrum_sct.simple_config import SimpleConfig
-from electrum_sct.blockchain import Blockchain, deserialize_header, hash_header
+from electrum_sct.blockchain import Blockchain, BlockHeader, deserialize_header, hash_header
 from electrum_sct.util import bh2u, bfh, make_dir
 
 from . import SequentialTestCase
@@ -237,3 +241,536 @@ class TestBlockchain(SequentialTestCase):
 
         for b in (chain_u, chain_l, chain_z):
             self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
+
+    def test_read_header_sees_truncating_write(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+
+        self._append_header(chain_u, self.HEADERS['A'])
+        self._append_header(chain_u, self.HEADERS['B'])
+        self._append_header(chain_u, self.HEADERS['C'])
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+
+        # rewrite the tip with a header from another branch
+        chain_u.write(bfh(blockchain.serialize_header(self.HEADERS['B'])), 2 * 80)
+        self.assertEqual(2, chain_u.height())
+        self.assertEqual(hash_header(self.HEADERS['B']), hash_header(chain_u.read_header(2)))
+
+        chain_u.write(b'', 1 * 80)
+        self.assertEqual(0, chain_u.height())
+        self.assertEqual(None, chain_u.read_header(1))
+        self.assertEqual(self.HEADERS['A'], chain_u.read_header(0))
+
+    def test_header_cache(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+
+        self._append_header(chain_u, self.HEADERS['A'])
+        self._append_header(chain_u, self.HEADERS['B'])
+        self._append_header(chain_u, self.HEADERS['C'])
+
+        misses = chain_u.get_header_cache_stats()['misses']
+        hits = chain_u.get_header_cache_stats()['hits']
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+        stats = chain_u.get_header_cache_stats()
+        self.assertEqual(hits + 2, stats['hits'])
+        self.assertEqual(misses + 1, stats['misses'])
+
+        # modifying a returned header must not affect the cache
+        chain_u.read_header(2)['nonce'] = 42
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+
+        # overwriting the tip invalidates it
+        chain_u.write(bfh(blockchain.serialize_header(self.HEADERS['B'])), 2 * 80)
+        self.assertEqual(hash_header(self.HEADERS['B']), hash_header(chain_u.read_header(2)))
+        self.assertEqual(hash_header(self.HEADERS['B']), hash_header(chain_u.read_header(1)))
+
+    def test_hash_index(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+
+        for name in 'ABCDEFO':
+            self._append_header(chain_u, self.HEADERS[name])
+        self.assertEqual(7 * 32, os.stat(chain_u.hashes_path()).st_size)
+        self.assertEqual(hash_header(self.HEADERS['C']), chain_u._read_indexed_hash(2))
+
+        # a missing or stale index is rebuilt
+        chain_u.delete_hash_index()
+        self.assertEqual(hash_header(self.HEADERS['B']), chain_u.get_hash(1))
+        self.assertEqual(7 * 32, os.stat(chain_u.hashes_path()).st_size)
+        with open(chain_u.hashes_path(), 'r+b') as f:
+            f.seek(6 * 32)
+            f.write(bytes(range(32)))
+        chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains[constants.net.GENESIS] = chain_u
+        self.assertEqual(hash_header(self.HEADERS['O']), chain_u.get_hash(6))
+
+        # forks have their own index, which moves with them when swapping
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        self.assertEqual(1 * 32, os.stat(chain_l.hashes_path()).st_size)
+        self.assertEqual(hash_header(self.HEADERS['G']), chain_l._read_indexed_hash(6))
+        self.assertEqual(hash_header(self.HEADERS['F']), chain_l._read_indexed_hash(5))
+        self._append_header(chain_l, self.HEADERS['H'])
+
+        self.assertEqual(None, chain_l.parent)
+        self.assertEqual(8 * 32, os.stat(chain_l.hashes_path()).st_size)
+        self.assertEqual(1 * 32, os.stat(chain_u.hashes_path()).st_size)
+        self.assertEqual(hash_header(self.HEADERS['H']), chain_l._read_indexed_hash(7))
+        self.assertEqual(hash_header(self.HEADERS['O']), chain_u._read_indexed_hash(6))
+        self.assertEqual(hash_header(self.HEADERS['F']), chain_u._read_indexed_hash(5))
+
+    def test_header_routing_indexes(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOP':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        self._append_header(chain_l, self.HEADERS['H'])
+
+        self.assertEqual(chain_u, blockchain.check_header(self.HEADERS['C']))
+        self.assertEqual(chain_u, blockchain.check_header(self.HEADERS['P']))
+        self.assertEqual(chain_l, blockchain.check_header(self.HEADERS['G']))
+        self.assertEqual(chain_l, blockchain.check_header(self.HEADERS['H']))
+        self.assertEqual(None, blockchain.check_header(self.HEADERS['I']))
+        self.assertEqual(chain_u, blockchain.can_connect(self.HEADERS['Q']))
+        self.assertEqual(chain_l, blockchain.can_connect(self.HEADERS['I']))
+        self.assertEqual(None, blockchain.can_connect(self.HEADERS['J']))
+
+        # chain_l becomes the best chain
+        self._append_header(chain_l, self.HEADERS['I'])
+        self.assertEqual(None, chain_l.parent)
+        self.assertEqual(chain_l, blockchain.check_header(self.HEADERS['C']))
+        self.assertEqual(chain_l, blockchain.check_header(self.HEADERS['G']))
+        self.assertEqual(chain_u, blockchain.check_header(self.HEADERS['O']))
+        self.assertEqual(chain_u, blockchain.check_header(self.HEADERS['P']))
+        self.assertEqual(chain_u, blockchain.can_connect(self.HEADERS['Q']))
+        self.assertEqual(chain_l, blockchain.can_connect(self.HEADERS['J']))
+
+        # and the same after loading the chains from disk
+        blockchain.blockchains = {}
+        blockchain.read_blockchains(self.config)
+        self.assertEqual(2, len(blockchain.blockchains))
+        chain_l = blockchain.get_best_chain()
+        chain_u = blockchain.blockchains[hash_header(self.HEADERS['O'])]
+        self.assertEqual(chain_l, blockchain.check_header(self.HEADERS['H']))
+        self.assertEqual(chain_u, blockchain.check_header(self.HEADERS['P']))
+        self.assertEqual(chain_u, blockchain.can_connect(self.HEADERS['Q']))
+        self.assertEqual(chain_l, blockchain.can_connect(self.HEADERS['J']))
+
+    def test_verify_chunk_in_process_pool(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        self._append_header(chain_u, self.HEADERS['A'])
+        data = b''.join(bfh(blockchain.serialize_header(self.HEADERS[name])) for name in 'ABCDEFOPQRSTU')
+
+        self.assertEqual([(0, data[:5*80]), (5, data[5*80:10*80]), (10, data[10*80:])],
+                         blockchain.split_chunk(0, data, 3))
+        self.assertEqual(data, chain_u.verify_chunk(0, data))
+        self.config.set_key('header_verification_processes', 3)
+        try:
+            self.assertEqual(data, chain_u.verify_chunk(0, data))
+            # linkage is checked across the runs verified by different workers
+            bad_data = data[:5*80] + data[6*80:]
+            with self.assertRaises(Exception):
+                chain_u.verify_chunk(0, bad_data)
+        finally:
+            self.config.set_key('header_verification_processes', 0)
+            self.assertIsNone(blockchain.get_verification_pool(self.config))
+
+    def test_group_commit(self):
+        self.config.set_key('header_fsync_delay', 60)
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            for name in 'ABCDEFO':
+                self._append_header(chain_u, self.HEADERS[name])
+            self.assertEqual(0, fsync.call_count)
+            # unsynced headers are still visible
+            self.assertEqual(self.HEADERS['O'], chain_u.read_header(6))
+            chain_u.sync()
+            # the headers and their block hash index
+            self.assertEqual(2, fsync.call_count)
+            chain_u.sync()
+            self.assertEqual(2, fsync.call_count)
+            # the fork is synced before the files are swapped
+            chain_l = chain_u.fork(self.HEADERS['G'])
+            self._append_header(chain_l, self.HEADERS['H'])
+            self.assertEqual(None, chain_l.parent)
+            self.assertFalse(chain_l._unsynced or chain_u._unsynced)
+        # the delay is an upper bound
+        self.config.set_key('header_fsync_delay', 0.01)
+        self._append_header(chain_l, self.HEADERS['I'])
+        self.assertTrue(chain_l._unsynced)
+        chain_l._sync_timer.join()
+        self.assertFalse(chain_l._unsynced)
+
+    def test_torn_headers_dropped_on_load(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        header_o = bfh(blockchain.serialize_header(self.HEADERS['O']))
+        header_p = bfh(blockchain.serialize_header(self.HEADERS['P']))
+
+        def crash_and_reload(tail: bytes) -> Blockchain:
+            with open(chain_u.path(), 'r+b') as f:
+                f.truncate(6 * 80)
+                f.seek(6 * 80)
+                f.write(tail)
+            chain = Blockchain(
+                config=self.config, forkpoint=0, parent=None,
+                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+            blockchain.blockchains[constants.net.GENESIS] = chain
+            self.assertEqual(0, os.path.getsize(chain.path()) % 80)
+            return chain
+
+        # partial header at the end
+        chain = crash_and_reload(header_o[:40])
+        self.assertEqual(5, chain.height())
+        self.assertEqual(6 * 80, os.path.getsize(chain.path()))
+        # whole headers, but only partly written
+        chain = crash_and_reload(bytes(40) + header_o[40:] + header_p)
+        self.assertEqual(5, chain.height())
+        chain = crash_and_reload(header_o[:40] + bytes(40) + header_p)
+        self.assertEqual(6, chain.height())
+        # zeroes where headers should be
+        chain = crash_and_reload(header_o + bytes(80 * 2))
+        self.assertEqual(6, chain.height())
+        self.assertEqual(hash_header(self.HEADERS['O']), chain.get_hash(6))
+        self._append_header(chain, self.HEADERS['P'])
+        # headers that all link are kept
+        chain = crash_and_reload(header_o + header_p)
+        self.assertEqual(7, chain.height())
+        self.assertEqual(hash_header(self.HEADERS['P']), chain.get_hash(7))
+        # hashes of headers lost in the crash are dropped from the index
+        with open(chain.hashes_path(), 'ab') as f:
+            f.write(bytes.fromhex(hash_header(self.HEADERS['Q']))[::-1])
+        with mock.patch.object(Blockchain, '_rebuild_hash_index') as rebuild:
+            chain = crash_and_reload(header_o + header_p)
+            chain.get_hash(7)
+        self.assertFalse(rebuild.called)
+        self.assertEqual(8 * 32, os.path.getsize(chain.hashes_path()))
+        self.assertEqual(hash_header(self.HEADERS['P']), chain._read_indexed_hash(7))
+
+
+class TestBlockHeader(SequentialTestCase):
+
+    RAW = bfh("0000002006226e46111a0b59caaf126043eb5bbf28c34f3a5e332a1fc7b2b73cf188910f186c8dfd970a4545f79916bc1d75c9d00432f57c89209bf3bb115b7612848f509c25f45bffff7f2000000000")
+
+    def test_dict_compatibility(self):
+        header = deserialize_header(self.RAW, 1)
+        as_dict = {
+            'version': 0x20000000,
+            'prev_block_hash': '0f9188f13cb7b2c71f2a335e3a4fc328bf5beb436012afca590b1a11466e2206',
+            'merkle_root': '508f8412765b11bbf39b20897cf53204d0c9751dbc1699f745450a97fd8d6c18',
+            'timestamp': 1542727068,
+            'bits': 0x207fffff,
+            'nonce': 0,
+            'block_height': 1,
+        }
+        self.assertEqual(as_dict, dict(header))
+        self.assertEqual(header, as_dict)
+        self.assertEqual(as_dict, header)
+        self.assertEqual(as_dict['bits'], header['bits'])
+        self.assertEqual(as_dict['bits'], header.bits)
+        self.assertEqual(None, header.get('auxpow'))
+        self.assertNotIn('auxpow', header)
+        with self.assertRaises(KeyError):
+            header['auxpow']
+        with self.assertRaises(KeyError):
+            header['no such field'] = 1
+        header['auxpow'] = None
+        self.assertIn('auxpow', header)
+        self.assertEqual(None, header.pop('auxpow'))
+        self.assertEqual(sorted(as_dict), sorted(header))
+        self.assertEqual(hash_header(as_dict), hash_header(header))
+        self.assertEqual(blockchain.serialize_header(as_dict), blockchain.serialize_header(header))
+        self.assertEqual(as_dict, json.loads(util.json_encode(header)))
+
+    def test_hashes_are_cached_until_a_field_changes(self):
+        header = deserialize_header(self.RAW, 1)
+        header_hash = hash_header(header)
+        pow_hash = blockchain.pow_hash_header(header)
+        self.assertEqual(header_hash, header.hash())
+        self.assertEqual(pow_hash, header.pow_hash())
+        copy = header.copy()
+        self.assertEqual(header_hash, copy._hash)
+        copy['nonce'] = 1
+        self.assertNotEqual(header_hash, hash_header(copy))
+        self.assertNotEqual(pow_hash, blockchain.pow_hash_header(copy))
+        copy.nonce = 0
+        self.assertEqual(header_hash, hash_header(copy))
+        self.assertEqual(self.RAW, copy.raw())
+        # state, including cached hashes, survives pickling for worker processes
+        unpickled = pickle.loads(pickle.dumps(header))
+        self.assertEqual(header, unpickled)
+        self.assertEqual(pow_hash, unpickled._powhash)
+
+    def test_built_from_fields(self):
+        header = deserialize_header(self.RAW, 1)
+        self.assertEqual(header, BlockHeader(dict(header)))
+        self.assertEqual(header.hash(), BlockHeader(**dict(header)).hash())
+
+
+class SyntheticChainTestCase(SequentialTestCase):
+    """Starts each test with a chain of random, linked headers."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        make_dir(os.path.join(self.data_dir, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.data_dir})
+        blockchain.blockchains = {}
+        self.chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(self.chain.path(), 'w+').close()
+        self.rand = random.Random(2016)
+        self.headers = []
+        self._append_random_headers(4400)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.data_dir)
+
+    def _random_header(self, height, prev_hash, timestamp):
+        target = self.rand.randint(blockchain.MAX_TARGET // 20000, blockchain.MAX_TARGET // 5000)
+        return {
+            'version': 1,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '00' * 32,
+            'timestamp': timestamp,
+            'bits': self.chain.convbits(target),
+            'nonce': height,
+            'block_height': height,
+        }
+
+    def _random_spacing(self):
+        # mostly around the 30 second target, sometimes out of order or slow
+        r = self.rand.random()
+        if r < 0.05:
+            return self.rand.randint(-60, 0)
+        if r < 0.10:
+            return self.rand.randint(60, 600)
+        return self.rand.randint(15, 45)
+
+    def _random_branch(self, headers, count):
+        """Returns 'headers' followed by 'count' new ones."""
+        headers = list(headers)
+        for i in range(count):
+            height = len(headers)
+            if not headers:
+                headers.append(TestBlockchain.HEADERS['A'])  # regtest genesis
+                continue
+            prev_hash = hash_header(headers[-1])
+            timestamp = headers[-1]['timestamp'] + self._random_spacing()
+            headers.append(self._random_header(height, prev_hash, timestamp))
+        return headers
+
+    def _serialize(self, headers):
+        return b''.join(bfh(blockchain.serialize_header(header)) for header in headers)
+
+    def _append_random_headers(self, count):
+        offset = len(self.headers) * 80
+        self.headers = self._random_branch(self.headers, count)
+        self.chain.write(self._serialize(self.headers[offset // 80:]), offset)
+
+
+class TestKimotoGravityWell(SyntheticChainTestCase):
+
+    def _assert_matches_reference(self, calculator, heights):
+        for height in heights:
+            self.assertEqual(self.chain.KimotoGravityWell(height, {}),
+                             calculator.get_target(height), height)
+
+    def test_sliding_window_matches_reference(self):
+        calculator = blockchain.KimotoGravityWellCalculator(self.chain)
+        self._assert_matches_reference(calculator, range(860, 900))
+        self._assert_matches_reference(calculator, range(4190, 4220))
+        # repeated lookups and jumps forward and backward
+        self._assert_matches_reference(calculator, [4219, 4219, 4250, 4390, 1000, 4400])
+
+    def test_window_follows_reorg(self):
+        calculator = blockchain.KimotoGravityWellCalculator(self.chain)
+        self._assert_matches_reference(calculator, range(4380, 4401))
+        # replace the last few headers with a branch with other timestamps
+        del self.headers[4390:]
+        self._append_random_headers(10)
+        self._assert_matches_reference(calculator, range(4380, 4401))
+
+    def test_missing_header_raises(self):
+        calculator = blockchain.KimotoGravityWellCalculator(self.chain)
+        with self.assertRaises(BaseException):
+            calculator.get_target(5000)
+
+    def test_window_recovers_once_gap_is_filled(self):
+        calculator = blockchain.KimotoGravityWellCalculator(self.chain)
+        self._assert_matches_reference(calculator, [4000])
+        # headers 4090-4098 unavailable, as in the checkpoint region
+        self.chain.write(bytes(9 * 80), 4090 * 80, truncate=False)
+        for c in (calculator, self.chain._kgw_calculator):
+            with self.assertRaises(BaseException):
+                c.get_target(4100)
+        self.chain.write(self._serialize(self.headers[4090:4099]), 4090 * 80, truncate=False)
+        self._assert_matches_reference(calculator, [4100, 4101])
+        self._assert_matches_reference(self.chain._kgw_calculator, [4100, 4101])
+
+
+class TestChainworkCache(SyntheticChainTestCase):
+
+    def test_chainwork_persisted(self):
+        blockchain.blockchains[constants.net.GENESIS] = self.chain
+        calls = []
+        get_target = self.chain.get_target
+        def counting_get_target(height, chain={}):
+            calls.append(height)
+            return get_target(height, chain)
+        self.chain.get_target = counting_get_target
+        testnet = constants.net.TESTNET
+        constants.net.TESTNET = False
+        try:
+            work = self.chain.get_chainwork(4399)
+            self.assertEqual(3, len(calls))
+            self.assertEqual(2 * 68, os.path.getsize(blockchain._chainwork_path(self.config)))
+
+            # after a restart, only the partial chunk at the tip is computed
+            blockchain._CHAINWORK_CACHE.clear()
+            blockchain._CHAINWORK_CACHE['00' * 32] = 0
+            blockchain.load_chainwork_cache(self.config)
+            del calls[:]
+            self.assertEqual(work, self.chain.get_chainwork(4399))
+            self.assertEqual(1, len(calls))
+
+            # entries for headers that were replaced are dropped
+            del self.headers[3000:]
+            self._append_random_headers(1400)
+            blockchain._CHAINWORK_CACHE.clear()
+            blockchain._CHAINWORK_CACHE['00' * 32] = 0
+            blockchain.load_chainwork_cache(self.config)
+            self.assertEqual(1 * 68, os.path.getsize(blockchain._chainwork_path(self.config)))
+            del calls[:]
+            self.chain.get_chainwork(4399)
+            self.assertEqual(2, len(calls))
+        finally:
+            constants.net.TESTNET = testnet
+
+
+class TestForkSwap(SyntheticChainTestCase):
+
+    def _assert_chain_has(self, chain, headers):
+        self.assertEqual(len(headers) - 1, chain.height())
+        heights = list(range(chain.forkpoint, len(headers), 97)) + [len(headers) - 1]
+        for height in heights:
+            self.assertEqual(hash_header(headers[height]), chain.get_hash(height), height)
+        self.assertEqual(headers[-1], chain.read_header(len(headers) - 1))
+        self.assertEqual((chain.height() - chain.forkpoint + 1) * 32, os.path.getsize(chain.hashes_path()))
+
+    def test_swap_thousands_of_headers(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_a = self.chain
+        headers_a = self.headers
+        swaps = blockchain.get_swap_lock_stats()['swaps']
+
+        # a branch from height 1400 that overtakes the 4400 headers of chain_a
+        headers_b = self._random_branch(headers_a[:1400], 4000)
+        chain_b = chain_a.fork(headers_b[1400])
+        fork_b_path = chain_b.path()
+        chain_b.write(self._serialize(headers_b[1401:]), 80)
+        chain_b.swap_with_parent()
+
+        self.assertEqual(None, chain_b.parent)
+        self.assertEqual(chain_b, chain_a.parent)
+        self.assertEqual(1400, chain_a.forkpoint)
+        self._assert_chain_has(chain_b, headers_b)
+        self._assert_chain_has(chain_a, headers_a)
+        self.assertFalse(os.path.exists(fork_b_path))
+        self.assertEqual([os.path.basename(chain_a.path())], os.listdir(os.path.join(self.data_dir, 'forks')))
+        self.assertEqual(swaps + 1, blockchain.get_swap_lock_stats()['swaps'])
+
+        # and back again
+        headers_a = self._random_branch(headers_a, 1100)
+        chain_a.write(self._serialize(headers_a[4400:]), (4400 - 1400) * 80)
+        chain_a.swap_with_parent()
+        self.assertEqual(None, chain_a.parent)
+        self._assert_chain_has(chain_a, headers_a)
+        self._assert_chain_has(chain_b, headers_b)
+        self.assertEqual(swaps + 2, blockchain.get_swap_lock_stats()['swaps'])
+
+        blockchain.blockchains = {}
+        blockchain.read_blockchains(self.config)
+        self.assertEqual(2, len(blockchain.blockchains))
+        self._assert_chain_has(blockchain.get_best_chain(), headers_a)
+        self._assert_chain_has(blockchain.blockchains[hash_header(headers_b[1400])], headers_b)
+
+
+class TestCheckpoints(SyntheticChainTestCase):
+
+    def _reference_checkpoints(self, chain, n):
+        # what get_checkpoints did before it streamed the headers file,
+        # with the target taken at the last block of each chunk
+        return [(chain.get_hash((index+1) * 2016 - 1), chain.KimotoGravityWell((index+1) * 2016 - 1, {}))
+                for index in range(n)]
+
+    def test_single_pass_matches_reference(self):
+        blockchain.blockchains[constants.net.GENESIS] = self.chain
+        self._append_random_headers(2000)
+        testnet = constants.net.TESTNET
+        constants.net.TESTNET = False
+        try:
+            # all of the synthetic chain is within the name expiration depth
+            self.assertEqual([], self.chain.get_checkpoints())
+            cp = self.chain.get_checkpoints(include_unexpired_names=True)
+            self.assertEqual(3, len(cp))
+            self.assertEqual(hash_header(self.headers[3 * 2016 - 1]), cp[2][0])
+            self.assertEqual(self._reference_checkpoints(self.chain, 3), cp)
+
+            # chunks below the forkpoint come from the parent
+            headers_b = self._random_branch(self.headers[:3000], 4000)
+            chain_b = self.chain.fork(headers_b[3000])
+            chain_b.write(self._serialize(headers_b[3001:]), 80)
+            cp = chain_b.get_checkpoints(include_unexpired_names=True)
+            self.assertEqual(3, len(cp))
+            self.assertEqual(hash_header(headers_b[3 * 2016 - 1]), cp[2][0])
+            self.assertEqual(self._reference_checkpoints(chain_b, 3), cp)
+        finally:
+            constants.net.TESTNET = testnet
+
+    def test_has_chunk(self):
+        blockchain.blockchains[constants.net.GENESIS] = self.chain
+        self.assertEqual([True, True, False], [self.chain.has_chunk(i) for i in range(3)])
+        # a gap in the middle of a chunk
+        self.chain.write(bytes(80), 3000 * 80, truncate=False)
+        self.assertFalse(self.chain.has_chunk(1))
+        self.chain.write(self._serialize(self.headers[3000:3001]), 3000 * 80, truncate=False)
+        # chunks below the forkpoint come from the parent
+        headers_b = self._random_branch(self.headers[:3000], 3100)
+        chain_b = self.chain.fork(headers_b[3000])
+        chain_b.write(self._serialize(headers_b[3001:]), 80)
+        self.assertEqual([True, True, True, False], [chain_b.has_chunk(i) for i in range(4)])
@@ -1,7 +1,15 @@
+import asyncio
+import shutil
+import tempfile
 import unittest
 from decimal import Decimal
+from unittest import mock
 
+from electrum_sct import commands
 from electrum_sct.commands import Commands, eval_bool
+from electrum_sct.names import name_op_to_script, OP_NAME_UPDATE
+from electrum_sct.transaction import Transaction
+from electrum_sct.tx_store import TxStore
 
 from . import TestCaseForTestnet
 
@@ -63,6 +71,42 @@ class TestCommands(unittest.TestCase):
                 self.assertEqual(xkey2, cmds.convert_xkey(xkey1, xtype2))
 
 
+    @mock.patch.object(commands, 'verify_tx_is_in_block')
+    def test_name_show_refetches_stored_tx_with_wrong_txid(self, mock_verify):
+        script = name_op_to_script({'op': OP_NAME_UPDATE, 'name': b'd/test', 'value': b'v'})
+        script += '76a914' + '00' * 20 + '88ac'
+        def name_tx(value):
+            return ('01000000' + '01' + '00' * 32 + '00000000' + '00' + 'ffffffff'
+                    + '01' + value.to_bytes(8, 'little').hex() + '%02x' % (len(script) // 2) + script
+                    + '00000000')
+        raw_tx = name_tx(1000000)
+        txid = Transaction(raw_tx).txid()
+        store = TxStore(tempfile.mkdtemp(prefix="test_tx_store"), 1000000)
+        self.addCleanup(shutil.rmtree, store.path)
+        store.put(txid, name_tx(2000000))
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        class MockNetwork:
+            tx_store = store
+            bhi_lock = asyncio.Lock()
+            async def get_history_for_scripthash(self, sh):
+                return [{'tx_hash': txid, 'height': 100}]
+            def blockchain(self):
+                return mock.Mock(height=lambda: 200, read_header=lambda height: {})
+            async def get_merkle_for_transaction(self, tx_hash, height):
+                return {'block_height': height, 'pos': 0, 'merkle': []}
+            async def get_transaction(self, tx_hash):
+                return raw_tx
+            def run_from_another_thread(self, coro):
+                return loop.run_until_complete(coro)
+
+        cmds = Commands(config=None, wallet=None, network=MockNetwork())
+        result = cmds.name_show('d/test')
+        self.assertEqual((txid, 'v'), (result['txid'], result['value']))
+        # the wrong entry was replaced by the one from the network
+        self.assertEqual(raw_tx, store.get(txid))
+
 class TestCommandsTestnet(TestCaseForTestnet):
 
     def test_convert_xkey(self):
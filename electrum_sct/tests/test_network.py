@@ -1,14 +1,30 @@
 import asyncio
+import collections
+import json
+import os
+import random
 import tempfile
 import unittest
 
+import aiorpcx
+
 from electrum_sct import constants
 from electrum_sct.simple_config import SimpleConfig
 from electrum_sct import blockchain
-from electrum_sct.interface import Interface
-from electrum_sct.crypto import sha256
+from electrum_sct import bitcoin
+from electrum_sct.interface import Interface, NotificationSession
+from electrum_sct.network import Network, ServerStats, RPCMetrics, UntrustedServerReturnedError, payload_size
+from electrum_sct.synchronizer import Synchronizer, history_status
+from electrum_sct.transaction import Transaction
+from electrum_sct.tx_store import TxStore
+from electrum_sct.verifier import SPV
+from electrum_sct.bitcoin import hash_decode, hash_encode
+from electrum_sct.blockchain import hash_header
+from electrum_sct.crypto import sha256, sha256d
 from electrum_sct.util import bh2u
 
+from .test_transaction import signed_blob, signed_segwit_blob
+
 
 class MockTaskGroup:
     async def spawn(self, x): return
@@ -16,6 +32,7 @@ class MockTaskGroup:
 class MockNetwork:
     main_taskgroup = MockTaskGroup()
     asyncio_loop = asyncio.get_event_loop()
+    def get_chunk_sources(self, interface): return []
 
 class MockInterface(Interface):
     def __init__(self, config):
@@ -113,6 +130,577 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_pipelined_catchup(self):
+        blockchain.blockchains = {}
+        config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network"),
+                               'header_pipeline_depth': 3})
+        ifa = MockInterface(config)
+        ifa.tip = 5 * 2016 + 99
+        in_flight, max_in_flight, connected = 0, 0, []
+        async def fetch_chunk(index, tip=None):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            # later chunks arrive first
+            await asyncio.sleep(0.01 * (6 - index))
+            in_flight -= 1
+            return {'hex': str(index), 'count': min(2016, tip - index * 2016 + 1)}
+        def connect_chunk(index, hexdata, checked=None):
+            self.assertEqual(str(index), hexdata)
+            self.assertEqual(hexdata, checked)
+            connected.append(index)
+            return True
+        ifa._fetch_chunk = fetch_chunk
+        ifa.blockchain.precheck_chunk = lambda index, hexdata: hexdata
+        ifa.blockchain.connect_chunk = connect_chunk
+        ifa.network.trigger_callback = lambda *args: None
+        self.assertEqual(('catchup', ifa.tip + 1), asyncio.get_event_loop().run_until_complete(ifa.sync_until(0)))
+        self.assertEqual([0, 1, 2, 3, 4, 5], connected)
+        self.assertEqual(3, max_in_flight)
+
+    def test_striped_catchup(self):
+        blockchain.blockchains = {}
+        config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network"),
+                               'header_pipeline_depth': 2})
+        ifa = MockInterface(config)
+        ifa.tip = 5 * 2016 + 99
+        fetched_from = {}
+        def make_source(server, fetch):
+            class Source:
+                async def _fetch_chunk(self, index, tip=None):
+                    fetched_from.setdefault(index, []).append(server)
+                    return await fetch(index, tip)
+            source = Source()
+            source.server = server
+            return source
+        async def fetch(index, tip=None):
+            return {'hex': str(index), 'count': min(2016, tip - index * 2016 + 1)}
+        async def lie(index, tip=None):
+            return {'hex': 'bad', 'count': min(2016, tip - index * 2016 + 1)}
+        async def stall(index, tip=None):
+            await asyncio.sleep(10)
+        liar, staller = make_source('liar', lie), make_source('staller', stall)
+        ifa._fetch_chunk = make_source(ifa.server, fetch)._fetch_chunk
+        connected, penalized = [], []
+        def connect_chunk(index, hexdata, checked=None):
+            self.assertEqual(str(index), hexdata)
+            connected.append(index)
+            return True
+        ifa.blockchain.precheck_chunk = lambda index, hexdata: None if hexdata == 'bad' else hexdata
+        ifa.blockchain.connect_chunk = connect_chunk
+        ifa.network.trigger_callback = lambda *args: None
+        ifa.network.get_chunk_sources = lambda interface: [liar, staller]
+        ifa.network.get_network_timeout_seconds = lambda request_type: 0.05
+        ifa.network.penalize_chunk_source = lambda source, seconds: penalized.append(source.server)
+        self.assertEqual(('catchup', ifa.tip + 1), asyncio.get_event_loop().run_until_complete(ifa.sync_until(0)))
+        self.assertEqual([0, 1, 2, 3, 4, 5], connected)
+        # striped over the three servers, then reassigned
+        self.assertEqual({0: [ifa.server], 1: ['liar', ifa.server], 2: ['staller', ifa.server],
+                          3: [ifa.server], 4: ['liar', ifa.server], 5: ['staller', ifa.server]}, fetched_from)
+        self.assertEqual(['liar', 'liar', 'staller', 'staller'], sorted(penalized))
+
+    def test_prefetch_name_window(self):
+        class MockChain:
+            have = {0, 1, 5}  # chunks already on disk
+            def height(self): return 9 * 2016 + 5
+            def has_chunk(self, index): return index in self.have
+        chain = MockChain()
+        config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network"),
+                               'name_prefetch_depth': 5 * 2016})
+        network = Network.__new__(Network)
+        network.config = config
+        network.interface = None
+        network._blockchain = chain
+        network.name_prefetch_progress = (0, 0)
+        requested, progress = [], []
+        async def request_chunk(height, tip=None, *, can_return_early=False):
+            requested.append(height // 2016)
+            chain.have.add(height // 2016)
+            return True, 2016
+        network.request_chunk = request_chunk
+        network.trigger_callback = lambda event, *args: progress.append((event,) + args)
+        checkpoints = constants.net.CHECKPOINTS
+        constants.net.CHECKPOINTS = [None] * 8  # max checkpoint at 7 * 2016 - 1
+        try:
+            # the window starts in chunk 4; 7 and above are not checkpointed
+            self.assertEqual([4, 5, 6], network.get_name_window_chunks())
+            asyncio.get_event_loop().run_until_complete(network._prefetch_name_window_chunks())
+            self.assertEqual([6, 4], requested)
+            self.assertEqual([('name_prefetch', 1, 3), ('name_prefetch', 2, 3),
+                              ('name_prefetch', 3, 3)], progress)
+            # nothing left to do
+            asyncio.get_event_loop().run_until_complete(network._prefetch_name_window_chunks())
+            self.assertEqual(2, len(requested))
+            self.assertEqual(3, len(progress))
+            network.config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network"),
+                                           'name_prefetch_depth': 0})
+            self.assertEqual([], network.get_name_window_chunks())
+        finally:
+            constants.net.CHECKPOINTS = checkpoints
+
+
+class TestServerStats(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix="test_network"), 'server_stats')
+
+    def test_stats(self):
+        stats = ServerStats(self.path)
+        stats.record_request('fast:1:s', 'server.ping', 0.1)
+        stats.record_request('fast:1:s', 'blockchain.block.headers', 5.0)
+        stats.record_request('fast:1:s', 'server.ping', 0.2)
+        stats.record_transfer('fast:1:s', 1000000, 2.0)
+        stats.record_request('flaky:1:s', 'server.ping', None)
+        stats.record_error('flaky:1:s')
+        stats.record_request('flaky:1:s', 'server.ping', 0.1)
+        d = stats.to_dict()
+        # chunk downloads do not count towards the RTT
+        self.assertAlmostEqual(0.12, d['fast:1:s']['rtt'])
+        self.assertEqual(0, d['fast:1:s']['error_rate'])
+        self.assertEqual(500000, d['fast:1:s']['bytes_per_second'])
+        self.assertAlmostEqual(2 / 3, d['flaky:1:s']['error_rate'])
+        self.assertIsNone(d['flaky:1:s']['bytes_per_second'])
+
+        stats.save()
+        self.assertEqual(d, ServerStats(self.path).to_dict())
+
+    def test_choose_prefers_fast_and_reliable_servers(self):
+        stats = ServerStats(None)
+        for i in range(10):
+            stats.record_request('fast:1:s', 'server.ping', 0.05)
+            stats.record_request('slow:1:s', 'server.ping', 2.0)
+            stats.record_request('flaky:1:s', 'server.ping', None if i % 2 else 0.05)
+        random.seed(0)
+        servers = ['fast:1:s', 'slow:1:s', 'flaky:1:s', 'new:1:s']
+        chosen = collections.Counter(stats.choose(servers) for i in range(1000))
+        self.assertGreater(chosen['fast:1:s'], chosen['flaky:1:s'])
+        self.assertGreater(chosen['flaky:1:s'], chosen['slow:1:s'])
+        self.assertGreater(chosen['slow:1:s'], 0)
+        # new servers get the median RTT, and no errors
+        self.assertGreater(chosen['new:1:s'], chosen['flaky:1:s'])
+
+
+class TestRPCMetrics(unittest.TestCase):
+
+    def test_payload_size(self):
+        for obj in ['abc', 12, None, [], {}, [1, 'a'], {'count': 2, 'hex': 'ab' * 10}, [{'height': 1, 'tx_hash': 'ff'}]]:
+            self.assertEqual(len(json.dumps(obj, separators=(',', ':'))), payload_size(obj))
+
+    def test_metrics(self):
+        metrics = RPCMetrics()
+        for i in range(4):
+            metrics.request_started('blockchain.scripthash.subscribe', ['ab' * 32])
+        metrics.request_finished('blockchain.scripthash.subscribe', 0.01, 'ok', 'cd' * 32)
+        metrics.request_finished('blockchain.scripthash.subscribe', 0.3, 'ok', None)
+        metrics.request_finished('blockchain.scripthash.subscribe', 20.0, 'timeout')
+        metrics.request_started('blockchain.transaction.get', ['ef' * 32])
+        metrics.request_finished('blockchain.transaction.get', 0.5, 'error')
+        metrics.record_reliable_call('get_transaction', 1, 0.5, False)
+        metrics.record_reliable_call('get_transaction', 3, 1.5, True)
+
+        snapshot = metrics.snapshot()
+        m = snapshot['methods']['blockchain.scripthash.subscribe']
+        self.assertEqual(4, m['calls'])
+        self.assertEqual(1, m['in_flight'])
+        self.assertEqual(4, m['max_in_flight'])
+        self.assertEqual(1, m['timeouts'])
+        self.assertEqual(0, m['errors'])
+        self.assertAlmostEqual(0.155, m['mean_time'])
+        self.assertEqual(1, m['latency_histogram']['<=0.05'])
+        self.assertEqual(1, m['latency_histogram']['<=0.5'])
+        self.assertEqual(2, sum(m['latency_histogram'].values()))
+        self.assertEqual(4 * 68, m['request_bytes'])
+        self.assertEqual(66 + 4, m['response_bytes'])
+        m = snapshot['methods']['blockchain.transaction.get']
+        self.assertEqual((1, 0), (m['errors'], m['in_flight']))
+        r = snapshot['best_effort_reliable']['get_transaction']
+        self.assertEqual((2, 2, 1), (r['calls'], r['retries'], r['failures']))
+        self.assertAlmostEqual(1.0, r['mean_time'])
+        self.assertIn('5 requests, 0 coalesced, 1 in flight, 1 timeouts, 1 errors', metrics.summary())
+
+
+class MockSession(NotificationSession):
+    def __init__(self):
+        self.interface = None
+        self._coalesced_requests = {}
+        self.server_version = ['ElectrumPersonalServer 0.1.7', '1.4']
+        self.sent = []
+        self.responses = {}
+    async def _send_request(self, method, params, timeout=None):
+        self.sent.append((method, params))
+        fut = self.responses[repr(params)] = asyncio.Future()
+        return await fut
+
+
+class TestRequestCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.session = MockSession()
+
+    def run_requests(self, requests):
+        tasks = [asyncio.ensure_future(self.session.send_request(*request)) for request in requests]
+        self.loop.run_until_complete(asyncio.sleep(0))
+        return tasks
+
+    def test_identical_requests_share_one(self):
+        tasks = self.run_requests([('blockchain.transaction.get', ['aa']),
+                                   ('blockchain.transaction.get', ['aa']),
+                                   ('blockchain.transaction.get', ['bb'])])
+        self.assertEqual([('blockchain.transaction.get', ['aa']), ('blockchain.transaction.get', ['bb'])],
+                         self.session.sent)
+        self.session.responses[repr(['aa'])].set_result('tx a')
+        self.session.responses[repr(['bb'])].set_result('tx b')
+        results = self.loop.run_until_complete(asyncio.gather(*tasks))
+        self.assertEqual(['tx a', 'tx a', 'tx b'], results)
+        self.assertEqual({}, self.session._coalesced_requests)
+        # once answered, the same request goes to the server again
+        tasks = self.run_requests([('blockchain.transaction.get', ['aa'])])
+        self.assertEqual(3, len(self.session.sent))
+        self.session.responses[repr(['aa'])].set_result('tx a')
+        self.loop.run_until_complete(tasks[0])
+
+    def test_errors_are_shared(self):
+        tasks = self.run_requests([('blockchain.scripthash.get_history', ['aa'])] * 2)
+        self.session.responses[repr(['aa'])].set_exception(ValueError('bad'))
+        results = self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.assertEqual(1, len(self.session.sent))
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_request_is_cancelled_with_the_last_caller(self):
+        tasks = self.run_requests([('blockchain.transaction.get_merkle', ['aa', 1])] * 2)
+        response = self.session.responses[repr(['aa', 1])]
+        tasks[0].cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(response.cancelled())
+        tasks[1].cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertTrue(response.cancelled())
+        self.assertEqual({}, self.session._coalesced_requests)
+
+    def test_send_requests_one_by_one_without_batches(self):
+        self.assertFalse(self.session.supports_batch_requests())
+        task = asyncio.ensure_future(self.session.send_requests('blockchain.transaction.get', [['aa'], ['bb']]))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual([('blockchain.transaction.get', ['aa']), ('blockchain.transaction.get', ['bb'])],
+                         self.session.sent)
+        error = aiorpcx.jsonrpc.RPCError(2, 'no such transaction')
+        self.session.responses[repr(['aa'])].set_exception(error)
+        self.session.responses[repr(['bb'])].set_result('tx b')
+        self.assertEqual([error, 'tx b'], self.loop.run_until_complete(task))
+        self.session.server_version = ['ElectrumX 1.8.5', '1.4']
+        self.assertTrue(self.session.supports_batch_requests())
+
+    def test_subscribe_many(self):
+        queue = asyncio.Queue()
+        self.session.subscriptions = collections.defaultdict(list)
+        self.session.cache = {'blockchain.scripthash.subscribe' + repr(['aa']): 'status a'}
+        task = asyncio.ensure_future(self.session.subscribe_many(
+            'blockchain.scripthash.subscribe', [['aa'], ['bb'], ['cc']], queue))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        # only the ones not cached are requested
+        self.assertEqual([('blockchain.scripthash.subscribe', ['bb']), ('blockchain.scripthash.subscribe', ['cc'])],
+                         self.session.sent)
+        self.session.responses[repr(['bb'])].set_result('status b')
+        self.session.responses[repr(['cc'])].set_result(None)
+        self.loop.run_until_complete(task)
+        self.assertEqual([['aa', 'status a'], ['bb', 'status b'], ['cc', None]],
+                         [queue.get_nowait() for i in range(3)])
+        self.assertEqual([queue], self.session.subscriptions['blockchain.scripthash.subscribe' + repr(['cc'])])
+
+    def test_other_methods_are_not_coalesced(self):
+        tasks = self.run_requests([('blockchain.transaction.broadcast', ['aa'])] * 2)
+        self.assertEqual(2, len(self.session.sent))
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+class MockJobNetwork:
+    interface = None
+    def __init__(self):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network")})
+        self.callbacks = []
+    def register_callback(self, callback, events): pass
+    def trigger_callback(self, event, *args): self.callbacks.append(event)
+    def blockchain(self): return self
+    def height(self): return 0
+
+class MockWallet:
+    def __init__(self, network):
+        self.network = network
+        self.db = self
+        self.up_to_date = False
+        self.synchronize_calls = 0
+        self.get_unverified_txs_calls = 0
+        self.received = []
+        self.history = {}
+    def diagnostic_name(self): return 'mock'
+    def get_addr_history(self, addr): return self.history.get(addr, [])
+    def synchronize(self): self.synchronize_calls += 1
+    def get_history(self): return []
+    def get_addresses(self): return []
+    def is_up_to_date(self): return self.up_to_date
+    def set_up_to_date(self, up_to_date): self.up_to_date = up_to_date
+    def get_unverified_txs(self):
+        self.get_unverified_txs_calls += 1
+        return {}
+    def get_transaction(self, tx_hash): return None
+    def receive_tx_callback(self, tx_hash, tx, tx_height): self.received.append(tx_hash)
+
+
+class TestNetworkJobsIdle(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.network = MockJobNetwork()
+        self.wallet = MockWallet(self.network)
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_synchronizer_does_nothing_until_woken_up(self):
+        synchronizer = Synchronizer(self.wallet)
+        task = asyncio.ensure_future(synchronizer.main())
+        self.run_for(0.5)
+        self.assertEqual(1, self.wallet.synchronize_calls)
+        self.assertTrue(self.wallet.up_to_date)
+        self.assertEqual(['wallet_updated'], self.network.callbacks)
+        synchronizer.wakeup()
+        self.run_for(0.2)
+        self.assertEqual(2, self.wallet.synchronize_calls)
+        self.run_for(0.3)
+        self.assertEqual(2, self.wallet.synchronize_calls)
+        task.cancel()
+        self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        self.loop.run_until_complete(synchronizer.group.cancel_remaining())
+
+    def test_spv_does_nothing_until_woken_up(self):
+        spv = SPV(self.network, self.wallet)
+        task = asyncio.ensure_future(spv.main())
+        self.run_for(0.5)
+        self.assertEqual(1, self.wallet.get_unverified_txs_calls)
+        spv.wakeup()
+        self.run_for(0.2)
+        self.assertEqual(2, self.wallet.get_unverified_txs_calls)
+        self.run_for(0.3)
+        self.assertEqual(2, self.wallet.get_unverified_txs_calls)
+        task.cancel()
+        self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+    def test_wakeup_event_outlives_resets(self):
+        for job in (Synchronizer(self.wallet), SPV(self.network, self.wallet)):
+            wakeup = job._wakeup
+            job.wakeup()
+            self.run_for(0)
+            self.assertTrue(wakeup.is_set())
+            job._reset()
+            self.assertIs(wakeup, job._wakeup)
+            self.assertFalse(wakeup.is_set())
+
+
+class MockSubscriptionSession:
+    def __init__(self):
+        self.batches = []
+    async def subscribe_many(self, method, params_list, queue):
+        self.batches.append(params_list)
+
+
+class TestSubscriptions(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.network = MockJobNetwork()
+        self.wallet = MockWallet(self.network)
+
+    def test_addresses_are_subscribed_in_batches(self):
+        self.network.config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network"),
+                                            'subscription_batch_size': 100, 'subscription_rate_limit': 0})
+        synchronizer = Synchronizer(self.wallet)
+        synchronizer.interface = collections.namedtuple('MockInterface', 'session')(MockSubscriptionSession())
+        addrs = [bitcoin.hash160_to_p2pkh(i.to_bytes(20, 'big')) for i in range(250)]
+        for addr in addrs:
+            self.loop.run_until_complete(synchronizer._add_address(addr))
+        task = asyncio.ensure_future(synchronizer.send_subscriptions())
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        batches = synchronizer.session.batches
+        self.assertEqual([100, 100, 50], [len(batch) for batch in batches])
+        self.assertEqual([[bitcoin.address_to_scripthash(addr)] for addr in addrs], sum(batches, []))
+        self.assertEqual(set(), synchronizer.requested_addrs)
+        task.cancel()
+        self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+    def test_local_status_is_cached(self):
+        synchronizer = Synchronizer(self.wallet)
+        self.assertIsNone(synchronizer.get_local_status('addr'))
+        hist = [('aa' * 32, 10)]
+        self.wallet.history['addr'] = hist
+        status = synchronizer.get_local_status('addr')
+        self.assertEqual(history_status(hist), status)
+        self.assertIs(hist, synchronizer._status_cache['addr'][0])
+        self.assertEqual(status, synchronizer.get_local_status('addr'))
+        # the wallet replaces the list when the history changes
+        hist = self.wallet.history['addr'] = hist + [('bb' * 32, 0)]
+        self.assertEqual(history_status(hist), synchronizer.get_local_status('addr'))
+        hist.append(('cc' * 32, 0))
+        self.assertEqual(history_status(hist), synchronizer.get_local_status('addr'))
+
+
+class MockProofNetwork(MockJobNetwork):
+    def __init__(self, headers, proofs):
+        super().__init__()
+        self.bhi_lock = asyncio.Lock()
+        self.headers = headers
+        self.proofs = proofs
+        self.header_reads = []
+        self.requests = []
+    def read_header(self, height):
+        self.header_reads.append(height)
+        return self.headers.get(height)
+    def height(self): return max(self.headers)
+    async def get_merkle_for_transactions(self, txs):
+        self.requests.append(list(txs))
+        return [self.proofs.get(tx_hash) or UntrustedServerReturnedError(original_exception=aiorpcx.RPCError(1, 'not found'))
+                for tx_hash, tx_height in txs]
+
+
+class MockSPVWallet(MockWallet):
+    def __init__(self, network, unverified):
+        super().__init__(network)
+        self.unverified = unverified
+        self.verified = {}
+        self.undone = {}
+    def get_unverified_txs(self): return dict(self.unverified)
+    def add_verified_tx(self, tx_hash, info):
+        self.unverified.pop(tx_hash)
+        self.undone.pop(tx_hash, None)
+        self.verified[tx_hash] = info
+    def get_undone_verified_tx(self, tx_hash): return self.undone.get(tx_hash)
+    def remove_undone_verified_tx(self, tx_hash): self.undone.pop(tx_hash)
+    def remove_unverified_tx(self, tx_hash, tx_height): self.unverified.pop(tx_hash)
+
+
+def make_block_header(merkle_root: str, height: int, nonce: int = 0):
+    raw = bytes(4) + bytes(32) + hash_decode(merkle_root) + height.to_bytes(4, 'little') + bytes(4) + nonce.to_bytes(4, 'little')
+    return blockchain.deserialize_header(raw, height)
+
+
+class TestSPVProofs(unittest.TestCase):
+
+    def test_proofs_are_batched_and_cached(self):
+        loop = asyncio.get_event_loop()
+        tx_a, tx_b, tx_c, tx_d = (bh2u(sha256(x)) for x in (b'a', b'b', b'c', b'd'))
+        root = hash_encode(sha256d(hash_decode(tx_a) + hash_decode(tx_b)))
+        headers = {10: make_block_header(root, 10), 11: make_block_header(tx_c, 11), 12: make_block_header(tx_d, 12)}
+        proofs = {tx_a: {'block_height': 10, 'pos': 0, 'merkle': [tx_b]},
+                  tx_b: {'block_height': 10, 'pos': 1, 'merkle': [tx_a]},
+                  tx_c: {'block_height': 11, 'pos': 0, 'merkle': []}}
+        network = MockProofNetwork(headers, proofs)
+        wallet = MockSPVWallet(network, {tx_a: 10, tx_b: 10, tx_c: 11, tx_d: 12})
+        spv = SPV(network, wallet)
+        spv.blockchain = network
+
+        loop.run_until_complete(spv._request_proofs())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        # one request for all proofs, one header read per block for each pass
+        self.assertEqual([[(tx_a, 10), (tx_b, 10), (tx_c, 11), (tx_d, 12)]], network.requests)
+        self.assertEqual([10, 11, 12, 10, 11], network.header_reads)
+        self.assertEqual({tx_a, tx_b, tx_c}, set(wallet.verified))
+        self.assertEqual(1, wallet.verified[tx_b].txpos)
+        self.assertEqual(hash_header(headers[10]), wallet.verified[tx_a].header_hash)
+        self.assertEqual({}, wallet.unverified)
+        self.assertTrue(spv.is_up_to_date())
+
+        loop.run_until_complete(spv.group.cancel_remaining())
+
+        # a reorg undid the verifications, and the wallet was restarted;
+        # after a reorg back, the block of tx_a is the same again
+        for tx_hash, tx_height in ((tx_a, 10), (tx_c, 11)):
+            wallet.undone[tx_hash] = wallet.verified.pop(tx_hash)
+            wallet.unverified[tx_hash] = tx_height
+        headers[11] = make_block_header(tx_c, 11, nonce=1)
+        spv = SPV(network, wallet)
+        spv.blockchain = network
+        loop.run_until_complete(spv._request_proofs())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual([(tx_c, 11)], network.requests[-1])
+        self.assertEqual({}, wallet.unverified)
+        self.assertEqual({}, wallet.undone)
+        self.assertEqual(hash_header(headers[11]), wallet.verified[tx_c].header_hash)
+        loop.run_until_complete(spv.group.cancel_remaining())
+
+
+class MockTxNetwork(MockJobNetwork):
+    def __init__(self, config, txs):
+        super().__init__()
+        self.config = config
+        self.txs = txs
+        self.batches = []
+        self.tx_store = TxStore(os.path.join(config.path, 'txstore'), 1000000)
+    async def get_transactions(self, tx_hashes, timeout=None):
+        self.batches.append(list(tx_hashes))
+        return [self.txs.get(tx_hash) or UntrustedServerReturnedError(original_exception=Exception('not found'))
+                for tx_hash in tx_hashes]
+
+
+class TestTransactionFetcher(unittest.TestCase):
+
+    def test_fetch_in_batches_most_urgent_first(self):
+        loop = asyncio.get_event_loop()
+        txid = Transaction(signed_blob).txid()
+        config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network"),
+                               'tx_fetch_batch_size': 2, 'tx_fetch_concurrency': 1})
+        network = MockTxNetwork(config, {txid: signed_blob})
+        wallet = MockWallet(network)
+        synchronizer = Synchronizer(wallet)
+        hist = [('aa' * 32, 100), ('bb' * 32, 0), (txid, 200)]
+        loop.run_until_complete(synchronizer._request_missing_txs(hist, allow_server_not_finding_tx=True))
+        self.assertEqual({'fetched': 0, 'total': 3, 'bytes': 0}, synchronizer.get_tx_fetch_progress())
+        self.assertFalse(synchronizer.is_up_to_date())
+
+        task = asyncio.ensure_future(synchronizer._fetch_transactions())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        # unconfirmed first, then the newest
+        self.assertEqual([['bb' * 32, txid], ['aa' * 32]], network.batches)
+        self.assertEqual([txid], wallet.received)
+        self.assertEqual({'fetched': 3, 'total': 3, 'bytes': len(signed_blob) // 2},
+                         synchronizer.get_tx_fetch_progress())
+        self.assertTrue(synchronizer.is_up_to_date())
+        self.assertIn('tx_fetch_progress', network.callbacks)
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+        # another wallet finds the transaction in the store
+        wallet = MockWallet(network)
+        synchronizer = Synchronizer(wallet)
+        loop.run_until_complete(synchronizer._request_missing_txs([(txid, 200)]))
+        task = asyncio.ensure_future(synchronizer._fetch_transactions())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual([txid], wallet.received)
+        self.assertEqual(2, len(network.batches))
+        self.assertEqual(1, network.tx_store.get_stats()['hits'])
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+    def test_stored_tx_with_wrong_txid_is_fetched(self):
+        loop = asyncio.get_event_loop()
+        txid = Transaction(signed_blob).txid()
+        config = SimpleConfig({'electrum_path': tempfile.mkdtemp(prefix="test_network")})
+        network = MockTxNetwork(config, {txid: signed_blob})
+        network.tx_store.put(txid, signed_segwit_blob)
+        wallet = MockWallet(network)
+        synchronizer = Synchronizer(wallet)
+        loop.run_until_complete(synchronizer._request_missing_txs([(txid, 200)]))
+        task = asyncio.ensure_future(synchronizer._fetch_transactions())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual([[txid]], network.batches)
+        self.assertEqual([txid], wallet.received)
+        self.assertEqual(signed_blob, network.tx_store.get(txid))
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
 
 if __name__=="__main__":
     constants.set_regtest()
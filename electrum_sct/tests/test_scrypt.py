@@ -0,0 +1,46 @@
+import os
+import unittest
+from unittest import mock
+
+from electrum_sct import scrypt
+from electrum_sct.util import bfh
+
+from . import SequentialTestCase
+
+
+class Test_scrypt(SequentialTestCase):
+
+    VECTORS = [
+        ("00"*80, "161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69"),
+        ("ff"*80, "5253069c14ecedf978745486375ee37415e977f55cdbedac31ebee8bf33dd127"),
+        ("01000000ae178934851bfa0e83ccb6a3fc4bfddff3641e104b6c4680c31509074e699be2bd672d8d2199ef37a59678f92443083e3b85edef8b45c71759371f823bab59a97126614f44d5001d45920180", "01796dae1f78a72dfb09356db6f027cd884ba0201e6365b72aa54b3b00000000"),
+    ]
+
+    def test_scrypt_1024_1_1_80(self):
+        for header, hash in self.VECTORS:
+            self.assertEqual(bfh(hash), scrypt.scrypt_1024_1_1_80(bfh(header)))
+
+    @mock.patch.object(scrypt, 'MIN_BATCH_SIZE', 1)
+    def test_scrypt_1024_1_1_80_many(self):
+        headers = [bfh(header) for header, hash in self.VECTORS]
+        self.assertEqual([bfh(hash) for header, hash in self.VECTORS],
+                         scrypt.scrypt_1024_1_1_80_many(headers))
+        self.assertEqual([], scrypt.scrypt_1024_1_1_80_many([]))
+
+    @unittest.skipIf(scrypt.numpy is None, "numpy not available")
+    @mock.patch.object(scrypt, 'MIN_BATCH_SIZE', 1)
+    @mock.patch.object(scrypt, 'BATCH_SIZE', 2)
+    def test_scrypt_1024_1_1_80_many_matches_pure_across_batches(self):
+        headers = [os.urandom(80) for i in range(3)]
+        hashes = scrypt.scrypt_1024_1_1_80_many(headers)
+        self.assertEqual([scrypt.scrypt_1024_1_1_80(h) for h in headers], hashes)
+
+    def test_small_batches_are_hashed_one_by_one(self):
+        headers = [bfh(header) for header, hash in self.VECTORS[:1]]
+        with mock.patch.object(scrypt, '_scrypt_1024_1_1_80_numpy') as vectorized:
+            self.assertEqual([bfh(self.VECTORS[0][1])], scrypt.scrypt_1024_1_1_80_many(headers))
+        self.assertFalse(vectorized.called)
+
+    def test_invalid_header_length(self):
+        with self.assertRaises(ValueError):
+            scrypt.scrypt_1024_1_1_80_many([bytes(79)])
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+
+from electrum_sct.tx_store import TxStore
+
+from . import SequentialTestCase
+
+
+class TestTxStore(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp(prefix="test_tx_store")
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        store = TxStore(self.path, 1000)
+        self.assertIsNone(store.get('aa' * 32))
+        store.put('aa' * 32, '0102')
+        self.assertEqual('0102', store.get('aa' * 32))
+        stats = store.get_stats()
+        self.assertEqual((1, 2, 1, 1, 0.5), (stats['transactions'], stats['size'], stats['hits'],
+                                             stats['misses'], stats['hit_rate']))
+
+    def test_least_recently_used_are_evicted(self):
+        store = TxStore(self.path, 30)
+        for c in 'abc':
+            store.put(c * 64, '00' * 10)
+        store.get('a' * 64)
+        store.put('d' * 64, '00' * 10)
+        self.assertIsNone(store.get('b' * 64))
+        for c in 'acd':
+            self.assertIsNotNone(store.get(c * 64))
+        self.assertEqual(30, store.get_stats()['size'])
+        self.assertEqual(1, store.get_stats()['evictions'])
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'bb', 'b' * 64)))
+
+    def test_index_survives_restart(self):
+        store = TxStore(self.path, 1000)
+        store.put('aa' * 32, '01')
+        store.put('bb' * 32, '0203')
+        store.get('aa' * 32)
+        store.save()
+        store = TxStore(self.path, 1000)
+        self.assertEqual(3, store.size)
+        self.assertEqual(['bb' * 32, 'aa' * 32], list(store.entries))
+        self.assertEqual('0203', store.get('bb' * 32))
+
+    def test_index_is_rebuilt_from_files(self):
+        store = TxStore(self.path, 1000)
+        store.put('aa' * 32, '01')
+        store = TxStore(self.path, 1000)
+        self.assertEqual('01', store.get('aa' * 32))
+
+    def test_files_written_after_the_index_are_not_lost(self):
+        store = TxStore(self.path, 1000)
+        store.put('aa' * 32, '01')
+        store.put('bb' * 32, '02')
+        store.save()
+        # crash after more changes
+        store.put('cc' * 32, '0304')
+        store.get('bb' * 32)
+        store.get('aa' * 32)
+        store.discard('bb' * 32)
+        store = TxStore(self.path, 1000)
+        self.assertEqual(['aa' * 32, 'cc' * 32], list(store.entries))
+        self.assertEqual(3, store.size)
+        self.assertTrue(store.dirty)
+        store.save()
+        self.assertFalse(TxStore(self.path, 1000).dirty)
+
+    def test_save_only_when_changed(self):
+        store = TxStore(self.path, 1000)
+        store.save()
+        self.assertFalse(os.path.exists(os.path.join(self.path, TxStore.INDEX_FILE)))
+        store.put('aa' * 32, '01')
+        store.save()
+        self.assertFalse(store.dirty)
+        store.put('aa' * 32, '01')
+        store.get('aa' * 32)
+        self.assertFalse(store.dirty)
+        store.discard('aa' * 32)
+        self.assertTrue(store.dirty)
+
+    def test_no_path_stores_nothing(self):
+        store = TxStore(None, 1000)
+        store.put('aa' * 32, '01')
+        self.assertIsNone(store.get('aa' * 32))
@@ -79,6 +79,20 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def test_undone_verifications_survive_restart(self):
+        storage = WalletStorage(self.wallet_path)
+        txid = 'ab' * 32
+        info = TxMinedInfo(height=10, timestamp=1500000000, txpos=1, header_hash='cd' * 32)
+        storage.db.add_verified_tx(txid, info)
+        storage.db.undo_verified_tx(txid)
+        self.assertFalse(storage.db.is_in_verified_tx(txid))
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(info, storage.db.get_undone_verified_tx(txid))
+        storage.db.add_verified_tx(txid, info)
+        self.assertIsNone(storage.db.get_undone_verified_tx(txid))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
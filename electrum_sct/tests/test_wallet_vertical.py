@@ -9,9 +9,10 @@ from electrum_sct import Transaction
 from electrum_sct import SimpleConfig
 from electrum_sct.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
 from electrum_sct.wallet import sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet
-from electrum_sct.util import bfh, bh2u
+from electrum_sct.util import bfh, bh2u, TxMinedInfo
 from electrum_sct.transaction import TxOutput
 from electrum_sct.mnemonic import seed_type
+from electrum_sct.tx_store import TxStore
 
 from electrum_sct.plugins.trustedcoin import trustedcoin
 
@@ -1811,6 +1812,37 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_add_verified_tx_without_network(self, mock_write):
+        w = self.create_old_wallet()
+        self.assertIsNone(w.network)
+        txid = self.txid_list[0]
+        tx = Transaction(self.transactions[txid])
+        w.receive_tx_callback(txid, tx, 1230000)
+        self.assertIn(txid, w.get_unverified_txs())
+        w.add_verified_tx(txid, TxMinedInfo(height=1230000, timestamp=1500000000, txpos=1, header_hash='00' * 32))
+        self.assertNotIn(txid, w.get_unverified_txs())
+        self.assertEqual(1230000, w.get_tx_height(txid).height)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_get_input_tx_checks_stored_txid(self, mock_write):
+        w = self.create_old_wallet()
+        txid, other_txid = self.txid_list[:2]
+        store = TxStore(tempfile.mkdtemp(prefix="test_tx_store"), 1000000)
+        self.addCleanup(shutil.rmtree, store.path)
+        store.put(txid, self.transactions[other_txid])
+
+        class MockNetwork:
+            tx_store = store
+            async def get_transaction(_, tx_hash, timeout=None):
+                return self.transactions[tx_hash]
+            def run_from_another_thread(_, coro):
+                return asyncio.get_event_loop().run_until_complete(coro)
+        w.network = MockNetwork()
+        self.assertEqual(txid, w.get_input_tx(txid).txid())
+        # the wrong entry was replaced by the one from the network
+        self.assertEqual(self.transactions[txid], store.get(txid))
+
 
 class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
     transactions = {
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# Electrum-SCT - lightweight SmartCryptoTech client
+# Copyright (C) 2019 SmartCryptoTech Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from .util import PrintError, bfh, bh2u
+
+# seconds; covers coarse file timestamps and puts racing save()
+INDEX_MTIME_MARGIN = 2
+
+
+class TxStore(PrintError):
+    """Raw transactions shared by the wallets and commands of a daemon,
+    stored on disk by txid. When the store grows over max_size bytes, the
+    transactions used least recently are evicted.
+
+    Each transaction is a file under path, named after its txid. The
+    index file lists them in LRU order with their size;
+    it is written by save(), which the network calls periodically. If the
+    files changed after the index was written (e.g. after a crash), the
+    index is reconciled with them on load, and rebuilt if missing.
+    Methods do blocking file I/O; call them off the event loop.
+    Callers check that what they get has the txid they asked for.
+    If path is None, nothing is stored.
+    """
+
+    INDEX_FILE = "index"
+
+    def __init__(self, path: Optional[str], max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # txid -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = False  # entries changed since the index was saved
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load_index()
+
+    def diagnostic_name(self):
+        return 'TxStore'
+
+    def _tx_path(self, txid: str) -> str:
+        return os.path.join(self.path, txid[:2], txid)
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        try:
+            with open(index_path, "r", encoding='utf-8') as f:
+                indexed = [(txid, size) for txid, size in json.loads(f.read())]
+            index_mtime = os.stat(index_path).st_mtime_ns
+        except FileNotFoundError:
+            indexed, index_mtime = [], None
+        except Exception as e:
+            self.print_error('rebuilding index:', repr(e))
+            indexed, index_mtime = [], None
+        entries = indexed
+        # rebuild, or reconcile if files were added or removed after the index was saved
+        if index_mtime is None or any(shard.stat().st_mtime_ns >= index_mtime
+                                      for shard in os.scandir(self.path) if shard.is_dir()):
+            entries = self._reconcile(indexed, self._scan())
+            self.dirty = entries != indexed
+        for txid, size in entries:
+            self.entries[txid] = size
+            self.size += size
+
+    def _scan(self) -> list:
+        found = []
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if len(entry.name) != 64:  # leftover temp file
+                    continue
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        return [(txid, size) for mtime, txid, size in sorted(found)]
+
+    @classmethod
+    def _reconcile(cls, indexed: list, scanned: list) -> list:
+        """Keeps the order of the indexed transactions that still have
+        a file, followed by the files missing from the index."""
+        sizes = dict(scanned)
+        entries = [(txid, sizes.pop(txid)) for txid, size in indexed if txid in sizes]
+        entries.extend((txid, size) for txid, size in scanned if txid in sizes)
+        return entries
+
+    def get(self, txid: str) -> Optional[str]:
+        """Returns the raw transaction as hex, if stored."""
+        if not self.path:
+            return None
+        with self.lock:
+            if txid not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(txid)
+        try:
+            with open(self._tx_path(txid), "rb") as f:
+                raw = f.read()
+        except OSError:
+            with self.lock:
+                self._remove(txid)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return bh2u(raw)
+
+    def put(self, txid: str, raw_tx: str) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            if txid in self.entries:
+                self.entries.move_to_end(txid)
+                return
+        raw = bfh(raw_tx)
+        path = self._tx_path(txid)
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(raw)
+            os.replace(temp_path, path)
+        except OSError as e:
+            self.print_error('cannot store {}: {}'.format(txid, repr(e)))
+            return
+        with self.lock:
+            if txid not in self.entries:
+                self.entries[txid] = len(raw)
+                self.size += len(raw)
+                self.dirty = True
+            while self.size > self.max_size and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, txid: str) -> None:
+        size = self.entries.pop(txid, 0)
+        self.size -= size
+        self.dirty = True
+        try:
+            os.unlink(self._tx_path(txid))
+        except OSError:
+            pass
+
+    def discard(self, txid: str) -> None:
+        """Removes a transaction, e.g. one that failed the txid check."""
+        if not self.path:
+            return
+        with self.lock:
+            self._remove(txid)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'transactions': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+            }
+
+    def save(self) -> None:
+        """Writes the index, if anything but the LRU order changed."""
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            # date the index back to before the snapshot, so that on load,
+            # files written while it was taken look newer than the index
+            snapshot_time = time.time() - INDEX_MTIME_MARGIN
+            s = json.dumps(list(self.entries.items()))
+            self.dirty = False
+        path = os.path.join(self.path, self.INDEX_FILE)
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
+        try:
+            with open(temp_path, "w", encoding='utf-8') as f:
+                f.write(s)
+            os.utime(temp_path, (snapshot_time, snapshot_time))
+            os.replace(temp_path, path)
+        except OSError as e:
+            self.print_error('cannot save index:', repr(e))
+            with self.lock:
+                self.dirty = True
@@ -187,8 +187,11 @@ class MyEncoder(json.JSONEncoder):
     def default(self, obj):
         # note: this does not get called for namedtuples :(  https://bugs.python.org/issue30343
         from .transaction import Transaction
+        from .blockchain import BlockHeader
         if isinstance(obj, Transaction):
             return obj.as_dict()
+        if isinstance(obj, BlockHeader):
+            return obj.to_dict()
         if isinstance(obj, Satoshis):
             return str(obj)
         if isinstance(obj, Fiat):
@@ -22,6 +22,7 @@
 # SOFTWARE.
 
 import asyncio
+from collections import defaultdict
 from typing import Sequence, Optional, TYPE_CHECKING
 
 import aiorpcx
@@ -46,17 +47,30 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+# number of merkle proofs requested in one JSON-RPC batch
+SPV_PROOF_BATCH_SIZE = 50
+
+# seconds between retries while waiting for headers in the checkpoint
+# region, which are downloaded without notice
+SPV_CHECKPOINT_RETRY_INTERVAL = 1
+
+
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
+        # set when there might be work for main(); made once, so that
+        # wakeup() can be called before the first _reset()
+        asyncio.set_event_loop(network.asyncio_loop)
+        self._wakeup = asyncio.Event()
         NetworkJobOnDefaultServer.__init__(self, network)
 
     def _reset(self):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self._wakeup.clear()
 
     async def _start_tasks(self):
         async with self.group as group:
@@ -65,17 +79,33 @@ class SPV(NetworkJobOnDefaultServer):
     def diagnostic_name(self):
         return '{}:{}'.format(self.__class__.__name__, self.wallet.diagnostic_name())
 
+    def wakeup(self):
+        """Makes main() look for unverified transactions again, e.g. when
+        one is added or the blockchain changes. Thread-safe."""
+        self.network.asyncio_loop.call_soon_threadsafe(lambda: self._wakeup.set())
+
     async def main(self):
         self.blockchain = self.network.blockchain()
         while True:
+            self._wakeup.clear()
             await self._maybe_undo_verifications()
-            await self._request_proofs()
-            await asyncio.sleep(0.1)
+            waiting_for_chunks = await self._request_proofs()
+            if not waiting_for_chunks:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), SPV_CHECKPOINT_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
-    async def _request_proofs(self):
+    async def _request_proofs(self) -> bool:
+        """Requests the proofs that can be requested. Returns whether some
+        transactions wait for headers in the checkpoint region."""
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
+        waiting_for_chunks = False
 
+        txs_by_height = defaultdict(list)
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -83,58 +113,94 @@ class SPV(NetworkJobOnDefaultServer):
             # or before headers are available
             if tx_height <= 0 or tx_height > local_height:
                 continue
+            txs_by_height[tx_height].append(tx_hash)
+
+        to_request = []
+        for tx_height, tx_hashes in sorted(txs_by_height.items()):
             # if it's in the checkpoint region, we still might not have the header
             header = self.blockchain.read_header(tx_height)
             if header is None:
                 if tx_height < constants.net.max_checkpoint():
-                    await self.group.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+                    await self.group.spawn(self._request_chunk(tx_height))
+                    waiting_for_chunks = True
                 continue
-            # request now
-            self.print_error('requested merkle', tx_hash)
-            self.requested_merkle.add(tx_hash)
-            await self.group.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            header_hash = hash_header(header)
+            for tx_hash in tx_hashes:
+                if self._verify_from_cache(tx_hash, tx_height, header, header_hash):
+                    continue
+                to_request.append((tx_hash, tx_height))
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.print_error('tx {} not at height {}'.format(tx_hash, tx_height))
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            try: self.requested_merkle.remove(tx_hash)
-            except KeyError: pass
-            return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        if tx_height != merkle.get('block_height'):
-            self.print_error('requested tx_height {} differs from received tx_height {} for txid {}'
-                             .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
+        # request now
+        for i in range(0, len(to_request), SPV_PROOF_BATCH_SIZE):
+            txs = to_request[i:i+SPV_PROOF_BATCH_SIZE]
+            self.print_error('requested {} merkle proofs at heights {}-{}'.format(len(txs), txs[0][1], txs[-1][1]))
+            self.requested_merkle.update(tx_hash for tx_hash, tx_height in txs)
+            await self.group.spawn(self._request_and_verify_proofs, txs)
+        return waiting_for_chunks
+
+    async def _request_chunk(self, height):
+        await self.network.request_chunk(height, None, can_return_early=True)
+        self._wakeup.set()
+
+    def _verify_from_cache(self, tx_hash, tx_height, header, header_hash) -> bool:
+        info = self.wallet.db.get_undone_verified_tx(tx_hash)
+        if info is None:
+            return False
+        if info.height != tx_height or info.header_hash != header_hash:
+            self.wallet.db.remove_undone_verified_tx(tx_hash)
+            return False
+        self.print_error("verified {} (cached proof)".format(tx_hash))
+        self.merkle_roots[tx_hash] = header.get('merkle_root')
+        self.wallet.add_verified_tx(tx_hash, info)
+        return True
+
+    async def _request_and_verify_proofs(self, txs):
+        merkles = await self.network.get_merkle_for_transactions(txs)
+        verified = []
+        headers = {}  # height -> header, read once per block
         # we need to wait if header sync/reorg is still ongoing, hence lock:
         async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.print_error("skipping merkle proof check %s" % tx_hash)
-            else:
-                self.print_error(str(e))
-                raise GracefulDisconnect(e)
+            for (tx_hash, tx_height), merkle in zip(txs, merkles):
+                if isinstance(merkle, UntrustedServerReturnedError):
+                    if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                        raise merkle
+                    self.print_error('tx {} not at height {}'.format(tx_hash, tx_height))
+                    self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                    self.requested_merkle.discard(tx_hash)
+                    continue
+                # Verify the hash of the server-provided merkle branch to a
+                # transaction matches the merkle root of its block
+                if tx_height != merkle.get('block_height'):
+                    self.print_error('requested tx_height {} differs from received tx_height {} for txid {}'
+                                     .format(tx_height, merkle.get('block_height'), tx_hash))
+                tx_height = merkle.get('block_height')
+                pos = merkle.get('pos')
+                merkle_branch = merkle.get('merkle')
+                if tx_height not in headers:
+                    headers[tx_height] = self.network.blockchain().read_header(tx_height)
+                header = headers[tx_height]
+                try:
+                    verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
+                except MerkleVerificationFailure as e:
+                    if self.network.config.get("skipmerklecheck"):
+                        self.print_error("skipping merkle proof check %s" % tx_hash)
+                    else:
+                        self.print_error(str(e))
+                        raise GracefulDisconnect(e)
+                verified.append((tx_hash, tx_height, pos, header))
         # we passed all the tests
-        self.merkle_roots[tx_hash] = header.get('merkle_root')
-        try: self.requested_merkle.remove(tx_hash)
-        except KeyError: pass
-        self.print_error("verified %s" % tx_hash)
-        header_hash = hash_header(header)
-        tx_info = TxMinedInfo(height=tx_height,
-                              timestamp=header.get('timestamp'),
-                              txpos=pos,
-                              header_hash=header_hash)
-        self.wallet.add_verified_tx(tx_hash, tx_info)
+        header_hashes = {}
+        for tx_hash, tx_height, pos, header in verified:
+            self.merkle_roots[tx_hash] = header.get('merkle_root')
+            self.requested_merkle.discard(tx_hash)
+            self.print_error("verified %s" % tx_hash)
+            if tx_height not in header_hashes:
+                header_hashes[tx_height] = hash_header(header)
+            tx_info = TxMinedInfo(height=tx_height,
+                                  timestamp=header.get('timestamp'),
+                                  txpos=pos,
+                                  header_hash=header_hashes[tx_height])
+            self.wallet.add_verified_tx(tx_hash, tx_info)
         #if self.is_up_to_date() and self.wallet.is_up_to_date():
         #    self.wallet.save_verified_tx(write=True)
 
@@ -186,6 +252,7 @@ class SPV(NetworkJobOnDefaultServer):
             self.requested_merkle.remove(tx_hash)
         except KeyError:
             pass
+        self.wakeup()
 
     def is_up_to_date(self):
         return not self.requested_merkle
@@ -955,6 +955,14 @@ class Abstract_Wallet(AddressSynchronizer):
         # all the input txs, in which case we ask the network.
         tx = self.db.get_transaction(tx_hash)
         if not tx and self.network:
+            raw_tx = self.network.tx_store.get(tx_hash)
+            if raw_tx:
+                tx = Transaction(raw_tx)
+                if tx.txid() == tx_hash:
+                    return tx
+                self.print_error(f'dropping stored txn with wrong txid for {tx_hash}')
+                self.network.tx_store.discard(tx_hash)
+                tx = None
             try:
                 raw_tx = self.network.run_from_another_thread(
                     self.network.get_transaction(tx_hash, timeout=10))
@@ -964,6 +972,8 @@ class Abstract_Wallet(AddressSynchronizer):
                     raise e
             else:
                 tx = Transaction(raw_tx)
+                if tx.txid() == tx_hash:
+                    self.network.tx_store.put(tx_hash, raw_tx)
         return tx
 
     def add_hw_info(self, tx):
@@ -1616,6 +1626,8 @@ class Deterministic_Wallet(Abstract_Wallet):
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.storage.write()
+            if self.synchronizer:
+                self.synchronizer.wakeup()
             return True
         else:
             return False